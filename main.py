@@ -3,19 +3,34 @@
 
 import logging
 import sqlite3
-import requests
+import httpx
 import json
 import os
 import sys
+import hashlib
+import hmac
+from urllib.parse import urlsplit, parse_qs
 from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ChatMemberHandler, ContextTypes, MessageHandler, filters
 import asyncio
+import threading
+import time
+import random
+import uuid
+import heapq
+import contextvars
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # === КОНФИГУРАЦИЯ (ЗАПОЛНИТЕ СВОИМИ ДАННЫМИ) ===
 BOT_TOKEN = "YOUR_BOT_TOKEN"
 CRYPTOBOT_API_TOKEN = "YOUR_CRYPTOBOT_TOKEN"
-CRYPTOBOT_API_URL = "https://pay.crypt.bot/api/"
+CRYPTOBOT_API_URL = os.environ.get("CRYPTOBOT_API_URL", "https://pay.crypt.bot/api/")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
 ADMIN_ID = 123456789  # Ваш Telegram ID
 CHANNEL_USERNAME = "@your_channel"
 
@@ -25,11 +40,119 @@ DEFAULT_STEAM_COEFFICIENT = 1.03  # 3% комиссия для Steam
 DEFAULT_EXCHANGE_RATE = 77.5  # Курс USDT к рублю
 CRYPTOBOT_FEE = 0.03  # Комиссия CryptoBot 3%
 
+# Сетевые настройки CryptoBot API (секунды / количество соединений)
+CRYPTOBOT_CONNECT_TIMEOUT = 5
+CRYPTOBOT_DEFAULT_TIMEOUT = 15
+CRYPTOBOT_CREATE_TIMEOUT = 15
+CRYPTOBOT_CHECK_TIMEOUT = 10
+CRYPTOBOT_MAX_CONNECTIONS = 20
+CRYPTOBOT_MAX_KEEPALIVE = 10
+CRYPTOBOT_KEEPALIVE_EXPIRY = 30
+CRYPTOBOT_BATCH_SIZE = 1000  # максимум invoice_ids в одном запросе getInvoices
+
+# Фоновая проверка неоплаченных заказов (секунды)
+PAYMENT_POLL_INTERVAL = 30
+
+# Кэш проверки подписки на канал (секунды / количество записей)
+SUBSCRIPTION_CACHE_POSITIVE_TTL = 600
+SUBSCRIPTION_CACHE_NEGATIVE_TTL = 30
+SUBSCRIPTION_CACHE_MAX_SIZE = 50000
+
+# Запись накопленной активности пользователей в базу (секунды)
+USER_FLUSH_INTERVAL = 5
+
+# Сверка кэша банов с таблицей banned_users (секунды)
+BAN_VERIFY_INTERVAL = 3600
+
+# Время на оплату заказа и отмена просроченных заказов
+ORDER_TIMEOUT = 900  # секунды
+EXPIRY_RETRY_DELAY = 30  # повтор прохода после ошибки, секунды
+EXPIRY_EDIT_RATE = 20  # правок сообщений в секунду при массовой отмене
+EXPIRY_EDIT_ATTEMPTS = 5  # попыток правки одного сообщения при ответах RetryAfter
+
+# Резерв товара живёт дольше заказа: обычно его снимает отмена заказа,
+# TTL нужен для резервов, под которые заказ так и не был создан
+RESERVATION_TTL = ORDER_TIMEOUT + 300  # секунды
+RESERVATION_SWEEP_INTERVAL = 60  # секунды
+
+# Рассылка: общий лимит Bot API около 30 сообщений в секунду
+BROADCAST_RATE = 25  # сообщений в секунду
+BROADCAST_BURST = 25
+BROADCAST_CONCURRENCY = 20  # одновременных запросов send_message
+BROADCAST_BATCH_SIZE = 100  # получателей за один запрос к базе (и шаг сохранения прогресса)
+BROADCAST_PROGRESS_INTERVAL = 5  # секунды между обновлениями прогресса у админа
+
+# Дневные сводки выручки
+ROLLUP_INTERVAL = 300  # секунды между инкрементальными проходами
+ROLLUP_BATCH_SIZE = 5000  # оплаченных заказов за одну транзакцию
+REPORT_DEFAULT_DAYS = 7
+
+# Товаров на одной странице админ-панели
+ADMIN_PAGE_SIZE = 10
+# Товаров на одной странице категории у покупателя
+CATEGORY_PAGE_SIZE = 10
+
+# Длинные списки админки (/banned, /orders)
+MESSAGE_LIMIT = 4096  # лимит длины сообщения Telegram
+LIST_FETCH_SIZE = 200  # строк за один fetchmany
+LIST_MAX_MESSAGES = 5  # сообщений за один показ, дальше — кнопка следующей страницы
+
+# Вебхук CryptoBot: в @CryptoBot → Crypto Pay → My Apps → Webhooks укажите
+# https://ваш-домен/cryptobot/webhook (проксируется на HOST:PORT ниже)
+CRYPTOBOT_WEBHOOK_ENABLED = os.environ.get("CRYPTOBOT_WEBHOOK_ENABLED", "0") == "1"
+CRYPTOBOT_WEBHOOK_HOST = os.environ.get("CRYPTOBOT_WEBHOOK_HOST", "127.0.0.1")
+CRYPTOBOT_WEBHOOK_PORT = int(os.environ.get("CRYPTOBOT_WEBHOOK_PORT", "8080"))
+CRYPTOBOT_WEBHOOK_PATH = "/cryptobot/webhook"
+
+# Метрики в формате Prometheus; при том же адресе, что у вебхука, сервер общий
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "0") == "1"
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9090"))
+METRICS_PATH = "/metrics"
+LOOP_LAG_INTERVAL = 1.0  # секунды между замерами задержки цикла событий
+DB_QUERY_LABEL_LENGTH = 80  # символов SQL в метке запроса
+
+# Флуд-контроль: токенов в секунду / запас на одного пользователя и на весь бот.
+# Навигация — команды и кнопки каталога, платёжные действия — кнопки с префиксами ниже
+FLOOD_USER_RATE = 2
+FLOOD_USER_BURST = 10
+FLOOD_GLOBAL_RATE = 300
+FLOOD_GLOBAL_BURST = 600
+FLOOD_PAYMENT_PREFIXES = ('buy_', 'check_', 'confirm_custom')
+FLOOD_PAYMENT_USER_RATE = 0.2  # одна покупка или проверка оплаты в 5 секунд
+FLOOD_PAYMENT_USER_BURST = 3
+FLOOD_PAYMENT_GLOBAL_RATE = 50  # платёжных действий в секунду на всех
+FLOOD_PAYMENT_GLOBAL_BURST = 100
+FLOOD_IDLE_TTL = 600  # секунды без действий, после которых ведро пользователя удаляется
+FLOOD_MAX_USERS = 100000  # вёдер пользователей в памяти
+
 # Путь к базе данных
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATA_DIR = os.path.join(BASE_DIR, "data")
+DATA_DIR = os.environ.get("SHOP_DATA_DIR", os.path.join(BASE_DIR, "data"))
 DB_PATH = os.path.join(DATA_DIR, "accounts.sqlite3")
 
+# Настройки SQLite
+DB_READER_THREADS = 4
+DB_BUSY_TIMEOUT = 10  # секунды ожидания блокировки
+DB_CACHE_SIZE_KB = 16384
+DB_MMAP_SIZE = 128 * 1024 * 1024
+DB_STATEMENT_CACHE = 256
+
+# Профилирование обработчиков: PROFILING_ENABLED=1 или /profile on
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "0") == "1"
+PROFILING_SAMPLE_RATE = float(os.environ.get("PROFILING_SAMPLE_RATE", "0.1"))  # доля трассируемых обновлений
+PROFILING_SLOWEST = 20  # самых медленных трасс в дампе
+PROFILING_DUMP_INTERVAL = 60  # секунды между дампами в PROFILES_DIR
+PROFILES_DIR = os.path.join(DATA_DIR, "profiles")
+
+# Соединений с Bot API (как у HTTPXRequest по умолчанию в ApplicationBuilder)
+BOT_CONNECTION_POOL_SIZE = 256
+
+# Параллельная обработка обновлений: разные пользователи одновременно, один пользователь по очереди
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "32"))  # обработчиков одновременно
+UPDATE_MAX_PENDING = 1024  # обновлений в работе вместе с ждущими очереди своего пользователя
+UPDATE_USER_MAX_PENDING = 8  # обновлений одного пользователя в работе и в очереди, лишние отбрасываются
+
 # Создаем папку data если её нет
 if not os.path.exists(DATA_DIR):
     os.makedirs(DATA_DIR, exist_ok=True)
@@ -46,10 +169,281 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def ensure_column(cursor, table, column, definition):
+    """Добавляет колонку в существующую таблицу, если её ещё нет"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+# === МИГРАЦИИ СХЕМЫ ===
+# Номер применённой миграции хранится в PRAGMA user_version; init_db создаёт
+# базовые таблицы, а всё, что меняет схему после этого, добавляется сюда новой миграцией
+
+def _migration_order_columns(cursor):
+    # Колонки, добавленные после первой версии схемы
+    ensure_column(cursor, 'orders', 'chat_id', 'INTEGER')
+    ensure_column(cursor, 'orders', 'message_id', 'INTEGER')
+    ensure_column(cursor, 'orders', 'pricing_version', 'INTEGER')
+
+def _migration_indexes(cursor):
+    # Статистика и отчёты по оплаченным заказам
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_status_paid_at ON orders (status, paid_at)')
+    # Только ожидающие оплаты заказы: опрос CryptoBot и отмена просроченных
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_orders_pending_created_at ON orders (created_at)
+        WHERE status = 'pending'
+    ''')
+    # Поиск заказа по вебхуку CryptoBot
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_cryptobot_invoice_id ON orders (cryptobot_invoice_id)')
+    # Заказы покупателя
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders (user_id, created_at)')
+    # /ban @username
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)')
+    # /unban @username и список банов
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_banned_users_username ON banned_users (username)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_banned_users_banned_at ON banned_users (banned_at)')
+    # Товары категории в админке и каталоге
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_products_category ON products (category_id, is_active, id)')
+
+def _migration_stock_reservations(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_reservations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            invoice_id TEXT UNIQUE,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            status TEXT DEFAULT 'active',  -- 'active', 'committed' или 'released'
+            created_at TIMESTAMP,
+            expires_at TIMESTAMP,
+            FOREIGN KEY (product_id) REFERENCES products (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_stock_reservations_active ON stock_reservations (expires_at)
+        WHERE status = 'active'
+    ''')
+
+def _migration_broadcasts(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT DEFAULT 'running',  -- 'running' или 'done'
+            admin_chat_id INTEGER,
+            progress_message_id INTEGER,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            last_user_id INTEGER DEFAULT 0,
+            created_at TIMESTAMP,
+            updated_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+
+def _migration_user_reachability(cursor):
+    # Итог последней доставки: рассылки пропускают чаты, заблокировавшие бота
+    ensure_column(cursor, 'users', 'is_reachable', 'INTEGER DEFAULT 1')
+    ensure_column(cursor, 'users', 'last_failure_reason', 'TEXT')
+    ensure_column(cursor, 'users', 'last_delivery_at', 'TIMESTAMP')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_reachable ON users (user_id)
+        WHERE is_reachable = 1
+    ''')
+    ensure_column(cursor, 'broadcasts', 'include_unreachable', 'INTEGER DEFAULT 0')
+
+def _migration_shop_counters(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shop_counters (
+            name TEXT PRIMARY KEY,
+            value REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    rebuild_shop_counters(cursor)
+
+def _migration_revenue_rollups(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS revenue_daily (
+            day TEXT PRIMARY KEY,
+            orders INTEGER NOT NULL DEFAULT 0,
+            price_amount REAL NOT NULL DEFAULT 0,
+            price_with_fee REAL NOT NULL DEFAULT 0,
+            custom_amount REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS revenue_daily_product (
+            day TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            product_name TEXT,
+            product_type TEXT,
+            orders INTEGER NOT NULL DEFAULT 0,
+            price_amount REAL NOT NULL DEFAULT 0,
+            price_with_fee REAL NOT NULL DEFAULT 0,
+            custom_amount REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, product_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS revenue_daily_category (
+            day TEXT NOT NULL,
+            category_id INTEGER NOT NULL,  -- 0: товар удалён
+            category_name TEXT,
+            orders INTEGER NOT NULL DEFAULT 0,
+            price_amount REAL NOT NULL DEFAULT 0,
+            price_with_fee REAL NOT NULL DEFAULT 0,
+            custom_amount REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, category_id)
+        )
+    ''')
+    # Водяной знак: последний учтённый оплаченный заказ по (paid_at, id)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            name TEXT PRIMARY KEY,
+            last_paid_at TIMESTAMP,
+            last_order_id INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+def _migration_admin_products_index(cursor):
+    # Постраничный список товаров админки по (category_id, id)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_products_category_id ON products (category_id, id)')
+
+def _migration_orders_user_id_index(cursor):
+    # /orders листает заказы пользователя по id; индекс (user_id, created_at)
+    # не даёт этого порядка и заставлял сортировать все заказы на каждой странице
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_id_id ON orders (user_id, id)')
+
+MIGRATIONS = [
+    (1, 'колонки orders для уведомлений и версии цен', _migration_order_columns),
+    (2, 'вторичные индексы', _migration_indexes),
+    (3, 'резервы товара', _migration_stock_reservations),
+    (4, 'рассылки', _migration_broadcasts),
+    (5, 'доступность пользователей для рассылок', _migration_user_reachability),
+    (6, 'счётчики статистики', _migration_shop_counters),
+    (7, 'дневные сводки выручки', _migration_revenue_rollups),
+    (8, 'индекс страниц товаров админки', _migration_admin_products_index),
+    (9, 'индекс страниц заказов пользователя', _migration_orders_user_id_index),
+]
+
+# === СЧЁТЧИКИ СТАТИСТИКИ ===
+# Агрегаты для экрана статистики хранятся в shop_counters и меняются в той же
+# транзакции, что и заказ, товар или пользователь; /rebuild_stats пересчитывает их с нуля
+
+SHOP_COUNTER_QUERIES = {
+    'active_products': 'SELECT COUNT(*) FROM products WHERE is_active = 1',
+    'total_stock': 'SELECT COALESCE(SUM(stock), 0) FROM products WHERE is_active = 1',
+    'paid_orders': "SELECT COUNT(*) FROM orders WHERE status = 'paid'",
+    'paid_revenue': "SELECT COALESCE(SUM(price_amount), 0) FROM orders WHERE status = 'paid'",
+    'paid_with_fee': "SELECT COALESCE(SUM(price_with_fee), 0) FROM orders WHERE status = 'paid'",
+    'users_total': 'SELECT COUNT(*) FROM users',
+    'users_reachable': 'SELECT COUNT(*) FROM users WHERE is_reachable = 1',
+}
+
+def bump_counters(conn, **deltas):
+    """Прибавляет deltas к счётчикам; вызывается внутри транзакции изменения"""
+    conn.executemany('''
+        INSERT INTO shop_counters (name, value) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+    ''', [(name, delta) for name, delta in deltas.items() if delta])
+
+def read_counters(conn):
+    return dict(conn.execute('SELECT name, value FROM shop_counters').fetchall())
+
+def rebuild_shop_counters(conn):
+    """Пересчитывает счётчики полными запросами; возвращает {имя: (было, стало)} для разошедшихся"""
+    stored = read_counters(conn)
+    drift = {}
+    for name, sql in SHOP_COUNTER_QUERIES.items():
+        value = conn.execute(sql).fetchone()[0]
+        if abs(stored.get(name, 0) - value) > 1e-6:
+            drift[name] = (stored.get(name, 0), value)
+        conn.execute('''
+            INSERT INTO shop_counters (name, value) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET value = excluded.value
+        ''', (name, value))
+    return drift
+
+def run_migrations(conn):
+    """Применяет миграции новее PRAGMA user_version, каждую отдельной транзакцией"""
+    if conn.in_transaction:
+        conn.commit()
+    cursor = conn.cursor()
+    current = cursor.execute('PRAGMA user_version').fetchone()[0]
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            migrate(cursor)
+            cursor.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"🗄️ Применена миграция {version}: {description}")
+        applied.append(version)
+    if applied:
+        # Обновляем статистику планировщика под новые индексы
+        cursor.execute('ANALYZE')
+        conn.commit()
+    return applied
+
+# Запросы к растущим таблицам, которые должны оставаться на индексах:
+# (описание, SQL, параметры, индексы, любой из которых допустим в плане).
+# Для pending-заказов планировщик по статистике выбирает частичный индекс
+# или префикс status составного — оба варианта без полного сканирования
+PENDING_ORDER_INDEXES = ('idx_orders_pending_created_at', 'idx_orders_status_paid_at')
+
+QUERY_PLAN_CHECKS = [
+    ('оплаченные заказы (статистика)',
+     "SELECT COUNT(*), SUM(price_amount) FROM orders WHERE status = 'paid'", (),
+     ('idx_orders_status_paid_at',)),
+    ('ожидающие оплаты заказы (опрос CryptoBot)',
+     "SELECT invoice_id, cryptobot_invoice_id FROM orders WHERE status = 'pending' AND cryptobot_invoice_id IS NOT NULL", (),
+     PENDING_ORDER_INDEXES),
+    ('просроченные заказы',
+     "SELECT invoice_id, chat_id, message_id FROM orders WHERE status = 'pending' AND created_at < ?", ('',),
+     PENDING_ORDER_INDEXES),
+    ('самый старый ожидающий заказ',
+     "SELECT MIN(created_at) FROM orders WHERE status = 'pending'", (),
+     PENDING_ORDER_INDEXES),
+    ('заказ по счёту CryptoBot',
+     'SELECT invoice_id FROM orders WHERE cryptobot_invoice_id = ?', ('',),
+     ('idx_orders_cryptobot_invoice_id',)),
+    ('заказ по номеру',
+     'SELECT status FROM orders WHERE invoice_id = ?', ('',),
+     ('sqlite_autoindex_orders_1',)),
+    ('пользователь по username',
+     'SELECT user_id, first_name FROM users WHERE username = ?', ('',),
+     ('idx_users_username',)),
+    ('получатели рассылки',
+     'SELECT user_id FROM users WHERE is_reachable = 1 AND user_id > ? ORDER BY user_id LIMIT 100', (0,),
+     ('idx_users_reachable',)),
+    ('новые оплаченные заказы (сводки выручки)',
+     "SELECT id FROM orders WHERE status = 'paid' AND (paid_at > ? OR (paid_at = ? AND id > ?)) ORDER BY paid_at, id LIMIT 100",
+     ('', '', 0),
+     ('idx_orders_status_paid_at',)),
+    ('бан по username',
+     'SELECT user_id FROM banned_users WHERE username = ?', ('',),
+     ('idx_banned_users_username',)),
+]
+
+def check_query_plans(conn):
+    """Проверяет EXPLAIN QUERY PLAN горячих запросов; возвращает описания запросов без нужного индекса"""
+    regressions = []
+    for description, sql, params, index_names in QUERY_PLAN_CHECKS:
+        plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()]
+        if not any(name in detail for detail in plan for name in index_names):
+            logger.warning(f"⚠️ Запрос «{description}» идёт мимо индекса: {'; '.join(plan)}")
+            regressions.append(description)
+    return regressions
+
 # Инициализация базы данных
 def init_db():
     try:
-        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -91,6 +485,9 @@ def init_db():
                 status TEXT DEFAULT 'pending',
                 created_at TIMESTAMP,
                 paid_at TIMESTAMP NULL,
+                chat_id INTEGER,
+                message_id INTEGER,
+                pricing_version INTEGER,
                 FOREIGN KEY (product_id) REFERENCES products (id)
             )
         ''')
@@ -129,6 +526,17 @@ def init_db():
             )
         ''')
         
+        # История изменений коэффициентов; id записи — версия цен
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS coefficient_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                coefficient_type TEXT NOT NULL,
+                old_value REAL,
+                new_value REAL NOT NULL,
+                changed_at TIMESTAMP
+            )
+        ''')
+        
         # Добавляем категории если их нет - ТОЛЬКО СТАРЫЕ КАТЕГОРИИ
         default_categories = [
             ('Telegram Stars/Premium', 'Покупка Telegram Stars и Premium подписки'),
@@ -203,203 +611,1092 @@ def init_db():
             print("⚙️ Инициализированы коэффициенты")
         
         conn.commit()
+        
+        # После стартовых данных: миграция счётчиков учитывает стартовые товары
+        run_migrations(conn)
+        
+        regressions = check_query_plans(conn)
         conn.close()
+        if regressions:
+            print(f"⚠️ Запросов без индекса: {len(regressions)} (подробности в логе)")
         print("✅ База данных успешно инициализирована")
         
     except Exception as e:
         print(f"❌ Ошибка инициализации базы данных: {e}")
         logger.error(f"Ошибка инициализации базы данных: {e}")
 
-# Функции работы с базой данных
+# === МЕТРИКИ ===
+# Реестр метрик в памяти, отдаётся в текстовом формате Prometheus на METRICS_PATH.
+# Метрики обновляются и из потоков базы данных, поэтому у каждой свой lock
+
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + '}'
+
+class Metric:
+    """Значения метрики по наборам меток; collect() без меток вызывается при выгрузке"""
+    
+    kind = 'untyped'
+    
+    def __init__(self, name, documentation, labels=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._collect = collect
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+    
+    def _copy(self, value):
+        return value
+    
+    def get(self, **labels):
+        with self._lock:
+            return self._copy(self._values.get(self._key(labels)))
+    
+    def render(self):
+        if self._collect is not None:
+            value = self._collect()
+            with self._lock:
+                self._values[()] = value
+        with self._lock:
+            items = [(key, self._copy(value)) for key, value in self._values.items()]
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(items, key=lambda item: item[0]):
+            lines.extend(self._render_sample(list(zip(self.labels, key)), value))
+        return lines
+    
+    def _render_sample(self, labels, value):
+        return [f"{self.name}{_format_labels(labels)} {value}"]
+
+class Counter(Metric):
+    kind = 'counter'
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+    
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class MetricTimer:
+    """Записывает длительность блока with в гистограмму"""
+    
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+class Histogram(Metric):
+    kind = 'histogram'
+    
+    def __init__(self, name, documentation, labels=(), buckets=METRIC_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+    
+    def _copy(self, value):
+        # [попадания по корзинам, сумма, количество]
+        return None if value is None else (list(value[0]), value[1], value[2])
+    
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+    
+    def time(self, **labels):
+        return MetricTimer(self, labels)
+    
+    def _render_sample(self, labels, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', bound)])} {cumulative}")
+        lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', '+Inf')])} {count}")
+        lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Метрики процесса в порядке регистрации"""
+    
+    def __init__(self):
+        self._metrics = []
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def counter(self, name, documentation, labels=(), collect=None):
+        return self.register(Counter(name, documentation, labels, collect))
+    
+    def gauge(self, name, documentation, labels=(), collect=None):
+        return self.register(Gauge(name, documentation, labels, collect))
+    
+    def histogram(self, name, documentation, labels=(), buckets=METRIC_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+    
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"Ошибка сбора метрики {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+handler_latency = metrics.histogram(
+    'shop_handler_duration_seconds', 'Время обработки обновления', ('kind', 'handler')
+)
+handler_errors = metrics.counter(
+    'shop_handler_errors_total', 'Необработанные исключения в обработчиках', ('kind', 'handler')
+)
+access_check_latency = metrics.histogram(
+    'shop_access_check_duration_seconds', 'Проверки check_access до вызова обработчика'
+)
+db_query_latency = metrics.histogram(
+    'shop_db_query_duration_seconds', 'Выполнение запроса в потоке базы', ('pool', 'query')
+)
+db_queue_wait = metrics.histogram(
+    'shop_db_queue_wait_seconds', 'Ожидание свободного потока базы', ('pool',)
+)
+cryptobot_latency = metrics.histogram(
+    'shop_cryptobot_request_duration_seconds', 'Запросы к CryptoBot API', ('method',)
+)
+cryptobot_errors = metrics.counter(
+    'shop_cryptobot_errors_total', 'Ошибки запросов к CryptoBot API', ('method', 'reason')
+)
+pending_orders_gauge = metrics.gauge('shop_pending_orders', 'Неоплаченные заказы')
+oldest_pending_order_age = metrics.gauge(
+    'shop_oldest_pending_order_age_seconds', 'Возраст самого старого неоплаченного заказа'
+)
+loop_lag = metrics.histogram('shop_event_loop_lag_seconds', 'Задержка пробуждения цикла событий')
+loop_lag_last = metrics.gauge('shop_event_loop_lag_last_seconds', 'Последняя замеренная задержка цикла событий')
+metrics.counter('shop_subscription_cache_hits_total', 'Попадания в кэш подписки',
+                collect=lambda: subscription_cache.hits)
+metrics.counter('shop_subscription_cache_misses_total', 'Промахи кэша подписки',
+                collect=lambda: subscription_cache.misses)
+metrics.gauge('shop_subscription_cache_entries', 'Записей в кэше подписки',
+              collect=lambda: len(subscription_cache))
+metrics.gauge('shop_banned_users_cached', 'Забаненных пользователей в кэше',
+              collect=lambda: len(ban_cache))
+
+def query_label(sql):
+    """Метка запроса для метрик: SQL в одну строку, обрезанный до DB_QUERY_LABEL_LENGTH"""
+    return ' '.join(sql.split())[:DB_QUERY_LABEL_LENGTH]
+
+# === ПРОФИЛИРОВАНИЕ ===
+# Выборочные трассы обновлений: обработчик открывает трассу, внутри неё span'ы
+# (проверки доступа, тело обработчика, запросы к базе и Bot API) складываются в дерево.
+# Текущая трасса живёт в contextvar, поэтому без трассы span стоит одного ContextVar.get().
+# В PROFILES_DIR пишутся самые медленные трассы (JSON) и свёрнутые стеки для flamegraph.pl
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+
+NO_SPAN = _NoSpan()
+
+class Trace:
+    """Span'ы одного обновления; время span'а без вложенных считается при закрытии"""
+    
+    def __init__(self, name):
+        self.name = name
+        self.started_at = datetime.now()
+        self.duration = 0.0
+        self.spans = []  # (путь, длительность, собственное время)
+        self._stack = [[name, 0.0]]  # [имя, время вложенных span'ов]
+        self.finished = False
+    
+    def enter(self, name):
+        # Задачи, запущенные из обработчика, видят его трассу и после её закрытия
+        if self.finished:
+            return
+        # ';' разделяет кадры в свёрнутых стеках
+        self._stack.append([name.replace(';', ','), 0.0])
+    
+    def exit(self, duration):
+        if self.finished:
+            return
+        name, children = self._stack.pop()
+        self._stack[-1][1] += duration
+        path = ';'.join(frame[0] for frame in self._stack) + ';' + name
+        self.spans.append((path, duration, max(duration - children, 0.0)))
+    
+    def finish(self, duration):
+        self.finished = True
+        self.duration = duration
+        self.spans.append((self.name, duration, max(duration - self._stack[0][1], 0.0)))
+    
+    def as_dict(self):
+        return {
+            'handler': self.name,
+            'started_at': self.started_at.isoformat(sep=' ', timespec='milliseconds'),
+            'duration_ms': round(self.duration * 1000, 3),
+            'spans': [
+                {'path': path, 'duration_ms': round(duration * 1000, 3), 'self_ms': round(own * 1000, 3)}
+                for path, duration, own in self.spans
+            ]
+        }
+
+class TraceSpan:
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+    
+    def __enter__(self):
+        self.trace.enter(self.name)
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.trace.exit(time.perf_counter() - self.started)
+        return False
+
+def span(name):
+    """Участок трассы текущего обновления; без активной трассы ничего не делает"""
+    trace = current_trace.get()
+    if trace is None:
+        return NO_SPAN
+    return TraceSpan(trace, name)
+
+class Profiler:
+    """Собирает выборку трасс: N самых медленных и суммарное собственное время по стекам"""
+    
+    def __init__(self, enabled, sample_rate, slowest):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.slowest = slowest
+        self.reset()
+    
+    def reset(self):
+        self._slowest = []  # куча (длительность, номер, трасса)
+        self._stacks = {}  # свёрнутый стек -> микросекунды собственного времени
+        self.traces = 0
+        self.dumped = 0
+    
+    def start(self, name):
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        trace = Trace(name)
+        return trace, current_trace.set(trace)
+    
+    def finish(self, started, duration):
+        trace, token = started
+        current_trace.reset(token)
+        trace.finish(duration)
+        self.traces += 1
+        for path, _, own in trace.spans:
+            self._stacks[path] = self._stacks.get(path, 0) + int(own * 1_000_000)
+        entry = (duration, self.traces, trace)
+        if len(self._slowest) < self.slowest:
+            heapq.heappush(self._slowest, entry)
+        elif duration > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+    
+    def snapshot(self):
+        slowest = [trace.as_dict() for _, _, trace in sorted(self._slowest, reverse=True)]
+        stacks = [f"{path} {value}" for path, value in sorted(self._stacks.items()) if value > 0]
+        return slowest, stacks
+    
+    async def dump(self, directory=None):
+        """Пишет slowest.json и stacks.folded; возвращает каталог или None, если писать нечего"""
+        if self.traces == self.dumped:
+            return None
+        directory = directory or PROFILES_DIR
+        slowest, stacks = self.snapshot()
+        self.dumped = self.traces
+        await asyncio.to_thread(_write_profile, directory, slowest, stacks)
+        return directory
+
+def _write_profile(directory, slowest, stacks):
+    os.makedirs(directory, exist_ok=True)
+    for filename, content in (
+        ('slowest.json', json.dumps(slowest, ensure_ascii=False, indent=2)),
+        ('stacks.folded', '\n'.join(stacks) + '\n')
+    ):
+        path = os.path.join(directory, filename)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(path + '.tmp', path)
+
+profiler = Profiler(PROFILING_ENABLED, PROFILING_SAMPLE_RATE, PROFILING_SLOWEST)
+
+class ProfilingRequest(HTTPXRequest):
+    """HTTPXRequest, который отмечает каждый вызов Bot API span'ом текущей трассы"""
+    
+    async def do_request(self, url, method, *args, **kwargs):
+        with span(f"bot_api:{url.rsplit('/', 1)[-1]}"):
+            return await super().do_request(url, method, *args, **kwargs)
+
+# === СЛОЙ ДОСТУПА К БАЗЕ ДАННЫХ ===
+# Долгоживущие соединения в отдельных потоках: один писатель (SQLite допускает
+# только одну запись одновременно) и несколько читателей (WAL не блокирует чтение).
+# Обработчики получают awaitable и не блокируют цикл событий.
+
+def configure_connection(conn, readonly=False):
+    cursor = conn.cursor()
+    cursor.execute('PRAGMA journal_mode = WAL')
+    cursor.execute('PRAGMA synchronous = NORMAL')  # в WAL безопасно, fsync только на чекпоинтах
+    cursor.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT * 1000}')
+    cursor.execute(f'PRAGMA cache_size = -{DB_CACHE_SIZE_KB}')
+    cursor.execute(f'PRAGMA mmap_size = {DB_MMAP_SIZE}')
+    cursor.execute('PRAGMA temp_store = MEMORY')
+    if readonly:
+        cursor.execute('PRAGMA query_only = ON')
+    cursor.close()
+
 def get_db_connection():
-    return sqlite3.connect(DB_PATH, check_same_thread=False, timeout=10)
+    """Отдельное соединение с теми же настройками (инициализация схемы, утилиты)"""
+    conn = sqlite3.connect(
+        DB_PATH, check_same_thread=False, timeout=DB_BUSY_TIMEOUT,
+        cached_statements=DB_STATEMENT_CACHE
+    )
+    configure_connection(conn)
+    return conn
+
+class Database:
+    """Асинхронный доступ к SQLite через выделенные потоки с постоянными соединениями"""
+    
+    def __init__(self, path, readers=DB_READER_THREADS):
+        self.path = path
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+    
+    def _connection(self, readonly):
+        # Одно соединение на поток: sqlite3 кэширует в нём подготовленные выражения
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path, check_same_thread=False, timeout=DB_BUSY_TIMEOUT,
+                cached_statements=DB_STATEMENT_CACHE
+            )
+            configure_connection(conn, readonly=readonly)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+    
+    def _run_read(self, fn, args, label, queued_at):
+        db_queue_wait.observe(time.perf_counter() - queued_at, pool='read')
+        with db_query_latency.time(pool='read', query=label):
+            return fn(self._connection(readonly=True), *args)
+    
+    def _run_write(self, fn, args, label, queued_at):
+        db_queue_wait.observe(time.perf_counter() - queued_at, pool='write')
+        conn = self._connection(readonly=False)
+        with db_query_latency.time(pool='write', query=label):
+            try:
+                result = fn(conn, *args)
+                conn.commit()
+                return result
+            except Exception:
+                conn.rollback()
+                raise
+    
+    async def _submit(self, executor, runner, fn, args, label):
+        # label — имя функции или SQL, по нему считаются метрики запросов
+        loop = asyncio.get_running_loop()
+        with span(f"db:{label}"):
+            return await loop.run_in_executor(executor, runner, fn, args, label, time.perf_counter())
+    
+    async def read(self, fn, *args):
+        """Выполняет fn(conn, *args) в пуле читателей"""
+        return await self._submit(self._readers, self._run_read, fn, args, getattr(fn, '__name__', 'query'))
+    
+    async def write(self, fn, *args):
+        """Выполняет fn(conn, *args) в потоке-писателе одной транзакцией"""
+        return await self._submit(self._writer, self._run_write, fn, args, getattr(fn, '__name__', 'query'))
+    
+    async def fetchone(self, sql, params=()):
+        return await self._submit(
+            self._readers, self._run_read, lambda conn: conn.execute(sql, params).fetchone(), (), query_label(sql)
+        )
+    
+    async def fetchall(self, sql, params=()):
+        return await self._submit(
+            self._readers, self._run_read, lambda conn: conn.execute(sql, params).fetchall(), (), query_label(sql)
+        )
+    
+    async def execute(self, sql, params=()):
+        """Одиночная запись; возвращает количество изменённых строк"""
+        return await self._submit(
+            self._writer, self._run_write, lambda conn: conn.execute(sql, params).rowcount, (), query_label(sql)
+        )
+    
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+db = Database(DB_PATH)
+
+# Функции работы с базой данных
+# Активность пользователей копится в памяти и пишется в базу пачкой:
+# одна транзакция на USER_FLUSH_INTERVAL секунд вместо коммита на каждый клик
+class UserActivityBuffer:
+    """Буфер upsert'ов пользователей, схлопнутый по user_id"""
+    
+    def __init__(self):
+        self._pending = {}  # user_id -> (username, first_name, last_activity)
+        self.flushed = 0
+    
+    def __len__(self):
+        return len(self._pending)
+    
+    def record(self, user_id, username, first_name):
+        self._pending[user_id] = (username, first_name, datetime.now())
+    
+    async def flush(self):
+        if not self._pending:
+            return 0
+        batch, self._pending = self._pending, {}
+        rows = [
+            (user_id, username, first_name, seen_at, seen_at)
+            for user_id, (username, first_name, seen_at) in batch.items()
+        ]
+        try:
+            await db.write(_upsert_users, rows)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения пользователей: {e}")
+            # Возвращаем пачку в буфер, не затирая более свежие записи
+            for user_id, entry in batch.items():
+                self._pending.setdefault(user_id, entry)
+            return 0
+        self.flushed += len(rows)
+        return len(rows)
+
+def _upsert_users(conn, rows):
+    # joined_at пишется только при первой вставке, дальше обновляется активность;
+    # написавший боту пользователь снова доступен для рассылок
+    new_users = conn.executemany('''
+        INSERT OR IGNORE INTO users (user_id, username, first_name, joined_at, last_activity)
+        VALUES (?, ?, ?, ?, ?)
+    ''', rows).rowcount
+    reachable_again = conn.executemany(
+        'UPDATE users SET is_reachable = 1 WHERE user_id = ? AND is_reachable = 0',
+        [(row[0],) for row in rows]
+    ).rowcount
+    conn.executemany(
+        'UPDATE users SET username = ?, first_name = ?, last_activity = ? WHERE user_id = ?',
+        [(username, first_name, last_activity, user_id) for user_id, username, first_name, _, last_activity in rows]
+    )
+    bump_counters(conn, users_total=new_users, users_reachable=new_users + reachable_again)
+
+user_activity = UserActivityBuffer()
 
 def save_user(user_id, username, first_name):
-    conn = get_db_connection()
+    user_activity.record(user_id, username, first_name)
+
+# Периодическая запись накопленной активности пользователей
+async def flush_user_activity(context: ContextTypes.DEFAULT_TYPE):
+    await user_activity.flush()
+
+# Баны хранятся в памяти: таблица banned_users читается один раз при старте,
+# дальше множество обновляется командами /ban и /unban
+class BanCache:
+    """Множество забаненных user_id с O(1) проверкой без обращения к базе"""
+    
+    def __init__(self):
+        self._ids = set()
+        self.checks = 0
+        self.hits = 0
+        self.drift_events = 0
+        self.loaded_at = None
+        self.version = 0  # растёт при каждом /ban и /unban
+    
+    def __len__(self):
+        return len(self._ids)
+    
+    @property
+    def hit_rate(self):
+        return self.hits / self.checks if self.checks else 0.0
+    
+    async def load(self):
+        rows = await db.fetchall('SELECT user_id FROM banned_users')
+        self._ids = {row[0] for row in rows}
+        self.loaded_at = datetime.now()
+        logger.info(f"🚫 Загружено банов: {len(self._ids)}")
+    
+    def is_banned(self, user_id):
+        self.checks += 1
+        if user_id in self._ids:
+            self.hits += 1
+            return True
+        return False
+    
+    def add(self, user_id):
+        self._ids.add(user_id)
+        self.version += 1
+    
+    def discard(self, user_id):
+        self._ids.discard(user_id)
+        self.version += 1
+    
+    async def verify(self):
+        """Сверяет множество с таблицей; при расхождении восстанавливает его из базы"""
+        version = self.version
+        rows = await db.fetchall('SELECT user_id FROM banned_users')
+        # Пока шло чтение, /ban или /unban мог изменить и таблицу, и множество:
+        # снимок таблицы уже устарел, сверка переносится на следующий проход
+        if self.version != version:
+            logger.info("🚫 Баны менялись во время сверки, сверка пропущена")
+            return set(), set()
+        table_ids = {row[0] for row in rows}
+        missing = table_ids - self._ids
+        extra = self._ids - table_ids
+        if missing or extra:
+            self.drift_events += 1
+            logger.warning(f"⚠️ Кэш банов расходится с базой: нет в памяти {len(missing)}, лишних {len(extra)}")
+            self._ids = table_ids
+        return missing, extra
+
+ban_cache = BanCache()
+
+def is_user_banned(user_id):
+    return ban_cache.is_banned(user_id)
+
+async def verify_ban_cache(context: ContextTypes.DEFAULT_TYPE):
     try:
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO users (user_id, username, first_name, joined_at, last_activity)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, username, first_name, datetime.now(), datetime.now()))
-        conn.commit()
+        await ban_cache.verify()
     except Exception as e:
-        logger.error(f"Ошибка сохранения пользователя: {e}")
-    finally:
-        conn.close()
+        logger.error(f"Ошибка сверки банов: {e}")
 
-def is_user_banned(user_id):
-    conn = get_db_connection()
+def _update_product_stock(conn, product_id, change_amount):
+    row = conn.execute('SELECT stock, is_active FROM products WHERE id = ?', (product_id,)).fetchone()
+    if row is None:
+        return None
+    old_stock, is_active = row
+    # Изменение относительное, поэтому уже зарезервированный товар оно не задевает.
+    # Списание больше остатка обнуляет остаток (MAX), а не уводит его в минус
+    new_stock = max(old_stock + change_amount, 0)
+    conn.execute('UPDATE products SET stock = ? WHERE id = ?', (new_stock, product_id))
+    if is_active:
+        bump_counters(conn, total_stock=new_stock - old_stock)
+    return new_stock
+
+async def update_product_stock(product_id, change_amount):
+    """Обновляет количество товара с проверкой на отрицательное значение"""
     try:
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id FROM banned_users WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        return result is not None
+        new_stock = await db.write(_update_product_stock, product_id, change_amount)
     except Exception as e:
-        logger.error(f"Ошибка проверки бана: {e}")
+        logger.error(f"Ошибка обновления остатка: {e}")
+        return None
+    await reload_catalog()
+    return new_stock
+
+# === РЕЗЕРВИРОВАНИЕ ТОВАРА ===
+# Товар списывается со склада условным UPDATE в момент создания заказа и числится
+# в stock_reservations: при оплате резерв подтверждается, при отмене или истечении
+# заказа (или TTL самого резерва) остаток возвращается на склад
+
+def _reserve_stock(conn, invoice_id, product_id, quantity, created_at, expires_at):
+    cursor = conn.execute('''
+        UPDATE products SET stock = stock - ?
+        WHERE id = ? AND is_active = 1 AND stock >= ?
+    ''', (quantity, product_id, quantity))
+    if cursor.rowcount == 0:
         return False
-    finally:
-        conn.close()
+    bump_counters(conn, total_stock=-quantity)
+    conn.execute('''
+        INSERT INTO stock_reservations (invoice_id, product_id, quantity, status, created_at, expires_at)
+        VALUES (?, ?, ?, 'active', ?, ?)
+    ''', (invoice_id, product_id, quantity, created_at, expires_at))
+    return True
 
-def get_product_info(product_id):
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
+def _release_reservations(cursor, invoice_ids):
+    """Возвращает на склад активные резервы заказов; без commit"""
+    released = 0
+    for invoice_id in invoice_ids:
         cursor.execute('''
-            SELECT p.id, p.name, p.price, p.description, p.stock, p.product_type, c.name as category_name
-            FROM products p
-            JOIN categories c ON p.category_id = c.id
-            WHERE p.id = ? AND p.is_active = 1
-        ''', (product_id,))
-        result = cursor.fetchone()
-        return result
+            SELECT product_id, quantity FROM stock_reservations
+            WHERE invoice_id = ? AND status = 'active'
+        ''', (invoice_id,))
+        reservation = cursor.fetchone()
+        if reservation is None:
+            continue
+        product_id, quantity = reservation
+        cursor.execute('''
+            UPDATE stock_reservations SET status = 'released' WHERE invoice_id = ? AND status = 'active'
+        ''', (invoice_id,))
+        # Счётчик total_stock учитывает только активные товары; удалённый товар
+        # не обновится ни одним запросом, и счётчик не изменится
+        cursor.execute('UPDATE products SET stock = stock + ? WHERE id = ? AND is_active = 1', (quantity, product_id))
+        bump_counters(cursor, total_stock=quantity * cursor.rowcount)
+        cursor.execute('UPDATE products SET stock = stock + ? WHERE id = ? AND is_active = 0', (quantity, product_id))
+        released += 1
+    return released
+
+def _commit_reservation(cursor, invoice_id):
+    cursor.execute('''
+        UPDATE stock_reservations SET status = 'committed' WHERE invoice_id = ? AND status = 'active'
+    ''', (invoice_id,))
+    return cursor.rowcount > 0
+
+def _release_expired_reservations(conn, now):
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT invoice_id FROM stock_reservations WHERE status = 'active' AND expires_at < ?
+    ''', (now,))
+    return _release_reservations(cursor, [row[0] for row in cursor.fetchall()])
+
+def make_invoice_id(product_id, user_id, created_at):
+    # Время с точностью до секунды не уникально: повторная покупка в ту же секунду
+    # упиралась бы в UNIQUE, поэтому добавляется случайный суффикс
+    return f"INV_{product_id}_{user_id}_{created_at.strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+
+async def reserve_stock(invoice_id, product_id, quantity=1):
+    """Резервирует товар под заказ; False, если на складе не хватает, None при ошибке базы"""
+    created_at = datetime.now()
+    expires_at = created_at + timedelta(seconds=RESERVATION_TTL)
+    try:
+        reserved = await db.write(_reserve_stock, invoice_id, product_id, quantity, created_at, expires_at)
     except Exception as e:
-        logger.error(f"Ошибка получения информации о товаре: {e}")
+        logger.error(f"Ошибка резервирования товара {product_id}: {e}")
         return None
-    finally:
-        conn.close()
+    if reserved:
+        await reload_catalog()
+    return reserved
 
-def update_product_stock(product_id, change_amount):
-    """Обновляет количество товара с проверкой на отрицательное значение"""
-    conn = get_db_connection()
+async def release_reservation(invoice_id):
     try:
-        cursor = conn.cursor()
-        # Получаем текущее количество
-        cursor.execute('SELECT stock FROM products WHERE id = ?', (product_id,))
-        result = cursor.fetchone()
-        
-        if not result:
-            return None
-            
-        current_stock = result[0]
-        
-        new_stock = current_stock + change_amount
-        if new_stock < 0:
-            new_stock = 0
-            
-        cursor.execute('UPDATE products SET stock = ? WHERE id = ?', (new_stock, product_id))
-        conn.commit()
-        return new_stock
+        released = await db.write(lambda conn: _release_reservations(conn.cursor(), [invoice_id]))
     except Exception as e:
-        logger.error(f"Ошибка обновления остатка: {e}")
-        return None
-    finally:
-        conn.close()
+        logger.error(f"Ошибка снятия резерва {invoice_id}: {e}")
+        return
+    if released:
+        await reload_catalog()
 
-def get_all_categories():
-    conn = get_db_connection()
+# Резервы без заказа (сбой между резервированием и созданием счёта) снимаются по TTL
+async def release_expired_reservations(context: ContextTypes.DEFAULT_TYPE):
     try:
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, name, description FROM categories ORDER BY id')
-        categories = cursor.fetchall()
-        return categories
+        released = await db.write(_release_expired_reservations, datetime.now())
     except Exception as e:
-        logger.error(f"Ошибка получения категорий: {e}")
-        return []
-    finally:
-        conn.close()
+        logger.error(f"Ошибка снятия просроченных резервов: {e}")
+        return
+    if released:
+        logger.info(f"📦 Снято просроченных резервов: {released}")
+        await reload_catalog()
 
-def get_products_by_category(category_id):
-    conn = get_db_connection()
+async def get_all_categories():
     try:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, name, price, description, stock, product_type 
-            FROM products 
-            WHERE category_id = ? AND is_active = 1
-            ORDER BY id
-        ''', (category_id,))
-        products = cursor.fetchall()
-        return products
+        return await db.fetchall('SELECT id, name, description FROM categories ORDER BY id')
     except Exception as e:
-        logger.error(f"Ошибка получения товаров категории: {e}")
+        logger.error(f"Ошибка получения категорий: {e}")
         return []
-    finally:
-        conn.close()
 
-# НОВЫЕ ФУНКЦИИ ДЛЯ КОЭФФИЦИЕНТОВ
-def get_coefficient(coeff_type):
-    """Получает коэффициент из базы данных"""
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute('SELECT value FROM coefficients WHERE coefficient_type = ?', (coeff_type,))
-        result = cursor.fetchone()
+# === КАТАЛОГ В ПАМЯТИ ===
+# Каталог меняется только из админки и при списании товара, поэтому покупатели
+# листают готовый снимок; любое изменение собирает новый снимок и подменяет его целиком
+
+# Категории, которые показываются покупателям (без эмодзи в названиях)
+CATALOG_CATEGORIES = ['Telegram Stars/Premium', 'Пополнение Steam', 'Прокси', 'Подписки', 'Физы']
+
+class CatalogSnapshot:
+    """Неизменяемый снимок каталога с заранее собранными текстами и клавиатурами"""
+    
+    def __init__(self, version, categories, products):
+        self.version = version
+        self.loaded_at = datetime.now()
+        
+        category_names = {cat_id: name for cat_id, name, description in categories}
+        products_by_category = {}
+        products_by_id = {}
+        for product_id, category_id, name, price, description, stock, product_type in products:
+            if category_id not in category_names:
+                continue
+            products_by_category.setdefault(category_id, []).append(
+                (product_id, name, price, description, stock, product_type)
+            )
+            products_by_id[product_id] = (
+                product_id, name, price, description, stock, product_type, category_names[category_id]
+            )
         
-        if result:
-            return result[0]
+        self.products = products_by_id
+        self.categories_view = self._build_categories_view(categories)
+        self.category_names = category_names
+        # Товары категории отсортированы по id: страница ищется бисекцией по курсору
+        self.category_products = products_by_category
+        self.category_ids = {
+            cat_id: [product[0] for product in items]
+            for cat_id, items in products_by_category.items()
+        }
+        self.category_buyable = {
+            cat_id: any(self._is_buyable(product) for product in items)
+            for cat_id, items in products_by_category.items()
+        }
+    
+    @staticmethod
+    def _build_categories_view(categories):
+        keyboard = [
+            [InlineKeyboardButton(f"{name}", callback_data=f"cat_{cat_id}")]
+            for cat_id, name, description in categories
+            if name in CATALOG_CATEGORIES
+        ]
+        if not keyboard:
+            return None
+        return "*Выберите категорию:*\n\n", InlineKeyboardMarkup(keyboard)
+    
+    @staticmethod
+    def _is_buyable(product):
+        product_id, name, price, description, stock, product_type = product
+        return product_type != 'fixed' or stock > 0
+    
+    def category_page(self, category_id, direction='next', cursor=0):
+        """Страница категории после (или перед) товаром с id = cursor"""
+        category_name = self.category_names.get(category_id)
+        if category_name is None:
+            return None
+        
+        products = self.category_products.get(category_id, [])
+        if not products:
+            return f"📦 В категории '{category_name}' пока нет товаров", None
+        if not self.category_buyable[category_id]:
+            return f"📭 В категории '{category_name}' все товары временно отсутствуют", InlineKeyboardMarkup(
+                [[InlineKeyboardButton("⬅️ Назад к категориям", callback_data="back_to_categories")]]
+            )
+        
+        ids = self.category_ids[category_id]
+        if direction == 'prev':
+            end = bisect_left(ids, cursor)
+            start = max(end - CATEGORY_PAGE_SIZE, 0)
+            # Дошли до начала (в том числе по курсору, устаревшему после удаления
+            # или скрытия товаров) — показываем полную первую страницу
+            if start == 0:
+                end = CATEGORY_PAGE_SIZE
         else:
-            # Возвращаем значение по умолчанию если нет в базе
-            defaults = {
-                'stars': DEFAULT_STARS_COEFFICIENT,
-                'steam': DEFAULT_STEAM_COEFFICIENT,
-                'exchange_rate': DEFAULT_EXCHANGE_RATE
-            }
-            return defaults.get(coeff_type, 1.0)
+            start = bisect_right(ids, cursor)
+            end = start + CATEGORY_PAGE_SIZE
+        # Курсор мог указывать за пределы списка после перезагрузки каталога
+        if start >= len(ids):
+            start = (len(ids) - 1) // CATEGORY_PAGE_SIZE * CATEGORY_PAGE_SIZE
+            end = len(ids)
+        
+        return self._build_category_page(
+            category_id, category_name, products[start:end], start, len(products)
+        )
+    
+    @staticmethod
+    def _build_category_page(category_id, category_name, products, start, total):
+        # Страница «назад» может начинаться не с кратного CATEGORY_PAGE_SIZE места:
+        # номер и число страниц считаются от фактического начала среза
+        pages_before = (start + CATEGORY_PAGE_SIZE - 1) // CATEGORY_PAGE_SIZE
+        pages = pages_before + (total - start + CATEGORY_PAGE_SIZE - 1) // CATEGORY_PAGE_SIZE
+        text = f"*Товары в категории: {category_name}*\n"
+        if pages > 1:
+            text += f"Страница {pages_before + 1}/{pages}\n"
+        text += "\n"
+        keyboard = []
+        
+        for product_id, name, price, description, stock, product_type in products:
+            if product_type == 'fixed':
+                stock_emoji = "🟢" if stock > 0 else "🔴"
+                status = f"{stock} шт." if stock > 0 else "Нет в наличии"
+                text += f"• *{name}* - {price}$ {stock_emoji} ({status})\n"
+                if stock > 0:
+                    keyboard.append([InlineKeyboardButton(
+                        f"{name} - {price}$", 
+                        callback_data=f"buy_{product_id}"
+                    )])
+            elif product_type == 'stars':
+                keyboard.append([InlineKeyboardButton(
+                    f"{name} (от 50)", 
+                    callback_data=f"buy_{product_id}"
+                )])
+            elif product_type == 'steam':
+                keyboard.append([InlineKeyboardButton(
+                    f"{name} (от 100₽)", 
+                    callback_data=f"buy_{product_id}"
+                )])
+        
+        navigation = []
+        if products and start > 0:
+            navigation.append(InlineKeyboardButton("⬅️", callback_data=f"catpage_prev_{category_id}_{products[0][0]}"))
+        if products and start + len(products) < total:
+            navigation.append(InlineKeyboardButton("➡️", callback_data=f"catpage_next_{category_id}_{products[-1][0]}"))
+        if navigation:
+            keyboard.append(navigation)
+        
+        keyboard.append([InlineKeyboardButton("⬅️ Назад к категориям", callback_data="back_to_categories")])
+        return text, InlineKeyboardMarkup(keyboard)
+
+def _load_catalog_rows(conn):
+    categories = conn.execute('SELECT id, name, description FROM categories ORDER BY id').fetchall()
+    products = conn.execute('''
+        SELECT id, category_id, name, price, description, stock, product_type
+        FROM products
+        WHERE is_active = 1
+        ORDER BY id
+    ''').fetchall()
+    return categories, products
+
+class CatalogStore:
+    """Хранит текущий снимок каталога и пересобирает его после изменений"""
+    
+    def __init__(self):
+        self.snapshot = CatalogSnapshot(0, [], [])
+        self._lock = asyncio.Lock()
+    
+    async def reload(self):
+        # Перезагрузки идут по очереди, чтобы старый снимок не затёр более новый
+        async with self._lock:
+            categories, products = await db.read(_load_catalog_rows)
+            self.snapshot = CatalogSnapshot(self.snapshot.version + 1, categories, products)
+        return self.snapshot
+
+catalog = CatalogStore()
+
+async def reload_catalog():
+    try:
+        await catalog.reload()
     except Exception as e:
-        logger.error(f"Ошибка получения коэффициента {coeff_type}: {e}")
-        return 1.0
-    finally:
-        conn.close()
+        logger.error(f"Ошибка обновления каталога: {e}")
+
+def get_product_info(product_id):
+    return catalog.snapshot.products.get(product_id)
+
+# === ЦЕНООБРАЗОВАНИЕ ===
+# Коэффициенты держим в памяти; каждое изменение пишется в coefficient_history,
+# id этой записи служит версией цен и сохраняется в заказе для аудита
+
+DEFAULT_COEFFICIENTS = {
+    'stars': DEFAULT_STARS_COEFFICIENT,
+    'steam': DEFAULT_STEAM_COEFFICIENT,
+    'exchange_rate': DEFAULT_EXCHANGE_RATE
+}
+
+def calculate_quote(product_type, amount, coefficients):
+    """Считает цену заказа Stars/Steam по переданным коэффициентам"""
+    coeff = coefficients.get(product_type, 1.0)
+    exchange_rate = coefficients.get('exchange_rate', DEFAULT_EXCHANGE_RATE)
+    # Формула: количество (или сумма в рублях) * коэффициент / курс
+    price_amount = round((amount * coeff) / exchange_rate, 2)
+    price_with_fee = round(price_amount * (1 + CRYPTOBOT_FEE), 2)
+    return {
+        'amount': amount,
+        'coefficient': coeff,
+        'exchange_rate': exchange_rate,
+        'price_amount': price_amount,
+        'price_with_fee': price_with_fee
+    }
+
+def _load_pricing(conn):
+    rows = conn.execute('SELECT coefficient_type, value, description FROM coefficients').fetchall()
+    version = conn.execute('SELECT COALESCE(MAX(id), 0) FROM coefficient_history').fetchone()[0]
+    return rows, version
+
+def _save_coefficient(conn, coeff_type, old_value, value, changed_at):
+    conn.execute('''
+        INSERT INTO coefficients (coefficient_type, value, updated_at)
+        VALUES (?, ?, ?)
+        ON CONFLICT(coefficient_type) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+    ''', (coeff_type, value, changed_at))
+    cursor = conn.execute('''
+        INSERT INTO coefficient_history (coefficient_type, old_value, new_value, changed_at)
+        VALUES (?, ?, ?, ?)
+    ''', (coeff_type, old_value, value, changed_at))
+    return cursor.lastrowid
+
+class PricingService:
+    """Коэффициенты в памяти с номером версии"""
+    
+    def __init__(self):
+        # (версия, {тип: значение}, {тип: описание}) подменяется целиком
+        self._state = (0, dict(DEFAULT_COEFFICIENTS), {})
+    
+    @property
+    def version(self):
+        return self._state[0]
+    
+    def load(self):
+        """Читает коэффициенты при старте (до запуска цикла событий)"""
+        conn = get_db_connection()
+        try:
+            rows, version = _load_pricing(conn)
+        finally:
+            conn.close()
+        values = dict(DEFAULT_COEFFICIENTS)
+        descriptions = {}
+        for coeff_type, value, description in rows:
+            values[coeff_type] = value
+            descriptions[coeff_type] = description
+        self._state = (version, values, descriptions)
+    
+    def get(self, coeff_type):
+        return self._state[1].get(coeff_type, 1.0)
+    
+    def all(self):
+        version, values, descriptions = self._state
+        return {
+            coeff_type: {'value': value, 'description': descriptions.get(coeff_type)}
+            for coeff_type, value in values.items()
+        }
+    
+    def quote(self, product_type, amount):
+        version, values, descriptions = self._state
+        quote = calculate_quote(product_type, amount, values)
+        quote['pricing_version'] = version
+        return quote
+    
+    async def update(self, coeff_type, value):
+        old_value = self.get(coeff_type)
+        version = await db.write(_save_coefficient, coeff_type, old_value, value, datetime.now())
+        _, values, descriptions = self._state
+        self._state = (version, {**values, coeff_type: value}, descriptions)
+        return version
+
+pricing = PricingService()
+
+def get_coefficient(coeff_type):
+    """Текущее значение коэффициента"""
+    return pricing.get(coeff_type)
 
-def update_coefficient(coeff_type, value):
-    """Обновляет коэффициент в базе данных"""
-    conn = get_db_connection()
+async def update_coefficient(coeff_type, value):
+    """Обновляет коэффициент в базе и в памяти"""
     try:
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO coefficients (coefficient_type, value, updated_at)
-            VALUES (?, ?, ?)
-        ''', (coeff_type, value, datetime.now()))
-        conn.commit()
+        await pricing.update(coeff_type, value)
         return True
     except Exception as e:
         logger.error(f"Ошибка обновления коэффициента {coeff_type}: {e}")
         return False
-    finally:
-        conn.close()
 
 def get_all_coefficients():
     """Получает все коэффициенты"""
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute('SELECT coefficient_type, value, description FROM coefficients')
-        coefficients = cursor.fetchall()
-        
-        # Создаем словарь для удобного доступа
-        coeff_dict = {}
-        for coeff_type, value, description in coefficients:
-            coeff_dict[coeff_type] = {
-                'value': value,
-                'description': description
-            }
-        return coeff_dict
-    except Exception as e:
-        logger.error(f"Ошибка получения коэффициентов: {e}")
-        return {}
-    finally:
-        conn.close()
+    return pricing.all()
 
 # Проверка подписки
-async def check_subscription(application, user_id):
-    try:
+class SubscriptionCache:
+    """LRU-кэш результатов get_chat_member с отдельными TTL для подписчиков и остальных"""
+    
+    def __init__(self, positive_ttl, negative_ttl, max_size):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # user_id -> (подписан, истекает_в)
+        self._channel_available = True
+        self._channel_checked_until = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            is_subscribed, expires_at = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return is_subscribed
+            del self._entries[user_id]
+        self.misses += 1
+        return None
+    
+    def set(self, user_id, is_subscribed):
+        ttl = self.positive_ttl if is_subscribed else self.negative_ttl
+        self._entries[user_id] = (is_subscribed, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def invalidate(self, user_id=None):
+        """Сбрасывает запись пользователя (или весь кэш, если user_id не указан)"""
+        if user_id is None:
+            self._entries.clear()
+            self._channel_checked_until = 0
+        else:
+            self._entries.pop(user_id, None)
+    
+    async def channel_available(self, application):
+        # Канал не меняется: после успешного get_chat больше его не запрашиваем,
+        # после ошибки повторяем не чаще чем раз в negative_ttl
+        if self._channel_checked_until > time.monotonic():
+            return self._channel_available
         try:
-            chat = await application.bot.get_chat(CHANNEL_USERNAME)
+            await application.bot.get_chat(CHANNEL_USERNAME)
+            self._channel_available = True
+            self._channel_checked_until = float('inf')
         except Exception as e:
             logger.error(f"Канал {CHANNEL_USERNAME} не найден: {e}")
+            self._channel_available = False
+            self._channel_checked_until = time.monotonic() + self.negative_ttl
+        return self._channel_available
+
+subscription_cache = SubscriptionCache(
+    SUBSCRIPTION_CACHE_POSITIVE_TTL, SUBSCRIPTION_CACHE_NEGATIVE_TTL, SUBSCRIPTION_CACHE_MAX_SIZE
+)
+
+async def check_subscription(application, user_id):
+    cached = subscription_cache.get(user_id)
+    if cached is not None:
+        return cached
+    
+    try:
+        if not await subscription_cache.channel_available(application):
             return True
         
         chat_member = await application.bot.get_chat_member(
             chat_id=CHANNEL_USERNAME,
             user_id=user_id
         )
-        return chat_member.status in ['member', 'administrator', 'creator']
+        is_subscribed = chat_member.status in ['member', 'administrator', 'creator']
+        subscription_cache.set(user_id, is_subscribed)
+        return is_subscribed
     except Exception as e:
         logger.error(f"Ошибка проверки подписки: {e}")
         return True
 
-# CryptoBot API
+# Обновления участников канала (приходят, если бот — администратор канала)
+async def handle_channel_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    member_update = update.chat_member
+    if member_update.chat.username and f"@{member_update.chat.username}".lower() == CHANNEL_USERNAME.lower():
+        subscription_cache.invalidate(member_update.new_chat_member.user.id)
+
+# CryptoBot API (асинхронный клиент с пулом keep-alive соединений)
 class CryptoBotAPI:
     def __init__(self, api_token):
         self.api_token = api_token
@@ -408,10 +1705,45 @@ class CryptoBotAPI:
             'Crypto-Pay-API-Token': self.api_token,
             'Content-Type': 'application/json'
         }
+        self._client = None
     
-    def create_invoice(self, amount, description, expires_in=900):
-        url = f"{self.base_url}createInvoice"
-        
+    def _get_client(self):
+        """Возвращает общий httpx-клиент, создавая его при первом обращении"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=self.headers,
+                timeout=httpx.Timeout(CRYPTOBOT_DEFAULT_TIMEOUT, connect=CRYPTOBOT_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=CRYPTOBOT_MAX_CONNECTIONS,
+                    max_keepalive_connections=CRYPTOBOT_MAX_KEEPALIVE,
+                    keepalive_expiry=CRYPTOBOT_KEEPALIVE_EXPIRY
+                )
+            )
+        return self._client
+    
+    async def close(self):
+        """Закрывает пул соединений (вызывается при остановке бота)"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def _request(self, http_method, api_method, **kwargs):
+        """HTTP-запрос к API с замером времени и подсчётом ошибок"""
+        started = time.perf_counter()
+        try:
+            with span(f"cryptobot:{api_method}"):
+                response = await self._get_client().request(http_method, api_method, **kwargs)
+        except Exception as e:
+            cryptobot_errors.inc(method=api_method, reason=type(e).__name__)
+            raise
+        finally:
+            cryptobot_latency.observe(time.perf_counter() - started, method=api_method)
+        if response.status_code != 200:
+            cryptobot_errors.inc(method=api_method, reason=f"http_{response.status_code}")
+        return response
+    
+    async def create_invoice(self, amount, description, expires_in=ORDER_TIMEOUT):
         # Добавляем комиссию CryptoBot 3% к сумме
         amount_with_fee = round(amount * (1 + CRYPTOBOT_FEE), 2)
         
@@ -428,7 +1760,9 @@ class CryptoBotAPI:
         
         try:
             logger.info(f"Создание инвойса: {amount} USDT + комиссия {CRYPTOBOT_FEE*100}% = {amount_with_fee} USDT - {description}")
-            response = requests.post(url, json=payload, headers=self.headers, timeout=30)
+            response = await self._request(
+                "POST", "createInvoice", json=payload, timeout=CRYPTOBOT_CREATE_TIMEOUT
+            )
             
             if response.status_code != 200:
                 logger.error(f"HTTP Error {response.status_code}: {response.text}")
@@ -445,6 +1779,7 @@ class CryptoBotAPI:
                 return result['result']
             else:
                 error_msg = result.get('error', {}).get('name', 'Unknown error')
+                cryptobot_errors.inc(method="createInvoice", reason=error_msg)
                 logger.error(f"❌ CryptoBot API error: {error_msg}")
                 return None
                 
@@ -452,13 +1787,14 @@ class CryptoBotAPI:
             logger.error(f"❌ Ошибка создания инвойса: {e}")
             return None
 
-    def check_invoice_status(self, invoice_id):
+    async def check_invoice_status(self, invoice_id):
         try:
-            url = f"{self.base_url}getInvoices"
             params = {"invoice_ids": invoice_id}
             
             logger.info(f"Проверка статуса инвойса: {invoice_id}")
-            response = requests.get(url, params=params, headers=self.headers, timeout=10)
+            response = await self._request(
+                "GET", "getInvoices", params=params, timeout=CRYPTOBOT_CHECK_TIMEOUT
+            )
             result = response.json()
             
             if result.get('ok') and result['result']['items']:
@@ -469,9 +1805,330 @@ class CryptoBotAPI:
         except Exception as e:
             logger.error(f"❌ Ошибка проверки статуса: {e}")
             return None
+    
+    async def get_invoices(self, invoice_ids):
+        """Статусы нескольких инвойсов одним запросом: {invoice_id: status}"""
+        try:
+            params = {
+                "invoice_ids": ",".join(str(invoice_id) for invoice_id in invoice_ids),
+                "count": len(invoice_ids)
+            }
+            response = await self._request(
+                "GET", "getInvoices", params=params, timeout=CRYPTOBOT_CHECK_TIMEOUT
+            )
+            result = response.json()
+            
+            if not result.get('ok'):
+                error_msg = result.get('error', {}).get('name', 'Unknown error')
+                cryptobot_errors.inc(method="getInvoices", reason=error_msg)
+                logger.error(f"❌ CryptoBot API error: {error_msg}")
+                return None
+            
+            return {str(item['invoice_id']): item.get('status') for item in result['result']['items']}
+        except Exception as e:
+            logger.error(f"❌ Ошибка пакетной проверки инвойсов: {e}")
+            return None
 
 cryptobot = CryptoBotAPI(CRYPTOBOT_API_TOKEN)
 
+# === ВСТРОЕННЫЙ HTTP-СЕРВЕР (вебхуки) ===
+
+class HTTPRequest:
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+class LocalHTTPServer:
+    """Минимальный HTTP/1.1 сервер на asyncio для служебных эндпоинтов"""
+    
+    MAX_BODY_SIZE = 64 * 1024
+    READ_TIMEOUT = 10
+    
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self._server = None
+    
+    def add_route(self, path, handler):
+        # handler(request) -> (status, content_type, body: bytes)
+        self.routes[path] = handler
+    
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        sockets = self._server.sockets or []
+        if sockets:
+            # При port=0 система выбирает свободный порт
+            self.port = sockets[0].getsockname()[1]
+        logger.info(f"🌐 HTTP-сервер слушает {self.host}:{self.port}")
+    
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+    
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        
+        length = int(headers.get('content-length') or 0)
+        if length > self.MAX_BODY_SIZE:
+            raise ValueError("Слишком большое тело запроса")
+        body = await reader.readexactly(length) if length else b''
+        
+        url = urlsplit(target)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        return HTTPRequest(method.upper(), url.path, query, headers, body)
+    
+    async def _handle_connection(self, reader, writer):
+        status, content_type, body = 500, 'text/plain', b'error'
+        try:
+            request = await asyncio.wait_for(self._read_request(reader), self.READ_TIMEOUT)
+            if request is None:
+                return
+            handler = self.routes.get(request.path)
+            if handler is None:
+                status, content_type, body = 404, 'text/plain', b'not found'
+            else:
+                status, content_type, body = await handler(request)
+        except Exception as e:
+            logger.error(f"Ошибка обработки HTTP-запроса: {e}")
+            status, content_type, body = 400, 'text/plain', b'bad request'
+        
+        try:
+            writer.write(
+                f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+def cryptobot_signature(api_token, body):
+    """Подпись вебхука CryptoBot: HMAC-SHA256(тело, ключ = SHA256(токена))"""
+    secret = hashlib.sha256(api_token.encode('utf-8')).digest()
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+def verify_cryptobot_signature(body, signature):
+    if not signature:
+        return False
+    expected = cryptobot_signature(CRYPTOBOT_API_TOKEN, body)
+    return hmac.compare_digest(expected, signature)
+
+webhook_server = None
+
+# === ЭКСПОРТ МЕТРИК ===
+
+def _handler_label(handler):
+    if isinstance(handler, CommandHandler):
+        return 'command', '/' + ','.join(sorted(handler.commands))
+    if isinstance(handler, CallbackQueryHandler):
+        return 'callback', getattr(handler.pattern, 'pattern', str(handler.pattern))
+    if isinstance(handler, ChatMemberHandler):
+        return 'chat_member', handler.callback.__name__
+    return 'message', handler.callback.__name__
+
+def _timed_callback(callback, kind, label):
+    async def timed(update, context):
+        started = time.perf_counter()
+        trace = profiler.start(label)
+        try:
+            return await callback(update, context)
+        except Exception:
+            handler_errors.inc(kind=kind, handler=label)
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            handler_latency.observe(duration, kind=kind, handler=label)
+            if trace is not None:
+                profiler.finish(trace, duration)
+    return timed
+
+def instrument_handlers(application):
+    """Оборачивает все зарегистрированные обработчики замером времени"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            kind, label = _handler_label(handler)
+            handler.callback = _timed_callback(handler.callback, kind, label)
+
+def _load_pending_order_stats(conn):
+    return conn.execute("SELECT COUNT(*), MIN(created_at) FROM orders WHERE status = 'pending'").fetchone()
+
+async def handle_metrics(request):
+    try:
+        count, oldest = await db.read(_load_pending_order_stats)
+        pending_orders_gauge.set(count)
+        age = (datetime.now() - datetime.fromisoformat(oldest)).total_seconds() if oldest else 0
+        oldest_pending_order_age.set(round(age, 3))
+    except Exception as e:
+        logger.error(f"Ошибка сбора метрик заказов: {e}")
+    return 200, 'text/plain; version=0.0.4; charset=utf-8', metrics.render().encode('utf-8')
+
+class LoopLagMonitor:
+    """Замеряет, насколько позже запланированного просыпается цикл событий"""
+    
+    def __init__(self, interval):
+        self.interval = interval
+        self._task = None
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(time.perf_counter() - started - self.interval, 0.0)
+            loop_lag.observe(lag)
+            loop_lag_last.set(round(lag, 6))
+
+loop_lag_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL)
+metrics_server = None
+
+# === ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ОБНОВЛЕНИЙ ===
+# Обновления разных пользователей обрабатываются одновременно (не больше UPDATE_WORKERS),
+# обновления одного пользователя — строго по очереди: обработчики читают и пишут
+# context.user_data (selected_product, price_amount), и два нажатия одного
+# пользователя не должны перемешаться. Application запускает задачи обновлений
+# в порядке поступления, а asyncio.Lock отдаёт блокировку ждущим в порядке очереди
+
+update_lock_contended = metrics.counter(
+    'shop_update_lock_contended_total', 'Обновления, ждавшие предыдущее обновление того же пользователя'
+)
+update_lock_wait = metrics.histogram(
+    'shop_update_lock_wait_seconds', 'Ожидание очереди пользователя перед обработкой'
+)
+update_worker_wait = metrics.histogram(
+    'shop_update_worker_wait_seconds', 'Ожидание свободного обработчика'
+)
+updates_dropped = metrics.counter(
+    'shop_updates_dropped_total', 'Обновления, отброшенные из-за переполненной очереди пользователя'
+)
+
+class UserLock:
+    __slots__ = ('lock', 'holders')
+    
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.holders = 0  # обновления в работе и в очереди; при 0 запись удаляется
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка с очередью на каждого пользователя"""
+    
+    def __init__(self, workers, max_pending, user_max_pending):
+        # Семафор базового класса ограничивает обновления вместе с ждущими своей очереди,
+        # собственный — одновременно работающие обработчики. Семафор базового класса
+        # берётся раньше очереди пользователя (process_update помечен @final), поэтому
+        # очередь одного пользователя ограничена user_max_pending: иначе флудящий
+        # пользователь занял бы все места и остальные ждали бы его
+        super().__init__(max_pending)
+        self.workers = workers
+        self.user_max_pending = user_max_pending
+        self._workers = asyncio.Semaphore(workers)
+        self._locks = {}  # user_id -> UserLock
+        self.in_progress = 0
+    
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+    
+    async def do_process_update(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+        
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = UserLock()
+        elif entry.holders >= self.user_max_pending:
+            await self._drop(key, update, coroutine)
+            return
+        entry.holders += 1
+        try:
+            if entry.lock.locked():
+                update_lock_contended.inc()
+                with update_lock_wait.time():
+                    await entry.lock.acquire()
+            else:
+                await entry.lock.acquire()
+            try:
+                await self._run(coroutine)
+            finally:
+                entry.lock.release()
+        finally:
+            entry.holders -= 1
+            if not entry.holders:
+                del self._locks[key]
+    
+    @staticmethod
+    async def _drop(key, update, coroutine):
+        updates_dropped.inc()
+        coroutine.close()
+        kind = next((kind.value for kind in Update.ALL_TYPES if getattr(update, kind.value, None)), 'unknown')
+        logger.debug(f"Очередь пользователя {key} переполнена, обновление {kind} отброшено")
+        # Без ответа на нажатие клиент крутил бы индикатор загрузки до таймаута Telegram
+        if update.callback_query:
+            try:
+                await update.callback_query.answer("⏳ Слишком много запросов, подождите пару секунд")
+            except Exception as e:
+                logger.error(f"Ошибка ответа на нажатие: {e}")
+    
+    async def _run(self, coroutine):
+        with update_worker_wait.time():
+            await self._workers.acquire()
+        self.in_progress += 1
+        try:
+            await coroutine
+        finally:
+            self.in_progress -= 1
+            self._workers.release()
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+update_processor = PerUserUpdateProcessor(UPDATE_WORKERS, UPDATE_MAX_PENDING, UPDATE_USER_MAX_PENDING)
+metrics.gauge('shop_update_user_queues', 'Пользователей с обновлениями в работе или в очереди',
+              collect=lambda: len(update_processor._locks))
+metrics.gauge('shop_updates_in_progress', 'Обновлений в обработке сейчас',
+              collect=lambda: update_processor.in_progress)
+
 # Уведомление админу
 async def notify_admin(application, order_data, order_type="new"):
     try:
@@ -508,19 +2165,173 @@ async def notify_admin(application, order_data, order_type="new"):
     except Exception as e:
         logger.error(f"❌ Ошибка отправки уведомления админу: {e}")
 
+# === ФЛУД-КОНТРОЛЬ ===
+# Вёдра токенов на пользователя и общие на бота, отдельно для навигации и для
+# платёжных действий (покупка, проверка оплаты, подтверждение счёта — это запросы
+# к базе и CryptoBot). Ведро пользователя, к которому не обращались FLOOD_IDLE_TTL,
+# заведомо полное, поэтому его удаление ничего не меняет
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас"""
+    
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at', 'paused_until')
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+    
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    
+    def try_acquire(self, tokens=1):
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.paused_until or self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+    
+    async def acquire(self, tokens=1):
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+            elif self.tokens >= tokens:
+                self.tokens -= tokens
+                return
+            else:
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+    
+    def refund(self, tokens=1):
+        """Возвращает токены, взятые под действие, которое не состоялось"""
+        self.tokens = min(self.capacity, self.tokens + tokens)
+    
+    def pause(self, seconds):
+        """Никто не получает токены ближайшие seconds секунд (ответ RetryAfter)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+class FloodControl:
+    """Лимиты частоты действий: limits = {вид: (rate, burst пользователя, rate, burst общий)}"""
+    
+    def __init__(self, limits, idle_ttl, max_users):
+        self.limits = limits
+        self.idle_ttl = idle_ttl
+        self.max_users = max_users
+        self.global_buckets = {
+            kind: TokenBucket(global_rate, global_burst)
+            for kind, (_, _, global_rate, global_burst) in limits.items()
+        }
+        self._users = OrderedDict()  # (user_id, вид) -> TokenBucket, от давних обращений к свежим
+        self.evictions = 0
+    
+    def __len__(self):
+        return len(self._users)
+    
+    def allow(self, user_id, kind):
+        """None, если действие разрешено, иначе 'user' или 'global' — какой лимит исчерпан"""
+        key = (user_id, kind)
+        bucket = self._users.get(key)
+        if bucket is None:
+            rate, burst = self.limits[kind][:2]
+            bucket = self._users[key] = TokenBucket(rate, burst)
+            self._evict()
+        else:
+            self._users.move_to_end(key)
+        
+        # Сначала личный лимит: флудящий пользователь не должен расходовать общий
+        if not bucket.try_acquire():
+            return 'user'
+        if not self.global_buckets[kind].try_acquire():
+            bucket.refund()
+            return 'global'
+        return None
+    
+    def _evict(self):
+        deadline = time.monotonic() - self.idle_ttl
+        while self._users:
+            key, bucket = next(iter(self._users.items()))
+            if bucket.updated_at >= deadline and len(self._users) <= self.max_users:
+                break
+            del self._users[key]
+            self.evictions += 1
+
+flood_control = FloodControl(
+    {
+        'navigation': (FLOOD_USER_RATE, FLOOD_USER_BURST, FLOOD_GLOBAL_RATE, FLOOD_GLOBAL_BURST),
+        'payment': (
+            FLOOD_PAYMENT_USER_RATE, FLOOD_PAYMENT_USER_BURST,
+            FLOOD_PAYMENT_GLOBAL_RATE, FLOOD_PAYMENT_GLOBAL_BURST
+        ),
+    },
+    FLOOD_IDLE_TTL, FLOOD_MAX_USERS
+)
+
+flood_throttled = metrics.counter(
+    'shop_flood_throttled_total', 'Действия, отклонённые флуд-контролем', ('kind', 'limit')
+)
+metrics.gauge('shop_flood_tracked_buckets', 'Вёдер пользователей во флуд-контроле',
+              collect=lambda: len(flood_control))
+
+def flood_kind(update: Update):
+    query = update.callback_query
+    if query and query.data and query.data.startswith(FLOOD_PAYMENT_PREFIXES):
+        return 'payment'
+    return 'navigation'
+
+async def _check_flood(update: Update):
+    """False, если пользователь превысил лимит; нажатие кнопки гасится query.answer без похода в базу"""
+    user_id = update.effective_user.id
+    if user_id == ADMIN_ID:
+        return True
+    
+    kind = flood_kind(update)
+    limit = flood_control.allow(user_id, kind)
+    if limit is None:
+        return True
+    
+    flood_throttled.inc(kind=kind, limit=limit)
+    # На сообщения не отвечаем: ответ стоил бы ещё одного запроса к Bot API
+    if update.callback_query:
+        try:
+            await update.callback_query.answer("⏳ Слишком много запросов, подождите пару секунд")
+        except Exception as e:
+            logger.error(f"Ошибка ответа на нажатие: {e}")
+    return False
+
 # Проверка доступа
 async def check_access(update: Update, context: ContextTypes.DEFAULT_TYPE, func, *args, **kwargs):
-    user_id = update.effective_user.id
+    with access_check_latency.time(), span('check_access'):
+        allowed = await _check_access(update, context)
+    if not allowed:
+        return
+    with span('handler'):
+        return await func(update, context, *args, **kwargs)
+
+async def _check_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with span('flood_check'):
+        allowed = await _check_flood(update)
+    if not allowed:
+        return False
     
-    if is_user_banned(user_id):
+    user_id = update.effective_user.id
+    with span('ban_check'):
+        banned = is_user_banned(user_id)
+    if banned:
         if update.callback_query:
             await update.callback_query.answer("🚫 Доступ к боту ограничен администратором", show_alert=True)
         else:
             await update.message.reply_text("🚫 Доступ к боту ограничен администратором")
-        return
+        return False
     
     if user_id != ADMIN_ID:
-        is_subscribed = await check_subscription(context.application, user_id)
+        with span('subscription_check'):
+            is_subscribed = await check_subscription(context.application, user_id)
         if not is_subscribed:
             subscription_text = (
                 "📢 Чтобы получить доступ к магазину, подпишитесь на наш канал!\n\n"
@@ -535,15 +2346,17 @@ async def check_access(update: Update, context: ContextTypes.DEFAULT_TYPE, func,
                 await update.callback_query.answer()
             else:
                 await update.message.reply_text(subscription_text, reply_markup=reply_markup)
-            return
+            return False
     
     user = update.effective_user
-    save_user(user.id, user.username, user.first_name)
-    
-    return await func(update, context, *args, **kwargs)
+    with span('save_user'):
+        save_user(user.id, user.username, user.first_name)
+    return True
 
 # Команда /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # После подписки пользователя просят нажать /start — проверяем подписку заново
+    subscription_cache.invalidate(update.effective_user.id)
     return await check_access(update, context, _start)
 
 async def _start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -589,26 +2402,13 @@ async def price(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return await check_access(update, context, _price)
 
 async def _price(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    categories = get_all_categories()
-    
-    if not categories:
-        await update.message.reply_text("📭 Категории товаров временно недоступны")
-        return
-    
-    text = "*Выберите категорию:*\n\n"
-    keyboard = []
-    
-    # ТОЛЬКО СТАРЫЕ КАТЕГОРИИ (без эмодзи в названиях)
-    for cat_id, name, description in categories:
-        # Проверяем, что это оригинальная категория
-        if name in ['Telegram Stars/Premium', 'Пополнение Steam', 'Прокси', 'Подписки', 'Физы']:
-            keyboard.append([InlineKeyboardButton(f"{name}", callback_data=f"cat_{cat_id}")])
+    view = catalog.snapshot.categories_view
     
-    if not keyboard:
+    if view is None:
         await update.message.reply_text("📭 Категории товаров временно недоступны")
         return
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    text, reply_markup = view
     await update.message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
 
 # Обработка выбора категории
@@ -621,64 +2421,24 @@ async def _handle_category_selection(update: Update, context: ContextTypes.DEFAU
     
     data = query.data
     if data.startswith('cat_'):
-        category_id = int(data[4:])
-        
-        conn = get_db_connection()
-        try:
-            cursor = conn.cursor()
-            cursor.execute('SELECT name FROM categories WHERE id = ?', (category_id,))
-            category = cursor.fetchone()
-            
-            if not category:
-                await query.edit_message_text("📭 Категория не найдена")
-                return
-            
-            category_name = category[0]
-            products = get_products_by_category(category_id)
-            
-            if not products:
-                await query.edit_message_text(f"📦 В категории '{category_name}' пока нет товаров")
-                return
-            
-            text = f"*Товары в категории: {category_name}*\n\n"
-            keyboard = []
-            
-            for product in products:
-                product_id, name, price, description, stock, product_type = product
-                
-                if product_type == 'fixed':
-                    stock_emoji = "🟢" if stock > 0 else "🔴"
-                    status = f"{stock} шт." if stock > 0 else "Нет в наличии"
-                    text += f"• *{name}* - {price}$ {stock_emoji} ({status})\n"
-                    if stock > 0:
-                        keyboard.append([InlineKeyboardButton(
-                            f"{name} - {price}$", 
-                            callback_data=f"buy_{product_id}"
-                        )])
-                elif product_type == 'stars':
-                    keyboard.append([InlineKeyboardButton(
-                        f"{name} (от 50)", 
-                        callback_data=f"buy_{product_id}"
-                    )])
-                elif product_type == 'steam':
-                    keyboard.append([InlineKeyboardButton(
-                        f"{name} (от 100₽)", 
-                        callback_data=f"buy_{product_id}"
-                    )])
-            
-            if not keyboard:
-                text = f"📭 В категории '{category_name}' все товары временно отсутствуют"
-            
-            keyboard.append([InlineKeyboardButton("⬅️ Назад к категориям", callback_data="back_to_categories")])
-            
-            reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
-            await query.edit_message_text(text, parse_mode='Markdown', reply_markup=reply_markup)
-            
-        except Exception as e:
-            logger.error(f"Ошибка загрузки категории: {e}")
-            await query.edit_message_text("❌ Ошибка при загрузке товаров")
-        finally:
-            conn.close()
+        view = catalog.snapshot.category_page(int(data[4:]))
+    elif data.startswith('catpage_'):
+        # catpage_{next|prev}_{category_id}_{product_id}
+        _, direction, category_id, cursor = data.split('_')
+        view = catalog.snapshot.category_page(int(category_id), direction, int(cursor))
+    else:
+        return
+    
+    if view is None:
+        await query.edit_message_text("📭 Категория не найдена")
+        return
+    
+    text, reply_markup = view
+    try:
+        await query.edit_message_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки категории: {e}")
+        await query.edit_message_text("❌ Ошибка при загрузке товаров")
 
 # Обработка кнопки "Назад к категориям"
 async def handle_back_to_categories(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -688,22 +2448,13 @@ async def _handle_back_to_categories(update: Update, context: ContextTypes.DEFAU
     query = update.callback_query
     await query.answer()
     
-    categories = get_all_categories()
+    view = catalog.snapshot.categories_view
     
-    if not categories:
+    if view is None:
         await query.edit_message_text("📭 Категории товаров временно недоступны")
         return
     
-    text = "*Выберите категорию:*\n\n"
-    keyboard = []
-    
-    # ТОЛЬКО СТАРЫЕ КАТЕГОРИИ (без эмодзи в названиях)
-    for cat_id, name, description in categories:
-        # Проверяем, что это оригинальная категория
-        if name in ['Telegram Stars/Premium', 'Пополнение Steam', 'Прокси', 'Подписки', 'Физы']:
-            keyboard.append([InlineKeyboardButton(f"{name}", callback_data=f"cat_{cat_id}")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    text, reply_markup = view
     await query.edit_message_text(text, parse_mode='Markdown', reply_markup=reply_markup)
 
 # Обработка покупки товара
@@ -792,17 +2543,17 @@ async def handle_custom_amount(update: Update, context: ContextTypes.DEFAULT_TYP
                 await update.message.reply_text("⚠️ Минимальное количество Stars: 50")
                 return
             
-            # ИСПОЛЬЗУЕМ КОЭФФИЦИЕНТЫ ИЗ БАЗЫ
-            stars_coeff = get_coefficient('stars')
-            exchange_rate = get_coefficient('exchange_rate')
-            
             # Формула: количество * коэффициент_звезд / курс
-            price_amount = round(stars_amount * stars_coeff / exchange_rate, 2)
-            price_with_fee = round(price_amount * (1 + CRYPTOBOT_FEE), 2)
+            quote = pricing.quote('stars', stars_amount)
+            stars_coeff = quote['coefficient']
+            exchange_rate = quote['exchange_rate']
+            price_amount = quote['price_amount']
+            price_with_fee = quote['price_with_fee']
             
             context.user_data['custom_amount'] = stars_amount
             context.user_data['price_amount'] = price_amount
             context.user_data['price_with_fee'] = price_with_fee
+            context.user_data['pricing_version'] = quote['pricing_version']
             
             # Показываем детали с коэффициентами
             await update.message.reply_text(
@@ -829,17 +2580,17 @@ async def handle_custom_amount(update: Update, context: ContextTypes.DEFAULT_TYP
                 await update.message.reply_text("⚠️ Минимальная сумма пополнения: 100₽")
                 return
             
-            # ИСПОЛЬЗУЕМ КОЭФФИЦИЕНТЫ ИЗ БАЗЫ
-            steam_coeff = get_coefficient('steam')
-            exchange_rate = get_coefficient('exchange_rate')
-            
             # Формула: (сумма * коэффициент_стим) / курс
-            price_amount = round((rub_amount * steam_coeff) / exchange_rate, 2)
-            price_with_fee = round(price_amount * (1 + CRYPTOBOT_FEE), 2)
+            quote = pricing.quote('steam', rub_amount)
+            steam_coeff = quote['coefficient']
+            exchange_rate = quote['exchange_rate']
+            price_amount = quote['price_amount']
+            price_with_fee = quote['price_with_fee']
             
             context.user_data['custom_amount'] = rub_amount
             context.user_data['price_amount'] = price_amount
             context.user_data['price_with_fee'] = price_with_fee
+            context.user_data['pricing_version'] = quote['pricing_version']
             
             # Показываем детали с коэффициентами
             steam_percentage = round((steam_coeff - 1) * 100, 1)
@@ -866,6 +2617,10 @@ async def handle_custom_amount(update: Update, context: ContextTypes.DEFAULT_TYP
 
 # Подтверждение кастомного заказа
 async def handle_confirm_custom(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Подтверждение выставляет счёт в CryptoBot: тот же лимит, что у покупки
+    if not await _check_flood(update):
+        return
+    
     query = update.callback_query
     await query.answer()
     
@@ -888,6 +2643,8 @@ async def handle_cancel_custom(update: Update, context: ContextTypes.DEFAULT_TYP
         del context.user_data['price_amount']
     if 'price_with_fee' in context.user_data:
         del context.user_data['price_with_fee']
+    if 'pricing_version' in context.user_data:
+        del context.user_data['pricing_version']
     
     await query.edit_message_text("❌ Заказ отменен")
 
@@ -898,27 +2655,35 @@ async def process_payment(query, application, context):
         return
     
     product = context.user_data['selected_product']
+    created_at = datetime.now()
+    invoice_id = make_invoice_id(product['id'], query.from_user.id, created_at)
+    
+    # Товар резервируется до выставления счёта, чтобы его нельзя было продать дважды
+    reserved = await reserve_stock(invoice_id, product['id'])
+    if reserved is None:
+        await query.edit_message_text("❌ Ошибка при создании заказа. Попробуйте позже")
+        return
+    if not reserved:
+        await query.edit_message_text("📭 Товар закончился. Выберите другой товар: /price")
+        return
     
-    invoice = cryptobot.create_invoice(
+    invoice = await cryptobot.create_invoice(
         amount=product['price'],
         description=product['description'],
-        expires_in=900
+        expires_in=ORDER_TIMEOUT
     )
     
     if not invoice:
+        await release_reservation(invoice_id)
         await query.edit_message_text("❌ Ошибка при создании платежа. Попробуйте позже")
         return
     
-    conn = get_db_connection()
+    order_saved = False
     try:
-        cursor = conn.cursor()
-        
-        invoice_id = f"INV_{product['id']}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        
-        cursor.execute('''
+        await db.execute('''
             INSERT INTO orders 
-            (invoice_id, user_id, username, first_name, product_id, product_name, price_amount, price_with_fee, cryptobot_invoice_id, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            (invoice_id, user_id, username, first_name, product_id, product_name, price_amount, price_with_fee, cryptobot_invoice_id, created_at, chat_id, message_id, pricing_version)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
             invoice_id, 
             query.from_user.id, 
@@ -929,10 +2694,15 @@ async def process_payment(query, application, context):
             product['price'],
             invoice['amount_with_fee'],
             invoice['invoice_id'], 
-            datetime.now()
+            created_at,
+            query.message.chat_id,
+            query.message.message_id,
+            pricing.version
         ))
-        
-        conn.commit()
+        order_saved = True
+        # Таймер ставится сразу после сохранения: ошибка при показе счёта не должна
+        # оставить заказ без отмены до следующего прохода
+        expiry_scheduler.order_created(created_at)
         
         order_data = {
             'invoice_id': invoice_id,
@@ -942,7 +2712,7 @@ async def process_payment(query, application, context):
             'product_name': product['name'],
             'price_amount': product['price'],
             'price_with_fee': invoice['amount_with_fee'],
-            'created_at': datetime.now()
+            'created_at': created_at
         }
         await notify_admin(application, order_data, "new")
         
@@ -968,13 +2738,11 @@ async def process_payment(query, application, context):
         
         await query.edit_message_text(order_text, parse_mode='Markdown', reply_markup=reply_markup)
         
-        asyncio.create_task(cancel_order_after_timeout(invoice_id, query.message.chat_id, query.message.message_id, application))
-        
     except Exception as e:
         logger.error(f"Ошибка создания заказа: {e}")
+        if not order_saved:
+            await release_reservation(invoice_id)
         await query.edit_message_text("❌ Ошибка при создании заказа")
-    finally:
-        conn.close()
 
 # Процесс оплаты кастомного товара (Stars/Steam)
 async def process_custom_payment(query, application, context):
@@ -989,26 +2757,24 @@ async def process_custom_payment(query, application, context):
     elif product['type'] == 'steam':
         description = f"Пополнение Steam: {custom_amount}₽"
     
-    invoice = cryptobot.create_invoice(
+    invoice = await cryptobot.create_invoice(
         amount=price_amount,
         description=description,
-        expires_in=900
+        expires_in=ORDER_TIMEOUT
     )
     
     if not invoice:
         await query.edit_message_text("❌ Ошибка при создании платежа. Попробуйте позже")
         return
     
-    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
+        created_at = datetime.now()
+        invoice_id = make_invoice_id(product['id'], query.from_user.id, created_at)
         
-        invoice_id = f"INV_{product['id']}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        
-        cursor.execute('''
+        await db.execute('''
             INSERT INTO orders 
-            (invoice_id, user_id, username, first_name, product_id, product_name, custom_amount, price_amount, price_with_fee, cryptobot_invoice_id, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            (invoice_id, user_id, username, first_name, product_id, product_name, custom_amount, price_amount, price_with_fee, cryptobot_invoice_id, created_at, chat_id, message_id, pricing_version)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
             invoice_id, 
             query.from_user.id, 
@@ -1020,10 +2786,12 @@ async def process_custom_payment(query, application, context):
             price_amount,
             invoice['amount_with_fee'],
             invoice['invoice_id'], 
-            datetime.now()
+            created_at,
+            query.message.chat_id,
+            query.message.message_id,
+            context.user_data.get('pricing_version', pricing.version)
         ))
-        
-        conn.commit()
+        expiry_scheduler.order_created(created_at)
         
         order_data = {
             'invoice_id': invoice_id,
@@ -1034,7 +2802,7 @@ async def process_custom_payment(query, application, context):
             'price_amount': price_amount,
             'price_with_fee': invoice['amount_with_fee'],
             'custom_amount': custom_amount,
-            'created_at': datetime.now()
+            'created_at': created_at
         }
         await notify_admin(application, order_data, "new")
         
@@ -1060,13 +2828,10 @@ async def process_custom_payment(query, application, context):
         
         await query.edit_message_text(order_text, parse_mode='Markdown', reply_markup=reply_markup)
         
-        asyncio.create_task(cancel_order_after_timeout(invoice_id, query.message.chat_id, query.message.message_id, application))
-        
     except Exception as e:
         logger.error(f"Ошибка создания заказа: {e}")
         await query.edit_message_text("❌ Ошибка при создании заказа")
     finally:
-        conn.close()
         # Очищаем временные данные
         if 'selected_product' in context.user_data:
             del context.user_data['selected_product']
@@ -1076,6 +2841,162 @@ async def process_custom_payment(query, application, context):
             del context.user_data['price_amount']
         if 'price_with_fee' in context.user_data:
             del context.user_data['price_with_fee']
+        if 'pricing_version' in context.user_data:
+            del context.user_data['pricing_version']
+
+# Текст для клиента об успешной оплате заказа
+def format_paid_order_text(order_data, already_paid=False):
+    invoice_id = order_data['invoice_id']
+    product_name = order_data['product_name']
+    price_amount = order_data['price_amount']
+    price_with_fee = order_data['price_with_fee']
+    custom_amount = order_data['custom_amount']
+    product_type = order_data['product_type']
+    
+    if already_paid:
+        success_text = (
+            "*Заказ уже оплачен!*\n\n"
+            f"Товар: {product_name}\n"
+            f"Сумма: {price_amount} USDT\n"
+            f"Оплачено: {price_with_fee} USDT (с учетом комиссии)\n"
+            f"Для получения товара напишите администратору\n\n"
+            f"_Номер заказа: {invoice_id}_"
+        )
+        if custom_amount:
+            if product_type == 'stars':
+                success_text = f"*Заказ уже оплачен!*\n\nTelegram Stars: {custom_amount} шт.\nСтоимость: {price_amount} USDT\nОплачено: {price_with_fee} USDT\nДля получения Stars напишите администратору\n\n_Номер заказа: {invoice_id}_"
+            elif product_type == 'steam':
+                success_text = f"*Заказ уже оплачен!*\n\nПополнение Steam: {custom_amount}₽\nСтоимость: {price_amount} USDT\nОплачено: {price_with_fee} USDT\nДля пополнения напишите администратору\n\n_Номер заказа: {invoice_id}_"
+        return success_text
+    
+    success_text = (
+        "*Заказ успешно оплачен!*\n\n"
+        f"Товар: {product_name}\n"
+        f"Сумма: {price_amount} USDT\n"
+        f"Оплачено: {price_with_fee} USDT (с учетом комиссии)\n"
+        f"Номер заказа: {invoice_id}\n\n"
+        f"Для получения товара напишите администратору\n\n"
+        f"_Не забудьте указать номер заказа!_"
+    )
+    if custom_amount:
+        if product_type == 'stars':
+            success_text = f"*Заказ успешно оплачен!*\n\nTelegram Stars: {custom_amount} шт.\nСтоимость: {price_amount} USDT\nОплачено: {price_with_fee} USDT\nНомер заказа: {invoice_id}\n\nДля получения Stars напишите администратору"
+        elif product_type == 'steam':
+            success_text = f"*Заказ успешно оплачен!*\n\nПополнение Steam: {custom_amount}₽\nСтоимость: {price_amount} USDT\nОплачено: {price_with_fee} USDT\nНомер заказа: {invoice_id}\n\nДля пополнения напишите администратору"
+    return success_text
+
+def get_order_data(cursor, invoice_id):
+    cursor.execute('''
+        SELECT o.cryptobot_invoice_id, o.product_name, o.status, o.user_id, o.username, 
+               o.first_name, o.price_amount, o.product_id, o.custom_amount,
+               p.product_type, p.stock, o.price_with_fee, o.chat_id, o.message_id
+        FROM orders o
+        LEFT JOIN products p ON o.product_id = p.id
+        WHERE o.invoice_id = ?
+    ''', (invoice_id,))
+    order = cursor.fetchone()
+    if not order:
+        return None
+    
+    (cryptobot_invoice_id, product_name, status, user_id, username, 
+     first_name, price_amount, product_id, custom_amount, 
+     product_type, stock, price_with_fee, chat_id, message_id) = order
+    
+    return {
+        'invoice_id': invoice_id,
+        'cryptobot_invoice_id': cryptobot_invoice_id,
+        'status': status,
+        'user_id': user_id,
+        'username': username,
+        'first_name': first_name,
+        'product_id': product_id,
+        'product_name': product_name,
+        'product_type': product_type,
+        'stock': stock,
+        'price_amount': price_amount,
+        'price_with_fee': price_with_fee,
+        'custom_amount': custom_amount,
+        'chat_id': chat_id,
+        'message_id': message_id
+    }
+
+def _apply_order_payment(cursor, invoice_id, paid_at):
+    """Списание товара и смена статуса на paid без commit (вызывающий завершает транзакцию)"""
+    order_data = get_order_data(cursor, invoice_id)
+    
+    if not order_data:
+        return 'not_found', None
+    if order_data['status'] == 'paid':
+        return 'already_paid', order_data
+    
+    # Товар уже списан резервом при создании заказа; если резерв успели снять
+    # (заказ истёк) или заказ создан до появления резервов — списываем атомарно сейчас
+    if order_data['product_type'] == 'fixed' and not _commit_reservation(cursor, invoice_id):
+        cursor.execute('UPDATE products SET stock = stock - 1 WHERE id = ? AND stock >= 1', (order_data['product_id'],))
+        # rowcount запоминается сразу: bump_counters выполняет запрос на том же курсоре
+        decremented = cursor.rowcount
+        bump_counters(cursor, total_stock=-decremented)
+        
+        if decremented == 0:
+            cursor.execute('SELECT 1 FROM products WHERE id = ?', (order_data['product_id'],))
+            if not cursor.fetchone():
+                return 'product_missing', order_data
+            
+            cursor.execute('UPDATE orders SET status = "out_of_stock" WHERE invoice_id = ? AND status = ?',
+                           (invoice_id, order_data['status']))
+            return 'out_of_stock', order_data
+    
+    # Условие по статусу защищает от двойного подтверждения (кнопка, вебхук, фоновая проверка)
+    cursor.execute('''
+        UPDATE orders SET status = 'paid', paid_at = ? 
+        WHERE invoice_id = ? AND status = ?
+    ''', (paid_at, invoice_id, order_data['status']))
+    
+    if cursor.rowcount == 0:
+        return 'already_paid', order_data
+    
+    bump_counters(
+        cursor,
+        paid_orders=1,
+        paid_revenue=order_data['price_amount'] or 0,
+        paid_with_fee=order_data['price_with_fee'] or 0
+    )
+    order_data['status'] = 'paid'
+    order_data['paid_at'] = paid_at
+    return 'paid', order_data
+
+async def apply_order_payment(invoice_id):
+    """Списывает товар и переводит заказ в статус paid. Возвращает (результат, данные заказа)"""
+    result, order_data = await db.write(lambda conn: _apply_order_payment(conn.cursor(), invoice_id, datetime.now()))
+    if result == 'paid' and order_data['product_type'] == 'fixed':
+        await reload_catalog()
+    return result, order_data
+
+async def notify_customer_paid(application, order_data):
+    """Сообщает клиенту об оплате: редактирует сообщение заказа или пишет новое"""
+    text = format_paid_order_text(order_data)
+    try:
+        if order_data.get('chat_id') and order_data.get('message_id'):
+            await application.bot.edit_message_text(
+                chat_id=order_data['chat_id'],
+                message_id=order_data['message_id'],
+                text=text,
+                parse_mode='Markdown'
+            )
+        else:
+            await application.bot.send_message(chat_id=order_data['user_id'], text=text, parse_mode='Markdown')
+    except Exception as e:
+        logger.error(f"Ошибка уведомления клиента об оплате {order_data['invoice_id']}: {e}")
+
+async def confirm_order_payment(application, invoice_id):
+    """Общий путь подтверждения оплаты: списание, смена статуса, уведомление админа"""
+    result, order_data = await apply_order_payment(invoice_id)
+    
+    if result == 'paid':
+        logger.info(f"✅ Заказ {invoice_id} оплачен")
+        await notify_admin(application, order_data, "paid")
+    
+    return result, order_data
 
 # Проверка оплаты
 async def check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1089,107 +3010,31 @@ async def _check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith('check_'):
         invoice_id = data[6:]
         
-        conn = get_db_connection()
         try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT o.cryptobot_invoice_id, o.product_name, o.status, o.user_id, o.username, 
-                       o.first_name, o.price_amount, o.product_id, o.custom_amount,
-                       p.product_type, p.stock, o.price_with_fee
-                FROM orders o
-                LEFT JOIN products p ON o.product_id = p.id
-                WHERE o.invoice_id = ?
-            ''', (invoice_id,))
-            order = cursor.fetchone()
+            order_data = await db.read(lambda conn: get_order_data(conn.cursor(), invoice_id))
             
-            if not order:
+            if not order_data:
                 await query.answer("❌ Заказ не найден", show_alert=True)
                 return
             
-            (cryptobot_invoice_id, product_name, status, user_id, username, 
-             first_name, price_amount, product_id, custom_amount, 
-             product_type, stock, price_with_fee) = order
-            
-            if status == 'paid':
-                success_text = (
-                    "*Заказ уже оплачен!*\n\n"
-                    f"Товар: {product_name}\n"
-                    f"Сумма: {price_amount} USDT\n"
-                    f"Оплачено: {price_with_fee} USDT (с учетом комиссии)\n"
-                    f"Для получения товара напишите администратору\n\n"
-                    f"_Номер заказа: {invoice_id}_"
-                )
-                if custom_amount:
-                    if product_type == 'stars':
-                        success_text = f"*Заказ уже оплачен!*\n\nTelegram Stars: {custom_amount} шт.\nСтоимость: {price_amount} USDT\nОплачено: {price_with_fee} USDT\nДля получения Stars напишите администратору\n\n_Номер заказа: {invoice_id}_"
-                    elif product_type == 'steam':
-                        success_text = f"*Заказ уже оплачен!*\n\nПополнение Steam: {custom_amount}₽\nСтоимость: {price_amount} USDT\nОплачено: {price_with_fee} USDT\nДля пополнения напишите администратору\n\n_Номер заказа: {invoice_id}_"
-                
-                await query.edit_message_text(success_text, parse_mode='Markdown')
+            if order_data['status'] == 'paid':
+                await query.edit_message_text(format_paid_order_text(order_data, already_paid=True), parse_mode='Markdown')
                 return
             
-            invoice_status = cryptobot.check_invoice_status(cryptobot_invoice_id)
+            invoice_status = await cryptobot.check_invoice_status(order_data['cryptobot_invoice_id'])
             
             if invoice_status == 'paid':
-                # СПИСЫВАЕМ ТОВАР ТОЛЬКО ПОСЛЕ УСПЕШНОЙ ОПЛАТЫ
-                if product_type == 'fixed':
-                    # Получаем текущий остаток
-                    cursor.execute('SELECT stock FROM products WHERE id = ?', (product_id,))
-                    result = cursor.fetchone()
-                    
-                    if not result:
-                        await query.answer("❌ Ошибка: товар не найден", show_alert=True)
-                        return
-                    
-                    current_stock = result[0]
-                    
-                    # Проверяем, есть ли товар в наличии
-                    if current_stock <= 0:
-                        await query.answer("❌ Товар закончился на складе", show_alert=True)
-                        cursor.execute('UPDATE orders SET status = "out_of_stock" WHERE invoice_id = ?', (invoice_id,))
-                        conn.commit()
-                        return
-                    
-                    # Уменьшаем количество товара
-                    new_stock = current_stock - 1
-                    cursor.execute('UPDATE products SET stock = ? WHERE id = ?', (new_stock, product_id))
+                result, order_data = await confirm_order_payment(context.application, invoice_id)
                 
-                cursor.execute('''
-                    UPDATE orders SET status = 'paid', paid_at = ? 
-                    WHERE invoice_id = ?
-                ''', (datetime.now(), invoice_id))
-                
-                conn.commit()
-                
-                order_data = {
-                    'invoice_id': invoice_id,
-                    'user_id': user_id,
-                    'username': username,
-                    'first_name': first_name,
-                    'product_name': product_name,
-                    'price_amount': price_amount,
-                    'price_with_fee': price_with_fee,
-                    'custom_amount': custom_amount,
-                    'paid_at': datetime.now()
-                }
-                await notify_admin(context.application, order_data, "paid")
-                
-                success_text = (
-                    "*Заказ успешно оплачен!*\n\n"
-                    f"Товар: {product_name}\n"
-                    f"Сумма: {price_amount} USDT\n"
-                    f"Оплачено: {price_with_fee} USDT (с учетом комиссии)\n"
-                    f"Номер заказа: {invoice_id}\n\n"
-                    f"Для получения товара напишите администратору\n\n"
-                    f"_Не забудьте указать номер заказа!_"
-                )
-                if custom_amount:
-                    if product_type == 'stars':
-                        success_text = f"*Заказ успешно оплачен!*\n\nTelegram Stars: {custom_amount} шт.\nСтоимость: {price_amount} USDT\nОплачено: {price_with_fee} USDT\nНомер заказа: {invoice_id}\n\nДля получения Stars напишите администратору"
-                    elif product_type == 'steam':
-                        success_text = f"*Заказ успешно оплачен!*\n\nПополнение Steam: {custom_amount}₽\nСтоимость: {price_amount} USDT\nОплачено: {price_with_fee} USDT\nНомер заказа: {invoice_id}\n\nДля пополнения напишите администратору"
-                
-                await query.edit_message_text(success_text, parse_mode='Markdown')
+                if result == 'product_missing':
+                    await query.answer("❌ Ошибка: товар не найден", show_alert=True)
+                elif result == 'out_of_stock':
+                    await query.answer("❌ Товар закончился на складе", show_alert=True)
+                else:
+                    await query.edit_message_text(
+                        format_paid_order_text(order_data, already_paid=(result == 'already_paid')),
+                        parse_mode='Markdown'
+                    )
                 
             elif invoice_status == 'active':
                 await query.answer("❌ Оплата не найдена. Пожалуйста, оплатите счет и попробуйте снова", show_alert=True)
@@ -1199,42 +3044,465 @@ async def _check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             logger.error(f"Ошибка проверки оплаты: {e}")
             await query.answer("❌ Ошибка при проверке оплаты", show_alert=True)
-        finally:
-            conn.close()
 
-# Отмена заказа по таймауту
-async def cancel_order_after_timeout(invoice_id, chat_id, message_id, application):
-    await asyncio.sleep(900)
+# Вебхук CryptoBot: мгновенное подтверждение оплаты без нажатия кнопки
+async def find_order_by_cryptobot_invoice(cryptobot_invoice_id):
+    result = await db.fetchone(
+        'SELECT invoice_id FROM orders WHERE cryptobot_invoice_id = ?', (str(cryptobot_invoice_id),)
+    )
+    return result[0] if result else None
+
+async def handle_cryptobot_webhook(application, request):
+    if request.method != 'POST':
+        return 405, 'text/plain', b'method not allowed'
+    
+    if not verify_cryptobot_signature(request.body, request.headers.get('crypto-pay-api-signature')):
+        logger.warning("⚠️ Вебхук CryptoBot с неверной подписью отклонен")
+        return 401, 'text/plain', b'invalid signature'
+    
+    webhook_update = json.loads(request.body)
+    if webhook_update.get('update_type') != 'invoice_paid':
+        return 200, 'application/json', b'{"ok":true}'
+    
+    invoice = webhook_update.get('payload') or {}
+    invoice_id = await find_order_by_cryptobot_invoice(invoice.get('invoice_id'))
+    if not invoice_id:
+        logger.warning(f"Вебхук: заказ для инвойса {invoice.get('invoice_id')} не найден")
+        return 200, 'application/json', b'{"ok":true}'
+    
+    result, order_data = await confirm_order_payment(application, invoice_id)
+    
+    if result == 'paid':
+        await notify_customer_paid(application, order_data)
+    elif result == 'out_of_stock':
+        logger.warning(f"Заказ {invoice_id} оплачен, но товар закончился на складе")
+    
+    return 200, 'application/json', b'{"ok":true}'
+
+# Фоновая проверка всех неоплаченных заказов пакетными запросами getInvoices
+ORDER_EXPIRED_TEXT = "*Заказ отменен* (время оплаты истекло)\n\nДля нового заказа используйте /price"
+
+async def get_pending_invoices():
+    return await db.fetchall('''
+        SELECT invoice_id, cryptobot_invoice_id FROM orders
+        WHERE status = 'pending' AND cryptobot_invoice_id IS NOT NULL
+    ''')
+
+def _apply_invoice_transitions(conn, paid_invoice_ids, expired_invoice_ids):
+    cursor = conn.cursor()
+    paid_at = datetime.now()
+    paid_orders = []
+    for invoice_id in paid_invoice_ids:
+        result, order_data = _apply_order_payment(cursor, invoice_id, paid_at)
+        if result == 'paid':
+            paid_orders.append(order_data)
+        elif result == 'out_of_stock':
+            logger.warning(f"Заказ {invoice_id} оплачен, но товар закончился на складе")
+    
+    expired_orders = []
+    for invoice_id in expired_invoice_ids:
+        cursor.execute('''
+            UPDATE orders SET status = 'expired' WHERE invoice_id = ? AND status = 'pending'
+        ''', (invoice_id,))
+        if cursor.rowcount:
+            cursor.execute('SELECT chat_id, message_id FROM orders WHERE invoice_id = ?', (invoice_id,))
+            chat_id, message_id = cursor.fetchone()
+            expired_orders.append({'invoice_id': invoice_id, 'chat_id': chat_id, 'message_id': message_id})
     
-    conn = get_db_connection()
+    released = _release_reservations(cursor, [order['invoice_id'] for order in expired_orders])
+    return paid_orders, expired_orders, released
+
+async def apply_invoice_transitions(paid_invoice_ids, expired_invoice_ids):
+    """Применяет оплаты и просрочки одной транзакцией. Возвращает (оплаченные, просроченные)"""
+    paid_orders, expired_orders, released = await db.write(
+        _apply_invoice_transitions, paid_invoice_ids, expired_invoice_ids
+    )
+    if released or any(order['product_type'] == 'fixed' for order in paid_orders):
+        await reload_catalog()
+    return paid_orders, expired_orders
+
+async def poll_pending_invoices(context: ContextTypes.DEFAULT_TYPE):
     try:
-        cursor = conn.cursor()
-        cursor.execute('SELECT status FROM orders WHERE invoice_id = ?', (invoice_id,))
-        order = cursor.fetchone()
+        pending = await get_pending_invoices()
+        if not pending:
+            return
         
-        if order and order[0] == 'pending':
-            cursor.execute('UPDATE orders SET status = "expired" WHERE invoice_id = ?', (invoice_id,))
-            
-            conn.commit()
-            
-            cancel_text = "*Заказ отменен* (время оплаты истекло)\n\nДля нового заказа используйте /price"
-            
+        by_cryptobot_id = {str(cryptobot_invoice_id): invoice_id for invoice_id, cryptobot_invoice_id in pending}
+        cryptobot_ids = list(by_cryptobot_id)
+        batches = [
+            cryptobot_ids[i:i + CRYPTOBOT_BATCH_SIZE]
+            for i in range(0, len(cryptobot_ids), CRYPTOBOT_BATCH_SIZE)
+        ]
+        results = await asyncio.gather(*(cryptobot.get_invoices(batch) for batch in batches))
+        
+        paid_invoice_ids = []
+        expired_invoice_ids = []
+        for statuses in results:
+            for cryptobot_invoice_id, status in (statuses or {}).items():
+                invoice_id = by_cryptobot_id.get(cryptobot_invoice_id)
+                if invoice_id is None:
+                    continue
+                if status == 'paid':
+                    paid_invoice_ids.append(invoice_id)
+                elif status == 'expired':
+                    expired_invoice_ids.append(invoice_id)
+        
+        if not paid_invoice_ids and not expired_invoice_ids:
+            return
+        
+        paid_orders, expired_orders = await apply_invoice_transitions(paid_invoice_ids, expired_invoice_ids)
+        logger.info(
+            f"Фоновая проверка: {len(pending)} в ожидании, "
+            f"оплачено {len(paid_orders)}, просрочено {len(expired_orders)}"
+        )
+        
+        for order_data in paid_orders:
+            await notify_admin(context.application, order_data, "paid")
+            await notify_customer_paid(context.application, order_data)
+        
+        await edit_messages_throttled(context.bot, expired_orders, ORDER_EXPIRED_TEXT)
+    except Exception as e:
+        logger.error(f"Ошибка фоновой проверки оплат: {e}")
+
+# Истечение неоплаченных заказов: один планировщик вместо задачи на каждый заказ.
+# Состояние (ближайший дедлайн) восстанавливается из orders.created_at при старте.
+def _expire_overdue_orders(conn, deadline):
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute('''
+        SELECT invoice_id, chat_id, message_id FROM orders
+        WHERE status = 'pending' AND created_at < ?
+    ''', (deadline,))
+    expired = [
+        {'invoice_id': invoice_id, 'chat_id': chat_id, 'message_id': message_id}
+        for invoice_id, chat_id, message_id in cursor.fetchall()
+    ]
+    cursor.execute('''
+        UPDATE orders SET status = 'expired'
+        WHERE status = 'pending' AND created_at < ?
+    ''', (deadline,))
+    released = _release_reservations(cursor, [order['invoice_id'] for order in expired])
+    return expired, released
+
+async def expire_overdue_orders(deadline):
+    """Переводит в expired все pending-заказы, созданные раньше deadline, одним UPDATE"""
+    expired, released = await db.write(_expire_overdue_orders, deadline)
+    if released:
+        await reload_catalog()
+    return expired
+
+async def get_oldest_pending_order_time():
+    result = (await db.fetchone("SELECT MIN(created_at) FROM orders WHERE status = 'pending'"))[0]
+    return datetime.fromisoformat(result) if result else None
+
+async def edit_messages_throttled(bot, messages, text, rate=EXPIRY_EDIT_RATE):
+    """Редактирует сообщения заказов не быстрее rate правок в секунду"""
+    for order in messages:
+        if not order.get('message_id'):
+            continue
+        for attempt in range(EXPIRY_EDIT_ATTEMPTS):
             try:
-                await application.bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    text=cancel_text,
+                await bot.edit_message_text(
+                    chat_id=order['chat_id'],
+                    message_id=order['message_id'],
+                    text=text,
                     parse_mode='Markdown'
                 )
-            except:
-                pass
-    except Exception as e:
-        logger.error(f"Ошибка отмены заказа: {e}")
+                break
+            except RetryAfter as e:
+                if attempt == EXPIRY_EDIT_ATTEMPTS - 1:
+                    logger.warning(f"Сообщение заказа {order['invoice_id']} не обновлено: лимит Bot API")
+                    break
+                await asyncio.sleep(e.retry_after)
+            except Exception:
+                break
+        await asyncio.sleep(1 / rate)
+
+class OrderExpiryScheduler:
+    """Один таймер на ближайший дедлайн оплаты среди всех pending-заказов"""
+    
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.job_queue = None
+        self._job = None
+        self._next_run = None
+    
+    def start(self, job_queue):
+        # Первый проход сразу: истекает всё, что просрочилось пока бот был выключен
+        self.job_queue = job_queue
+        self._schedule(datetime.now())
+    
+    def order_created(self, created_at):
+        if self.job_queue is not None:
+            self._schedule(created_at + timedelta(seconds=self.timeout))
+    
+    def _schedule(self, when):
+        if self._next_run is not None and self._next_run <= when:
+            return
+        if self._job is not None:
+            self._job.schedule_removal()
+        self._next_run = when
+        delay = max((when - datetime.now()).total_seconds(), 0)
+        self._job = self.job_queue.run_once(self._sweep, delay, name="expire_orders")
+    
+    async def _sweep(self, context: ContextTypes.DEFAULT_TYPE):
+        self._job = None
+        self._next_run = None
+        expired = []
+        try:
+            expired = await expire_overdue_orders(datetime.now() - timedelta(seconds=self.timeout))
+            if expired:
+                logger.info(f"⌛ Истекло заказов: {len(expired)}")
+            
+            oldest = await get_oldest_pending_order_time()
+            if oldest is not None:
+                self._schedule(max(oldest + timedelta(seconds=self.timeout), datetime.now() + timedelta(seconds=1)))
+        except Exception as e:
+            logger.error(f"Ошибка отмены просроченных заказов: {e}")
+            self._schedule(datetime.now() + timedelta(seconds=EXPIRY_RETRY_DELAY))
+        
+        await edit_messages_throttled(context.bot, expired, ORDER_EXPIRED_TEXT)
+
+expiry_scheduler = OrderExpiryScheduler(ORDER_TIMEOUT)
+
+# === ДЛИННЫЕ СПИСКИ ===
+# Строки читаются курсором пачками по LIST_FETCH_SIZE и раскладываются по сообщениям
+# не длиннее MESSAGE_LIMIT по границам строк. За один показ собирается не больше
+# max_messages сообщений, остальное доступно кнопкой с keyset-курсором по последней строке
+
+def message_length(text):
+    # Telegram считает длину в UTF-16: эмодзи занимают две позиции
+    return len(text.encode('utf-16-le')) // 2
+
+def truncate_text(text, limit):
+    if message_length(text) <= limit:
+        return text
+    text = text[:max(limit - 1, 0)]
+    while text and message_length(text) > limit - 1:
+        text = text[:-1]
+    return text + '…'
+
+class ChunkedText:
+    """Раскладывает строки по сообщениям не длиннее limit, заголовок повторяется в каждом"""
+    
+    def __init__(self, header='', limit=MESSAGE_LIMIT):
+        self.header = header
+        self.limit = limit
+        self.chunks = []
+        self._parts = []
+        self._length = message_length(header)
+    
+    @property
+    def count(self):
+        return len(self.chunks) + (1 if self._parts else 0)
+    
+    def fits(self, line):
+        return self._length + message_length(line) <= self.limit
+    
+    def add(self, line):
+        if self._parts and not self.fits(line):
+            self._close()
+        if not self.fits(line):
+            line = truncate_text(line, self.limit - self._length)
+        self._parts.append(line)
+        self._length += message_length(line)
+    
+    def _close(self):
+        self.chunks.append(self.header + ''.join(self._parts))
+        self._parts = []
+        self._length = message_length(self.header)
+    
+    def finish(self):
+        if self._parts:
+            self._close()
+        return self.chunks
+
+def render_rows(cursor, render_row, header='', max_messages=LIST_MAX_MESSAGES, limit=MESSAGE_LIMIT):
+    """Возвращает (сообщения, последняя показанная строка, остались ли ещё строки)"""
+    text = ChunkedText(header, limit)
+    last_row = None
+    while True:
+        rows = cursor.fetchmany(LIST_FETCH_SIZE)
+        if not rows:
+            return text.finish(), last_row, False
+        for row in rows:
+            line = render_row(row)
+            if not text.fits(line) and text.count >= max_messages:
+                return text.finish(), last_row, True
+            text.add(line)
+            last_row = row
+
+def _read_rendered_rows(conn, sql, params, render_row, header, max_messages):
+    cursor = conn.execute(sql, params)
+    try:
+        return render_rows(cursor, render_row, header, max_messages)
     finally:
-        conn.close()
+        # Недочитанный курсор держал бы открытой транзакцию чтения
+        cursor.close()
+
+async def show_rows(update: Update, sql, params, render_row, header, empty_text,
+                    next_page=None, first_page=None, max_messages=LIST_MAX_MESSAGES):
+    """Показывает строки запроса; next_page(последняя строка) даёт callback_data следующей страницы"""
+    chunks, last_row, has_more = await db.read(
+        _read_rendered_rows, sql, params, render_row, header, max_messages
+    )
+    query = update.callback_query
+    
+    navigation = []
+    if query and first_page:
+        navigation.append(InlineKeyboardButton("⏮ В начало", callback_data=first_page))
+    if has_more and next_page:
+        navigation.append(InlineKeyboardButton("➡️ Дальше", callback_data=next_page(last_row)))
+    reply_markup = InlineKeyboardMarkup([navigation]) if navigation else None
+    
+    messages = chunks or [empty_text]
+    for index, text in enumerate(messages):
+        markup = reply_markup if index == len(messages) - 1 else None
+        if index == 0 and query:
+            await query.edit_message_text(text, parse_mode='Markdown', reply_markup=markup)
+        else:
+            await update.effective_chat.send_message(text, parse_mode='Markdown', reply_markup=markup)
+    
+    if has_more and not next_page:
+        await update.effective_chat.send_message("✂️ Показаны не все записи")
 
 # === АДМИН-СИСТЕМА ===
 
+# Товары админки читаются одним запросом с JOIN страницами по ADMIN_PAGE_SIZE;
+# курсор страницы — (category_id, product_id) последней/первой строки
+def _load_admin_products(conn, direction, cursor, limit):
+    if cursor is None:
+        rows = conn.execute('''
+            SELECT c.id, c.name, p.id, p.name, p.price, p.stock, p.product_type
+            FROM products p
+            JOIN categories c ON c.id = p.category_id
+            ORDER BY p.category_id, p.id
+            LIMIT ?
+        ''', (limit,)).fetchall()
+    elif direction == 'next':
+        rows = conn.execute('''
+            SELECT c.id, c.name, p.id, p.name, p.price, p.stock, p.product_type
+            FROM products p
+            JOIN categories c ON c.id = p.category_id
+            WHERE (p.category_id, p.id) > (?, ?)
+            ORDER BY p.category_id, p.id
+            LIMIT ?
+        ''', (*cursor, limit)).fetchall()
+    else:
+        rows = conn.execute('''
+            SELECT c.id, c.name, p.id, p.name, p.price, p.stock, p.product_type
+            FROM products p
+            JOIN categories c ON c.id = p.category_id
+            WHERE (p.category_id, p.id) < (?, ?)
+            ORDER BY p.category_id DESC, p.id DESC
+            LIMIT ?
+        ''', (*cursor, limit)).fetchall()
+        rows.reverse()
+    return rows
+
+def _admin_product_line(row):
+    cat_id, cat_name, prod_id, prod_name, price, stock, prod_type = row
+    stock_emoji = "🟢" if stock > 0 else "🔴"
+    type_emoji = {
+        'fixed': '📦',
+        'stars': '⭐',
+        'steam': '🎮'
+    }.get(prod_type, '❓')
+    return f"  {type_emoji} {prod_name} - {price}$ {stock_emoji} ({stock} шт.)\n"
+
+def _admin_panel_footer():
+    # Получаем коэффициенты для отображения
+    coefficients = get_all_coefficients()
+    text = "\n*Коэффициенты:*\n"
+    for coeff_type, data in coefficients.items():
+        value = data['value']
+        
+        if coeff_type == 'stars':
+            text += f"Telegram Stars: {value}\n"
+        elif coeff_type == 'steam':
+            percentage = round((value - 1) * 100, 1)
+            text += f"Steam комиссия: +{percentage}% (коэф: {value})\n"
+        elif coeff_type == 'exchange_rate':
+            text += f"Курс USDT: {value} руб\n"
+    
+    text += f"\n*Комиссия CryptoBot:* {CRYPTOBOT_FEE*100}%\n"
+    return text
+
+async def _show_admin_panel(update: Update, direction='next', cursor=None):
+    # Лишняя строка показывает, есть ли страница дальше в направлении листания
+    rows = await db.read(_load_admin_products, direction, cursor, ADMIN_PAGE_SIZE + 1)
+    has_more = len(rows) > ADMIN_PAGE_SIZE
+    if has_more:
+        rows = rows[1:] if direction == 'prev' else rows[:-1]
+    
+    if direction == 'prev':
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = cursor is not None, has_more
+    
+    header = "*Панель администратора*\n\n*Категории:*\n"
+    footer = _admin_panel_footer()
+    limit = MESSAGE_LIMIT - message_length(footer)
+    
+    # Длинные названия могут не влезть в одно сообщение: страница тогда короче,
+    # а не показанные строки попадают на следующую. Строки отбираются с заголовком
+    # категории у каждой, так что настоящий текст страницы точно не длиннее
+    probe = ChunkedText(header, limit)
+    shown = []
+    for row in (reversed(rows) if direction == 'prev' else rows):
+        line = f"\n{row[1]}\n" + _admin_product_line(row)
+        if shown and not probe.fits(line):
+            break
+        probe.add(line)
+        shown.append(row)
+    if len(shown) < len(rows):
+        if direction == 'prev':
+            has_prev = True
+        else:
+            has_next = True
+    rows = shown[::-1] if direction == 'prev' else shown
+    
+    # Слишком длинную единственную строку ChunkedText.add обрежет по лимиту
+    page = ChunkedText(header, limit)
+    keyboard = []
+    current_category = None
+    
+    for row in rows:
+        cat_id, cat_name, prod_id, prod_name, price, stock, prod_type = row
+        line = _admin_product_line(row)
+        if cat_id != current_category:
+            current_category = cat_id
+            line = f"\n{cat_name}\n" + line
+        page.add(line)
+        
+        keyboard.append([
+            InlineKeyboardButton(f"✏️ {prod_name[:15]}", callback_data=f"edit_{prod_id}"),
+            InlineKeyboardButton(f"🗑️", callback_data=f"delete_{prod_id}")
+        ])
+    
+    navigation = []
+    if rows and has_prev:
+        navigation.append(InlineKeyboardButton("⬅️", callback_data=f"admin_page_prev_{rows[0][0]}_{rows[0][2]}"))
+    if rows and has_next:
+        navigation.append(InlineKeyboardButton("➡️", callback_data=f"admin_page_next_{rows[-1][0]}_{rows[-1][2]}"))
+    if navigation:
+        keyboard.append(navigation)
+    
+    text = (page.finish() or [header])[0] + footer
+    
+    keyboard.append([InlineKeyboardButton("➕ Добавить товар", callback_data="add_menu")])
+    keyboard.append([InlineKeyboardButton("⚙️ Настройки коэффициентов", callback_data="coefficients_menu")])
+    keyboard.append([InlineKeyboardButton("📊 Статистика", callback_data="stats")])
+    keyboard.append([InlineKeyboardButton("🚫 Управление банами", callback_data="bans_menu")])
+    keyboard.append([InlineKeyboardButton("📢 Рассылка", callback_data="broadcast_info")])
+    
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    if update.callback_query:
+        await update.callback_query.edit_message_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+
 # Команда /admin - админ панель
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Получаем user_id из разных источников
@@ -1252,72 +3520,31 @@ async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("🚫 У вас нет прав доступа")
         return
     
-    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, name FROM categories ORDER BY id')
-        categories = cursor.fetchall()
-        
-        text = "*Панель администратора*\n\n*Категории:*\n"
-        keyboard = []
-        
-        for cat_id, cat_name in categories:
-            text += f"\n{cat_name}\n"
-            cursor.execute('SELECT id, name, price, stock, product_type FROM products WHERE category_id = ?', (cat_id,))
-            products = cursor.fetchall()
-            
-            for prod_id, prod_name, price, stock, prod_type in products:
-                stock_emoji = "🟢" if stock > 0 else "🔴"
-                type_emoji = {
-                    'fixed': '📦',
-                    'stars': '⭐',
-                    'steam': '🎮'
-                }.get(prod_type, '❓')
-                text += f"  {type_emoji} {prod_name} - {price}$ {stock_emoji} ({stock} шт.)\n"
-                
-                keyboard.append([
-                    InlineKeyboardButton(f"✏️ {prod_name[:15]}", callback_data=f"edit_{prod_id}"),
-                    InlineKeyboardButton(f"🗑️", callback_data=f"delete_{prod_id}")
-                ])
-        
-        # Получаем коэффициенты для отображения
-        coefficients = get_all_coefficients()
-        text += "\n*Коэффициенты:*\n"
-        for coeff_type, data in coefficients.items():
-            value = data['value']
-            description = data['description'] or coeff_type
-            
-            if coeff_type == 'stars':
-                text += f"Telegram Stars: {value}\n"
-            elif coeff_type == 'steam':
-                percentage = round((value - 1) * 100, 1)
-                text += f"Steam комиссия: +{percentage}% (коэф: {value})\n"
-            elif coeff_type == 'exchange_rate':
-                text += f"Курс USDT: {value} руб\n"
-        
-        text += f"\n*Комиссия CryptoBot:* {CRYPTOBOT_FEE*100}%\n"
-        
-        keyboard.append([InlineKeyboardButton("➕ Добавить товар", callback_data="add_menu")])
-        keyboard.append([InlineKeyboardButton("⚙️ Настройки коэффициентов", callback_data="coefficients_menu")])
-        keyboard.append([InlineKeyboardButton("📊 Статистика", callback_data="stats")])
-        keyboard.append([InlineKeyboardButton("🚫 Управление банами", callback_data="bans_menu")])
-        keyboard.append([InlineKeyboardButton("📢 Рассылка", callback_data="broadcast_info")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        if update.callback_query:
-            await update.callback_query.edit_message_text(text, parse_mode='Markdown', reply_markup=reply_markup)
-        else:
-            await update.message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
-        
+        await _show_admin_panel(update)
     except Exception as e:
         logger.error(f"Ошибка в админ-панели: {e}")
         if update.callback_query:
             await update.callback_query.edit_message_text("❌ Ошибка загрузки")
         else:
             await update.message.reply_text("❌ Ошибка загрузки")
-    finally:
-        conn.close()
+
+# Листание товаров в админке
+async def admin_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    if query.from_user.id != ADMIN_ID:
+        return
+    
+    # admin_page_{next|prev}_{category_id}_{product_id}
+    _, _, direction, category_id, product_id = query.data.split('_')
+    
+    try:
+        await _show_admin_panel(update, direction, (int(category_id), int(product_id)))
+    except Exception as e:
+        logger.error(f"Ошибка в админ-панели: {e}")
+        await query.edit_message_text("❌ Ошибка загрузки")
 
 # Меню коэффициентов
 async def coefficients_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1397,7 +3624,7 @@ async def add_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if query.from_user.id != ADMIN_ID:
         return
     
-    categories = get_all_categories()
+    categories = await get_all_categories()
     keyboard = []
     
     for cat_id, name, description in categories:
@@ -1421,11 +3648,7 @@ async def handle_add_category(update: Update, context: ContextTypes.DEFAULT_TYPE
         category_id = int(data[8:])
         context.user_data['add_to_cat'] = category_id
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT name FROM categories WHERE id = ?', (category_id,))
-        cat_name = cursor.fetchone()[0]
-        conn.close()
+        cat_name = (await db.fetchone('SELECT name FROM categories WHERE id = ?', (category_id,)))[0]
         
         await query.edit_message_text(
             f"*Добавление товара в категорию:* {cat_name}\n\n"
@@ -1473,6 +3696,24 @@ async def handle_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text("❌ Товар не найден")
 
 # Удаление товара
+def _delete_product(conn, product_id):
+    cursor = conn.cursor()
+    cursor.execute('SELECT name, stock, is_active FROM products WHERE id = ?', (product_id,))
+    product = cursor.fetchone()
+    
+    if not product:
+        return None
+    
+    name, stock, is_active = product
+    # Резервы удалённого товара возвращать некуда: снимаем их в той же транзакции
+    cursor.execute('''
+        UPDATE stock_reservations SET status = 'released' WHERE product_id = ? AND status = 'active'
+    ''', (product_id,))
+    cursor.execute('DELETE FROM products WHERE id = ?', (product_id,))
+    if is_active:
+        bump_counters(cursor, active_products=-1, total_stock=-stock)
+    return (name,)
+
 async def handle_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -1484,24 +3725,18 @@ async def handle_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith('delete_'):
         product_id = int(data[7:])
         
-        conn = get_db_connection()
         try:
-            cursor = conn.cursor()
-            cursor.execute('SELECT name FROM products WHERE id = ?', (product_id,))
-            product_name = cursor.fetchone()
+            product_name = await db.write(_delete_product, product_id)
+            await reload_catalog()
             
             if product_name:
-                cursor.execute('DELETE FROM products WHERE id = ?', (product_id,))
-                conn.commit()
                 await query.edit_message_text(f"✅ Товар '{product_name[0]}' удален!")
             else:
                 await query.edit_message_text("❌ Товар не найден")
                 
         except Exception as e:
             logger.error(f"Ошибка удаления: {e}")
-            await query.edit_message_text(f"❌ Ошибка: {e}")
-        finally:
-            conn.close()
+            await query.edit_message_text(f"❌ Ошибка: {e}")
 
 # Назад в админку
 async def admin_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1514,6 +3749,13 @@ async def admin_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await admin(update, context)
 
 # Статистика
+def _load_shop_stats(conn):
+    counters = read_counters(conn)
+    last_broadcast = conn.execute('''
+        SELECT id, sent, failed, total, status FROM broadcasts ORDER BY id DESC LIMIT 1
+    ''').fetchone()
+    return counters, last_broadcast
+
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -1521,44 +3763,297 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if query.from_user.id != ADMIN_ID:
         return
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    counters, last_broadcast = await db.read(_load_shop_stats)
+    total_revenue = counters.get('paid_revenue', 0)
+    total_with_fee = counters.get('paid_with_fee', 0)
+    total_users = int(counters.get('users_total', 0))
+    reachable = int(counters.get('users_reachable', 0))
     
-    cursor.execute('SELECT COUNT(*) FROM products WHERE is_active = 1')
-    active_products = cursor.fetchone()[0]
+    stats_text = (
+        "*Статистика магазина*\n\n"
+        f"Активных товаров: {int(counters.get('active_products', 0))}\n"
+        f"Общий остаток: {int(counters.get('total_stock', 0))} шт.\n"
+        f"Оплаченных заказов: {int(counters.get('paid_orders', 0))}\n"
+        f"Выручка (без комиссии): {total_revenue:.2f} USDT\n"
+        f"Получено с комиссией: {total_with_fee:.2f} USDT\n"
+        f"Комиссия CryptoBot: {total_with_fee - total_revenue:.2f} USDT\n"
+        f"Зарегистрировано пользователей: {total_users}\n\n"
+        "*Аудитория рассылок*\n"
+        f"Доступны: {reachable}"
+        f" ({reachable / total_users * 100 if total_users else 0:.1f}%)\n"
+        f"Недоступны: {total_users - reachable}"
+    )
+    if last_broadcast:
+        broadcast_id, sent, failed, total, status = last_broadcast
+        state = "идёт" if status == 'running' else "завершена"
+        stats_text += (
+            f"\nПоследняя рассылка #{broadcast_id} ({state}): "
+            f"доставлено {sent}, не доставлено {failed} из {total}"
+        )
     
-    cursor.execute('SELECT SUM(stock) FROM products WHERE is_active = 1')
-    total_stock = cursor.fetchone()[0] or 0
+    keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="admin_back")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
     
-    cursor.execute('SELECT COUNT(*) FROM orders WHERE status = "paid"')
-    paid_orders = cursor.fetchone()[0]
+    await query.edit_message_text(stats_text, parse_mode='Markdown', reply_markup=reply_markup)
+
+# === ДНЕВНЫЕ СВОДКИ ВЫРУЧКИ ===
+# Оплаченные заказы сворачиваются в таблицы по дням, товарам и категориям.
+# Проход инкрементальный: берутся заказы после водяного знака (paid_at, id),
+# сводки и водяной знак обновляются одной транзакцией. Отчёты читают только сводки
+
+def _roll_up_batch(conn, batch_size):
+    state = conn.execute(
+        "SELECT last_paid_at, last_order_id FROM rollup_state WHERE name = 'revenue'"
+    ).fetchone()
+    last_paid_at, last_order_id = state if state else ('', 0)
     
-    cursor.execute('SELECT SUM(price_amount) FROM orders WHERE status = "paid"')
-    total_revenue = cursor.fetchone()[0] or 0
+    rows = conn.execute('''
+        SELECT o.id, o.paid_at, o.product_id, o.product_name, p.product_type,
+               COALESCE(c.id, 0), COALESCE(c.name, 'Удалённые товары'),
+               COALESCE(o.price_amount, 0), COALESCE(o.price_with_fee, 0), COALESCE(o.custom_amount, 0)
+        FROM orders o
+        LEFT JOIN products p ON p.id = o.product_id
+        LEFT JOIN categories c ON c.id = p.category_id
+        WHERE o.status = 'paid' AND (o.paid_at > ? OR (o.paid_at = ? AND o.id > ?))
+        ORDER BY o.paid_at, o.id
+        LIMIT ?
+    ''', (last_paid_at, last_paid_at, last_order_id, batch_size)).fetchall()
+    if not rows:
+        return 0
     
-    cursor.execute('SELECT SUM(price_with_fee) FROM orders WHERE status = "paid"')
-    total_with_fee = cursor.fetchone()[0] or 0
+    days, products, categories = {}, {}, {}
+    for (order_id, paid_at, product_id, product_name, product_type,
+         category_id, category_name, price_amount, price_with_fee, custom_amount) in rows:
+        day = str(paid_at)[:10]
+        totals = (1, price_amount, price_with_fee, custom_amount)
+        for bucket, key, labels in (
+            (days, day, ()),
+            (products, (day, product_id), (product_name, product_type)),
+            (categories, (day, category_id), (category_name,)),
+        ):
+            current = bucket.get(key)
+            if current is None:
+                bucket[key] = [labels, *totals]
+            else:
+                for i, value in enumerate(totals, start=1):
+                    current[i] += value
     
-    cursor.execute('SELECT COUNT(*) FROM users')
-    total_users = cursor.fetchone()[0]
+    conn.executemany('''
+        INSERT INTO revenue_daily (day, orders, price_amount, price_with_fee, custom_amount)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(day) DO UPDATE SET
+            orders = orders + excluded.orders,
+            price_amount = price_amount + excluded.price_amount,
+            price_with_fee = price_with_fee + excluded.price_with_fee,
+            custom_amount = custom_amount + excluded.custom_amount
+    ''', [(day, *values) for day, (labels, *values) in days.items()])
+    conn.executemany('''
+        INSERT INTO revenue_daily_product
+        (day, product_id, product_name, product_type, orders, price_amount, price_with_fee, custom_amount)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(day, product_id) DO UPDATE SET
+            product_name = excluded.product_name,
+            product_type = COALESCE(excluded.product_type, product_type),
+            orders = orders + excluded.orders,
+            price_amount = price_amount + excluded.price_amount,
+            price_with_fee = price_with_fee + excluded.price_with_fee,
+            custom_amount = custom_amount + excluded.custom_amount
+    ''', [(day, product_id, *labels, *values) for (day, product_id), (labels, *values) in products.items()])
+    conn.executemany('''
+        INSERT INTO revenue_daily_category
+        (day, category_id, category_name, orders, price_amount, price_with_fee, custom_amount)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(day, category_id) DO UPDATE SET
+            category_name = excluded.category_name,
+            orders = orders + excluded.orders,
+            price_amount = price_amount + excluded.price_amount,
+            price_with_fee = price_with_fee + excluded.price_with_fee,
+            custom_amount = custom_amount + excluded.custom_amount
+    ''', [(day, category_id, *labels, *values) for (day, category_id), (labels, *values) in categories.items()])
     
-    conn.close()
+    last_order_id, last_paid_at = rows[-1][0], rows[-1][1]
+    conn.execute('''
+        INSERT INTO rollup_state (name, last_paid_at, last_order_id) VALUES ('revenue', ?, ?)
+        ON CONFLICT(name) DO UPDATE SET last_paid_at = excluded.last_paid_at, last_order_id = excluded.last_order_id
+    ''', (last_paid_at, last_order_id))
+    return len(rows)
+
+async def roll_up_revenue_now():
+    """Догоняет сводки до последнего оплаченного заказа; возвращает число учтённых заказов"""
+    processed = 0
+    while True:
+        count = await db.write(_roll_up_batch, ROLLUP_BATCH_SIZE)
+        processed += count
+        if count < ROLLUP_BATCH_SIZE:
+            return processed
+
+# Периодическое обновление сводок
+async def roll_up_revenue(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        processed = await roll_up_revenue_now()
+        if processed:
+            logger.info(f"📈 В сводки выручки добавлено заказов: {processed}")
+    except Exception as e:
+        logger.error(f"Ошибка обновления сводок выручки: {e}")
+
+def _load_revenue_report(conn, date_from, date_to):
+    days = conn.execute('''
+        SELECT day, orders, price_amount, price_with_fee FROM revenue_daily
+        WHERE day BETWEEN ? AND ? ORDER BY day
+    ''', (date_from, date_to)).fetchall()
+    products = conn.execute('''
+        SELECT product_name, product_type, SUM(orders), SUM(price_amount), SUM(custom_amount)
+        FROM revenue_daily_product
+        WHERE day BETWEEN ? AND ?
+        GROUP BY product_id
+        ORDER BY SUM(price_amount) DESC
+        LIMIT 10
+    ''', (date_from, date_to)).fetchall()
+    categories = conn.execute('''
+        SELECT category_name, SUM(orders), SUM(price_amount)
+        FROM revenue_daily_category
+        WHERE day BETWEEN ? AND ?
+        GROUP BY category_id
+        ORDER BY SUM(price_amount) DESC
+    ''', (date_from, date_to)).fetchall()
+    return days, products, categories
+
+def parse_report_range(args):
+    """(с, по) в формате YYYY-MM-DD из аргументов /report; по умолчанию последние REPORT_DEFAULT_DAYS дней"""
+    today = datetime.now().date()
+    if not args:
+        return (today - timedelta(days=REPORT_DEFAULT_DAYS - 1)).isoformat(), today.isoformat()
+    date_from = datetime.strptime(args[0], '%Y-%m-%d').date()
+    date_to = datetime.strptime(args[1], '%Y-%m-%d').date() if len(args) > 1 else today
+    if date_from > date_to:
+        date_from, date_to = date_to, date_from
+    return date_from.isoformat(), date_to.isoformat()
+
+# Команда /report [с] [по] - выручка за период по дневным сводкам
+async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("🚫 У вас нет прав доступа")
+        return
     
-    stats_text = (
-        "*Статистика магазина*\n\n"
-        f"Активных товаров: {active_products}\n"
-        f"Общий остаток: {total_stock} шт.\n"
-        f"Оплаченных заказов: {paid_orders}\n"
+    try:
+        date_from, date_to = parse_report_range(context.args)
+    except ValueError:
+        await update.message.reply_text(
+            "Использование: /report [с] [по]\n\n"
+            "Даты в формате ГГГГ-ММ-ДД, например:\n"
+            "/report 2024-05-01 2024-05-31\n"
+            f"Без аргументов — последние {REPORT_DEFAULT_DAYS} дней"
+        )
+        return
+    
+    try:
+        await roll_up_revenue_now()
+        days, products, categories = await db.read(_load_revenue_report, date_from, date_to)
+    except Exception as e:
+        logger.error(f"Ошибка построения отчёта: {e}")
+        await update.message.reply_text(f"❌ Ошибка: {e}")
+        return
+    
+    total_orders = sum(row[1] for row in days)
+    total_revenue = sum(row[2] for row in days)
+    total_with_fee = sum(row[3] for row in days)
+    
+    text = (
+        f"📈 Выручка {date_from} — {date_to}\n\n"
+        f"Заказов: {total_orders}\n"
         f"Выручка (без комиссии): {total_revenue:.2f} USDT\n"
         f"Получено с комиссией: {total_with_fee:.2f} USDT\n"
-        f"Комиссия CryptoBot: {total_with_fee - total_revenue:.2f} USDT\n"
-        f"Зарегистрировано пользователей: {total_users}"
     )
     
-    keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="admin_back")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    if categories:
+        text += "\nПо категориям:\n"
+        for name, orders, revenue in categories:
+            text += f"• {name}: {orders} шт., {revenue:.2f} USDT\n"
     
-    await query.edit_message_text(stats_text, parse_mode='Markdown', reply_markup=reply_markup)
+    if products:
+        text += "\nТоп товаров:\n"
+        units = {'stars': ' Stars', 'steam': '₽'}
+        for name, product_type, orders, revenue, custom_amount in products:
+            line = f"• {name}: {orders} шт., {revenue:.2f} USDT"
+            if product_type in units and custom_amount:
+                line += f" ({custom_amount:g}{units[product_type]})"
+            text += line + "\n"
+    
+    if days:
+        text += "\nПо дням:\n"
+        # Последние 31 день периода, чтобы уложиться в лимит сообщения
+        for day, orders, revenue, with_fee in days[-31:]:
+            text += f"{day}: {orders} шт., {revenue:.2f} USDT\n"
+    
+    await update.message.reply_text(text)
+
+# Команда /rebuild_stats - пересчёт счётчиков статистики с проверкой расхождений
+async def rebuild_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("🚫 У вас нет прав доступа")
+        return
+    
+    try:
+        drift = await db.write(rebuild_shop_counters)
+    except Exception as e:
+        logger.error(f"Ошибка пересчёта статистики: {e}")
+        await update.message.reply_text(f"❌ Ошибка: {e}")
+        return
+    
+    if not drift:
+        await update.message.reply_text("✅ Счётчики статистики пересчитаны, расхождений нет")
+        return
+    
+    logger.warning(f"Расхождение счётчиков статистики: {drift}")
+    lines = [f"• {name}: было {old:g}, стало {new:g}" for name, (old, new) in drift.items()]
+    await update.message.reply_text("⚠️ Счётчики пересчитаны, найдены расхождения:\n\n" + "\n".join(lines))
+
+# Команда /profile [on [доля] | off | dump | reset] - выборочное профилирование обработчиков
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("🚫 У вас нет прав доступа")
+        return
+    
+    action = context.args[0].lower() if context.args else ''
+    try:
+        if action == 'on':
+            if len(context.args) > 1:
+                rate = float(context.args[1])
+                if not 0 < rate <= 1:
+                    raise ValueError("доля должна быть от 0 до 1")
+                profiler.sample_rate = rate
+            profiler.enabled = True
+        elif action == 'off':
+            profiler.enabled = False
+            await profiler.dump()
+        elif action == 'dump':
+            directory = await profiler.dump()
+            if directory is None:
+                await update.message.reply_text("📭 Новых трасс нет")
+                return
+        elif action == 'reset':
+            profiler.reset()
+        elif action:
+            await update.message.reply_text("Использование: /profile [on [доля] | off | dump | reset]")
+            return
+    except ValueError as e:
+        await update.message.reply_text(f"❌ Ошибка: {e}")
+        return
+    
+    state = "🟢 включено" if profiler.enabled else "🔴 выключено"
+    await update.message.reply_text(
+        f"🔬 Профилирование: {state}\n"
+        f"Доля обновлений: {profiler.sample_rate:.1%}\n"
+        f"Записано трасс: {profiler.traces}\n"
+        f"Дамп: {PROFILES_DIR}"
+    )
+
+# Периодический дамп трасс, пока профилирование включено
+async def dump_profiles(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await profiler.dump()
+    except Exception as e:
+        logger.error(f"Ошибка записи профиля: {e}")
 
 # Меню банов
 async def bans_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1573,11 +4068,16 @@ async def bans_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "*Команды:*\n"
         "• /ban @username [причина] - забанить\n"
         "• /unban @username - разбанить\n"
-        "• /banned - список забаненных\n\n"
+        "• /banned - список забаненных\n"
+        "• /orders <user_id | @username | номер> - заказы\n\n"
         "*Примеры:*\n"
         "/ban @username Спам\n"
         "/ban 123456789\n"
-        "/unban @username"
+        "/unban @username\n\n"
+        "*Кэш банов:*\n"
+        f"В памяти: {len(ban_cache)}\n"
+        f"Проверок: {ban_cache.checks}, совпадений: {ban_cache.hits} ({ban_cache.hit_rate:.2%})\n"
+        f"Расхождений с базой: {ban_cache.drift_events}"
     )
     
     keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="admin_back")]]
@@ -1598,7 +4098,9 @@ async def broadcast_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Используйте команду:\n"
         "/broadcast Ваше сообщение\n\n"
         "*Пример:*\n"
-        "/broadcast Всем привет! Новые товары в наличии!"
+        "/broadcast Всем привет! Новые товары в наличии!\n\n"
+        "Пользователи, заблокировавшие бота, пропускаются. "
+        "Чтобы отправить всем: /broadcast --all Ваше сообщение"
     )
     
     keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="admin_back")]]
@@ -1607,6 +4109,38 @@ async def broadcast_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.edit_message_text(text, parse_mode='Markdown', reply_markup=reply_markup)
 
 # Обработчик текстовых сообщений для админа
+def _update_product(conn, product_id, name, price, description, stock, product_type):
+    cursor = conn.cursor()
+    
+    # Получаем старое название
+    cursor.execute('SELECT name, stock, is_active FROM products WHERE id = ?', (product_id,))
+    old_name, old_stock, is_active = cursor.fetchone()
+    
+    # Админ вводит полное количество, а товар под неоплаченными заказами уже списан
+    # со склада и вернётся при снятии резерва: храним количество за вычетом резервов
+    cursor.execute('''
+        SELECT COALESCE(SUM(quantity), 0) FROM stock_reservations
+        WHERE product_id = ? AND status = 'active'
+    ''', (product_id,))
+    reserved = cursor.fetchone()[0]
+    available = max(stock - reserved, 0)
+    
+    cursor.execute('''
+        UPDATE products 
+        SET name = ?, price = ?, description = ?, stock = ?, product_type = ?
+        WHERE id = ?
+    ''', (name, price, description, available, product_type, product_id))
+    if is_active:
+        bump_counters(cursor, total_stock=available - old_stock)
+    return old_name, reserved
+
+def _add_product(conn, category_id, name, price, description, stock, product_type):
+    conn.execute('''
+        INSERT INTO products (category_id, name, price, description, stock, product_type)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (category_id, name, price, description, stock, product_type))
+    bump_counters(conn, active_products=1, total_stock=stock)
+
 async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.from_user.id != ADMIN_ID:
         return
@@ -1635,7 +4169,7 @@ async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             old_value = get_coefficient(coeff_type)
             
-            if update_coefficient(coeff_type, new_value):
+            if await update_coefficient(coeff_type, new_value):
                 # Форматируем сообщение в зависимости от типа
                 if coeff_type == 'stars':
                     message = f"*Коэффициент Telegram Stars изменен!*\n\nБыло: {old_value}\nСтало: {new_value}"
@@ -1681,16 +4215,8 @@ async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     await update.message.reply_text("❌ Неверный тип. Используйте: fixed, stars или steam")
                     return
                 
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                
-                cursor.execute('''
-                    INSERT INTO products (category_id, name, price, description, stock, product_type)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (category_id, name, price, description, stock, product_type))
-                
-                conn.commit()
-                conn.close()
+                await db.write(_add_product, category_id, name, price, description, stock, product_type)
+                await reload_catalog()
                 
                 del context.user_data['add_to_cat']
                 
@@ -1744,21 +4270,10 @@ async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     await update.message.reply_text("❌ Неверный тип. Используйте: fixed, stars или steam")
                     return
                 
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                
-                # Получаем старое название
-                cursor.execute('SELECT name FROM products WHERE id = ?', (product_id,))
-                old_name = cursor.fetchone()[0]
-                
-                cursor.execute('''
-                    UPDATE products 
-                    SET name = ?, price = ?, description = ?, stock = ?, product_type = ?
-                    WHERE id = ?
-                ''', (new_name, new_price, new_description, new_stock, new_type, product_id))
-                
-                conn.commit()
-                conn.close()
+                old_name, reserved = await db.write(
+                    _update_product, product_id, new_name, new_price, new_description, new_stock, new_type
+                )
+                await reload_catalog()
                 
                 del context.user_data['edit_product']
                 
@@ -1768,7 +4283,8 @@ async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"Стало: {new_name}\n"
                     f"Цена: {new_price}$\n"
                     f"Описание: {new_description[:50]}...\n"
-                    f"Количество: {new_stock} шт.\n"
+                    f"Количество: {new_stock} шт."
+                    f"{f' (в резерве {reserved} шт.)' if reserved else ''}\n"
                     f"Тип: {new_type}",
                     parse_mode='Markdown'
                 )
@@ -1829,43 +4345,45 @@ async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reason = " ".join(context.args[1:]) if len(context.args) > 1 else "Администратор"
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
         if target.isdigit():
             user_id = int(target)
-            cursor.execute('SELECT username, first_name FROM users WHERE user_id = ?', (user_id,))
-            user_data = cursor.fetchone()
+            user_data = await db.fetchone('SELECT username, first_name FROM users WHERE user_id = ?', (user_id,))
             
             if user_data:
                 username, first_name = user_data
-                cursor.execute('INSERT OR IGNORE INTO banned_users (user_id, username, first_name, banned_by, banned_at, reason) VALUES (?, ?, ?, ?, ?, ?)',
-                              (user_id, username, first_name, ADMIN_ID, datetime.now(), reason))
+                await db.execute('INSERT OR IGNORE INTO banned_users (user_id, username, first_name, banned_by, banned_at, reason) VALUES (?, ?, ?, ?, ?, ?)',
+                                 (user_id, username, first_name, ADMIN_ID, datetime.now(), reason))
+                ban_cache.add(user_id)
                 await update.message.reply_text(f"✅ Пользователь @{username} (ID: {user_id}) забанен!\nПричина: {reason}")
             else:
-                cursor.execute('INSERT OR IGNORE INTO banned_users (user_id, username, first_name, banned_by, banned_at, reason) VALUES (?, ?, ?, ?, ?, ?)',
-                              (user_id, 'Unknown', 'Unknown User', ADMIN_ID, datetime.now(), reason))
+                await db.execute('INSERT OR IGNORE INTO banned_users (user_id, username, first_name, banned_by, banned_at, reason) VALUES (?, ?, ?, ?, ?, ?)',
+                                 (user_id, 'Unknown', 'Unknown User', ADMIN_ID, datetime.now(), reason))
+                ban_cache.add(user_id)
                 await update.message.reply_text(f"✅ Пользователь (ID: {user_id}) забанен!\nПричина: {reason}")
         
         elif target.startswith('@'):
             username = target[1:]
-            cursor.execute('SELECT user_id, first_name FROM users WHERE username = ?', (username,))
-            user_data = cursor.fetchone()
+            user_data = await db.fetchone('SELECT user_id, first_name FROM users WHERE username = ?', (username,))
             
             if user_data:
                 user_id, first_name = user_data
-                cursor.execute('INSERT OR IGNORE INTO banned_users (user_id, username, first_name, banned_by, banned_at, reason) VALUES (?, ?, ?, ?, ?, ?)',
-                              (user_id, username, first_name, ADMIN_ID, datetime.now(), reason))
+                await db.execute('INSERT OR IGNORE INTO banned_users (user_id, username, first_name, banned_by, banned_at, reason) VALUES (?, ?, ?, ?, ?, ?)',
+                                 (user_id, username, first_name, ADMIN_ID, datetime.now(), reason))
+                ban_cache.add(user_id)
                 await update.message.reply_text(f"✅ Пользователь @{username} (ID: {user_id}) забанен!\nПричина: {reason}")
             else:
                 await update.message.reply_text(f"❌ Пользователь {target} не найден в базе")
         
-        conn.commit()
-        
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {e}")
-    finally:
-        conn.close()
+
+def _delete_bans(conn, column, value):
+    """Удаляет баны по user_id или username и возвращает снятые user_id"""
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT user_id FROM banned_users WHERE {column} = ?', (value,))
+    user_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute(f'DELETE FROM banned_users WHERE {column} = ?', (value,))
+    return user_ids
 
 async def unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.from_user.id != ADMIN_ID:
@@ -1879,26 +4397,45 @@ async def unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target = context.args[0]
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
+        unbanned_ids = []
         if target.isdigit():
-            cursor.execute('DELETE FROM banned_users WHERE user_id = ?', (int(target),))
+            unbanned_ids = await db.write(_delete_bans, 'user_id', int(target))
         elif target.startswith('@'):
             username = target[1:]
-            cursor.execute('DELETE FROM banned_users WHERE username = ?', (username,))
+            unbanned_ids = await db.write(_delete_bans, 'username', username)
         
-        if cursor.rowcount > 0:
+        for user_id in unbanned_ids:
+            ban_cache.discard(user_id)
+        
+        if unbanned_ids:
             await update.message.reply_text(f"✅ Пользователь {target} разбанен!")
         else:
             await update.message.reply_text(f"❌ Пользователь {target} не найден в списке забаненных")
         
-        conn.commit()
-        
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {e}")
-    finally:
-        conn.close()
+
+# Новые баны идут первыми; курсор страницы — id последнего показанного бана
+BANNED_LIST_SQL = '''
+    SELECT id, user_id, username, first_name, strftime('%d.%m.%Y %H:%M', banned_at), reason
+    FROM banned_users
+    WHERE id < ?
+    ORDER BY id DESC
+'''
+
+def _render_banned_user(row):
+    ban_id, user_id, username, first_name, banned_date, reason = row
+    username_display = f"@{username}" if username else "Нет username"
+    return f"• {first_name} ({username_display})\n  ID: {user_id}\n  Забанен: {banned_date}\n  Причина: {reason}\n\n"
+
+async def _show_banned_page(update: Update, before_id):
+    await show_rows(
+        update, BANNED_LIST_SQL, (before_id or sys.maxsize,), _render_banned_user,
+        "*Забаненные пользователи:*\n\n", "📋 Список забаненных пользователей пуст",
+        next_page=lambda row: f"banned_page_{row[0]}",
+        first_page="banned_page_0" if before_id else None,
+        max_messages=1
+    )
 
 async def banned_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.from_user.id != ADMIN_ID:
@@ -1906,81 +4443,451 @@ async def banned_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id, username, first_name, banned_at, reason FROM banned_users ORDER BY banned_at DESC')
-        banned_users = cursor.fetchall()
-        
-        if not banned_users:
-            await update.message.reply_text("📋 Список забаненных пользователей пуст")
-            return
-        
-        text = "*Забаненные пользователи:*\n\n"
-        for user in banned_users:
-            user_id, username, first_name, banned_at, reason = user
-            username_display = f"@{username}" if username else "Нет username"
-            banned_date = datetime.strptime(banned_at, '%Y-%m-%d %H:%M:%S').strftime('%d.%m.%Y %H:%M') if isinstance(banned_at, str) else banned_at.strftime('%d.%m.%Y %H:%M')
-            text += f"• {first_name} ({username_display})\n  ID: {user_id}\n  Забанен: {banned_date}\n  Причина: {reason}\n\n"
-        
-        await update.message.reply_text(text, parse_mode='Markdown')
-        
+        await _show_banned_page(update, 0)
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {e}")
-    finally:
-        conn.close()
 
-# Команда /broadcast
-async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def banned_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    if query.from_user.id != ADMIN_ID:
+        return
+    
+    try:
+        await _show_banned_page(update, int(query.data[len('banned_page_'):]))
+    except Exception as e:
+        logger.error(f"Ошибка списка банов: {e}")
+
+# === ПОИСК ЗАКАЗОВ ===
+# /orders показывает заказы пользователя от новых к старым (индекс idx_orders_user_id_id)
+# или один заказ по номеру; курсор страницы — id последнего показанного заказа
+
+ORDER_STATUS_TEXT = {
+    'pending': '⏳ ожидает оплаты',
+    'paid': '✅ оплачен',
+    'expired': '⌛ истёк'
+}
+
+ORDERS_BY_USER_SQL = '''
+    SELECT id, invoice_id, product_name, custom_amount, price_with_fee, status,
+           strftime('%d.%m.%Y %H:%M', created_at), strftime('%d.%m.%Y %H:%M', paid_at)
+    FROM orders
+    WHERE user_id = ? AND id < ?
+    ORDER BY id DESC
+'''
+
+ORDERS_BY_INVOICE_SQL = '''
+    SELECT id, invoice_id, product_name, custom_amount, price_with_fee, status,
+           strftime('%d.%m.%Y %H:%M', created_at), strftime('%d.%m.%Y %H:%M', paid_at)
+    FROM orders
+    WHERE invoice_id = ?
+'''
+
+def _render_order(row):
+    order_id, invoice_id, product_name, custom_amount, price_with_fee, status, created_at, paid_at = row
+    amount = f" ({custom_amount:g})" if custom_amount else ""
+    text = f"• `{invoice_id}`\n  {product_name}{amount} - {price_with_fee} USDT\n"
+    text += f"  {ORDER_STATUS_TEXT.get(status, status)}, создан {created_at}"
+    if paid_at:
+        text += f", оплачен {paid_at}"
+    return text + "\n\n"
+
+async def _show_user_orders(update: Update, user_id, before_id):
+    await show_rows(
+        update, ORDERS_BY_USER_SQL, (user_id, before_id or sys.maxsize), _render_order,
+        f"*Заказы пользователя* `{user_id}`*:*\n\n", f"📭 У пользователя {user_id} нет заказов",
+        next_page=lambda row: f"orders_page_{user_id}_{row[0]}",
+        first_page=f"orders_page_{user_id}_0" if before_id else None
+    )
+
+# Команда /orders <user_id | @username | номер заказа> - поиск заказов
+async def orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.from_user.id != ADMIN_ID:
         await update.message.reply_text("🚫 У вас нет прав доступа")
         return
     
     if not context.args:
-        await update.message.reply_text("Использование: /broadcast ваше сообщение")
+        await update.message.reply_text(
+            "Использование: /orders <user_id | @username | номер заказа>\n\n"
+            "Примеры:\n"
+            "/orders 123456789\n"
+            "/orders @username\n"
+            "/orders INV_1_123456789_20240101120000_1a2b3c4d"
+        )
         return
     
-    message = " ".join(context.args)
+    target = context.args[0]
+    try:
+        if target.isdigit():
+            await _show_user_orders(update, int(target), 0)
+        elif target.startswith('@'):
+            row = await db.fetchone('SELECT user_id FROM users WHERE username = ?', (target[1:],))
+            if not row:
+                await update.message.reply_text(f"❌ Пользователь {target} не найден")
+                return
+            await _show_user_orders(update, row[0], 0)
+        else:
+            await show_rows(
+                update, ORDERS_BY_INVOICE_SQL, (target,), _render_order,
+                "*Заказ:*\n\n", f"📭 Заказ {target} не найден"
+            )
+    except Exception as e:
+        await update.message.reply_text(f"❌ Ошибка: {e}")
+
+async def orders_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    if query.from_user.id != ADMIN_ID:
+        return
     
+    # orders_page_{user_id}_{order_id}
+    _, _, user_id, before_id = query.data.split('_')
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT DISTINCT user_id FROM users')
-        users = cursor.fetchall()
-        
-        total = len(users)
-        success = 0
-        failed = 0
-        
-        await update.message.reply_text(f"📢 Начинаю рассылку для {total} пользователей...")
-        
-        for user in users:
-            user_id = user[0]
+        await _show_user_orders(update, int(user_id), int(before_id))
+    except Exception as e:
+        logger.error(f"Ошибка поиска заказов: {e}")
+
+# === РАССЫЛКА ===
+# Рассылка идёт фоновой задачей: отправки ограничены общим token bucket (TokenBucket) (лимит Bot API
+# ~30 сообщений/с) и семафором, RetryAfter ставит на паузу всю рассылку.
+# Получатели читаются пачками по возрастанию user_id; после каждой пачки в broadcasts
+# сохраняется последний обработанный user_id, с него рассылка продолжается после перезапуска
+
+# Ошибки, после которых чат считается недоступным до следующего сообщения от пользователя
+UNREACHABLE_ERRORS = ('chat not found', 'user is deactivated', 'bot was blocked', 'bot was kicked')
+
+def delivery_failure(error):
+    """(причина, чат недоступен) для ошибки отправки"""
+    reason = str(error)[:200]
+    if isinstance(error, Forbidden):
+        return reason, True
+    if isinstance(error, BadRequest) and any(marker in reason.lower() for marker in UNREACHABLE_ERRORS):
+        return reason, True
+    return reason, False
+
+def _broadcast_recipients_sql(include_unreachable):
+    where = 'user_id > ?' if include_unreachable else 'is_reachable = 1 AND user_id > ?'
+    return f'SELECT user_id FROM users WHERE {where} ORDER BY user_id LIMIT ?'
+
+def _create_broadcast(conn, text, admin_chat_id, created_at, include_unreachable):
+    if include_unreachable:
+        total = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    else:
+        total = conn.execute('SELECT COUNT(*) FROM users WHERE is_reachable = 1').fetchone()[0]
+    cursor = conn.execute('''
+        INSERT INTO broadcasts
+        (text, status, admin_chat_id, total, sent, failed, last_user_id, include_unreachable, created_at, updated_at)
+        VALUES (?, 'running', ?, ?, 0, 0, 0, ?, ?, ?)
+    ''', (text, admin_chat_id, total, int(include_unreachable), created_at, created_at))
+    return cursor.lastrowid, total
+
+def _set_users_reachable(conn, user_ids, reachable):
+    """Меняет флаг доступности и счётчик users_reachable; только для реально изменившихся строк"""
+    changed = conn.executemany(
+        'UPDATE users SET is_reachable = ? WHERE user_id = ? AND is_reachable = ?',
+        [(int(reachable), user_id, int(not reachable)) for user_id in user_ids]
+    ).rowcount
+    bump_counters(conn, users_reachable=changed if reachable else -changed)
+
+def _record_deliveries(conn, deliveries, delivered_at):
+    delivered = [user_id for user_id, reason, unreachable in deliveries if reason is None]
+    failed = [(reason, user_id) for user_id, reason, unreachable in deliveries if reason is not None]
+    conn.executemany(
+        'UPDATE users SET last_delivery_at = ?, last_failure_reason = NULL WHERE user_id = ?',
+        [(delivered_at, user_id) for user_id in delivered]
+    )
+    conn.executemany('UPDATE users SET last_failure_reason = ? WHERE user_id = ?', failed)
+    _set_users_reachable(conn, delivered, True)
+    # Временные ошибки (сеть, лимиты) не лишают пользователя рассылок
+    _set_users_reachable(conn, [user_id for user_id, reason, unreachable in deliveries if unreachable], False)
+
+def _save_broadcast_progress(conn, broadcast_id, last_user_id, sent, failed, status, deliveries=()):
+    now = datetime.now()
+    _record_deliveries(conn, deliveries, now)
+    conn.execute('''
+        UPDATE broadcasts
+        SET last_user_id = ?, sent = ?, failed = ?, status = ?, updated_at = ?,
+            finished_at = CASE WHEN ? = 'running' THEN NULL ELSE ? END
+        WHERE id = ?
+    ''', (last_user_id, sent, failed, status, now, status, now, broadcast_id))
+
+class BroadcastEngine:
+    """Фоновая рассылка с ограничением скорости и продолжением после перезапуска"""
+    
+    def __init__(self, rate, burst, concurrency, batch_size, progress_interval):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self._task = None
+        self.current = None
+    
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+    
+    async def start(self, bot, admin_chat_id, text, include_unreachable=False):
+        """Создаёт рассылку и запускает её в фоне; None, если уже идёт другая"""
+        if self.running:
+            return None
+        broadcast_id, total = await db.write(
+            _create_broadcast, text, admin_chat_id, datetime.now(), include_unreachable
+        )
+        progress = await bot.send_message(
+            chat_id=admin_chat_id,
+            text=f"📢 Рассылка #{broadcast_id} запущена: 0/{total}"
+        )
+        await db.execute(
+            'UPDATE broadcasts SET progress_message_id = ? WHERE id = ?', (progress.message_id, broadcast_id)
+        )
+        self._launch(bot, {
+            'id': broadcast_id, 'text': text, 'admin_chat_id': admin_chat_id,
+            'progress_message_id': progress.message_id, 'total': total,
+            'sent': 0, 'failed': 0, 'last_user_id': 0, 'include_unreachable': include_unreachable
+        })
+        return broadcast_id
+    
+    async def resume(self, bot):
+        """Продолжает рассылку, прерванную остановкой бота"""
+        row = await db.fetchone('''
+            SELECT id, text, admin_chat_id, progress_message_id, total, sent, failed, last_user_id, include_unreachable
+            FROM broadcasts WHERE status = 'running' ORDER BY id DESC LIMIT 1
+        ''')
+        if row is None or self.running:
+            return
+        keys = (
+            'id', 'text', 'admin_chat_id', 'progress_message_id', 'total', 'sent', 'failed', 'last_user_id',
+            'include_unreachable'
+        )
+        logger.info(f"📢 Продолжаем рассылку #{row[0]} с user_id > {row[7]}")
+        self._launch(bot, dict(zip(keys, row)))
+    
+    async def stop(self):
+        """Останавливает рассылку; прогресс уже сохранён, статус остаётся running"""
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+    
+    def _launch(self, bot, broadcast):
+        self.current = broadcast
+        # Не application.create_task: остановка приложения ждала бы конца рассылки
+        self._task = asyncio.create_task(self._run(bot, broadcast))
+    
+    async def _send(self, bot, user_id, text):
+        """(причина ошибки или None, чат недоступен)"""
+        for attempt in range(3):
+            await self.bucket.acquire()
             try:
-                await context.bot.send_message(
+                await bot.send_message(
                     chat_id=user_id,
-                    text=f"*Рассылка от администратора:*\n\n{message}",
+                    text=f"*Рассылка от администратора:*\n\n{text}",
                     parse_mode='Markdown'
                 )
-                success += 1
+                return None, False
+            except RetryAfter as e:
+                self.bucket.pause(e.retry_after)
             except Exception as e:
-                failed += 1
-                logger.error(f"Ошибка отправки пользователю {user_id}: {e}")
-            
-            await asyncio.sleep(0.05)
+                reason, unreachable = delivery_failure(e)
+                if not unreachable:
+                    logger.error(f"Ошибка отправки пользователю {user_id}: {e}")
+                return reason, unreachable
+        return 'RetryAfter', False
+    
+    async def _run(self, bot, broadcast):
+        # Задача копирует контекст обработчика /broadcast: без сброса вся рассылка
+        # писала бы span'ы в его трассу, уже закрытую профилировщиком
+        current_trace.set(None)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        last_progress = time.monotonic()
         
-        await update.message.reply_text(
-            f"*Рассылка завершена!*\n\n"
-            f"✅ Успешно: {success}\n"
-            f"❌ Не доставлено: {failed}\n"
-            f"📊 Всего: {total}",
-            parse_mode='Markdown'
-        )
+        async def deliver(user_id):
+            async with semaphore:
+                return await self._send(bot, user_id, broadcast['text'])
+        
+        recipients_sql = _broadcast_recipients_sql(broadcast['include_unreachable'])
         
+        try:
+            while True:
+                rows = await db.fetchall(recipients_sql, (broadcast['last_user_id'], self.batch_size))
+                if not rows:
+                    break
+                
+                tasks = [asyncio.create_task(deliver(user_id)) for user_id, in rows]
+                try:
+                    await asyncio.gather(*tasks)
+                except asyncio.CancelledError:
+                    # Засчитываем непрерывный префикс уже отправленных, остальные — после перезапуска
+                    for task in tasks:
+                        task.cancel()
+                    done = 0
+                    for task in tasks:
+                        if not task.done() or task.cancelled():
+                            break
+                        done += 1
+                    deliveries = self._account(broadcast, rows[:done], tasks[:done])
+                    await db.write(
+                        _save_broadcast_progress, broadcast['id'], broadcast['last_user_id'],
+                        broadcast['sent'], broadcast['failed'], 'running', deliveries
+                    )
+                    raise
+                
+                deliveries = self._account(broadcast, rows, tasks)
+                await db.write(
+                    _save_broadcast_progress, broadcast['id'], broadcast['last_user_id'],
+                    broadcast['sent'], broadcast['failed'], 'running', deliveries
+                )
+                
+                if time.monotonic() - last_progress >= self.progress_interval:
+                    last_progress = time.monotonic()
+                    await self._report(bot, broadcast, finished=False)
+            
+            await db.write(
+                _save_broadcast_progress, broadcast['id'], broadcast['last_user_id'],
+                broadcast['sent'], broadcast['failed'], 'done'
+            )
+            await self._report(bot, broadcast, finished=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка рассылки #{broadcast['id']}: {e}")
+    
+    @staticmethod
+    def _account(broadcast, rows, tasks):
+        deliveries = []
+        for (user_id,), task in zip(rows, tasks):
+            reason, unreachable = task.result()
+            if reason is None:
+                broadcast['sent'] += 1
+            else:
+                broadcast['failed'] += 1
+            broadcast['last_user_id'] = user_id
+            deliveries.append((user_id, reason, unreachable))
+        return deliveries
+    
+    async def _report(self, bot, broadcast, finished):
+        processed = broadcast['sent'] + broadcast['failed']
+        if finished:
+            text = (
+                f"*Рассылка #{broadcast['id']} завершена!*\n\n"
+                f"✅ Успешно: {broadcast['sent']}\n"
+                f"❌ Не доставлено: {broadcast['failed']}\n"
+                f"📊 Всего: {processed}"
+            )
+        else:
+            text = (
+                f"📢 *Рассылка #{broadcast['id']}:* {processed}/{broadcast['total']}\n\n"
+                f"✅ Успешно: {broadcast['sent']}\n"
+                f"❌ Не доставлено: {broadcast['failed']}"
+            )
+        try:
+            await bot.edit_message_text(
+                chat_id=broadcast['admin_chat_id'],
+                message_id=broadcast['progress_message_id'],
+                text=text,
+                parse_mode='Markdown'
+            )
+        except Exception as e:
+            logger.error(f"Ошибка обновления прогресса рассылки: {e}")
+
+# Пользователь заблокировал или разблокировал бота в личном чате
+async def handle_bot_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    member_update = update.my_chat_member
+    if member_update.chat.type != 'private':
+        return
+    reachable = member_update.new_chat_member.status not in ('kicked', 'left')
+    user_id = member_update.chat.id
+    
+    def update_reachability(conn):
+        conn.execute(
+            'UPDATE users SET last_failure_reason = ? WHERE user_id = ?',
+            (None if reachable else 'bot was blocked by the user', user_id)
+        )
+        _set_users_reachable(conn, [user_id], reachable)
+    
+    try:
+        await db.write(update_reachability)
+    except Exception as e:
+        logger.error(f"Ошибка обновления доступности пользователя: {e}")
+
+broadcast_engine = BroadcastEngine(
+    BROADCAST_RATE, BROADCAST_BURST, BROADCAST_CONCURRENCY, BROADCAST_BATCH_SIZE, BROADCAST_PROGRESS_INTERVAL
+)
+
+# Команда /broadcast
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("🚫 У вас нет прав доступа")
+        return
+    
+    # --all: отправить и тем, кто ранее заблокировал бота
+    args = list(context.args)
+    include_unreachable = bool(args) and args[0] == '--all'
+    if include_unreachable:
+        args = args[1:]
+    
+    if not args:
+        await update.message.reply_text("Использование: /broadcast [--all] ваше сообщение")
+        return
+    
+    message = " ".join(args)
+    
+    try:
+        broadcast_id = await broadcast_engine.start(
+            context.bot, update.effective_chat.id, message, include_unreachable
+        )
+        if broadcast_id is None:
+            await update.message.reply_text("⚠️ Дождитесь окончания текущей рассылки")
     except Exception as e:
         logger.error(f"Ошибка рассылки: {e}")
         await update.message.reply_text(f"❌ Ошибка: {e}")
-    finally:
-        conn.close()
+
+# Запуск фоновых сервисов после инициализации бота
+async def on_startup(application):
+    global webhook_server, metrics_server
+    
+    await ban_cache.load()
+    snapshot = await catalog.reload()
+    logger.info(f"🛍️ Каталог загружен: {len(snapshot.products)} товаров")
+    expiry_scheduler.start(application.job_queue)
+    await broadcast_engine.resume(application.bot)
+    
+    if CRYPTOBOT_WEBHOOK_ENABLED:
+        webhook_server = LocalHTTPServer(CRYPTOBOT_WEBHOOK_HOST, CRYPTOBOT_WEBHOOK_PORT)
+        webhook_server.add_route(
+            CRYPTOBOT_WEBHOOK_PATH,
+            lambda request: handle_cryptobot_webhook(application, request)
+        )
+        await webhook_server.start()
+    
+    if METRICS_ENABLED:
+        if webhook_server is not None and (CRYPTOBOT_WEBHOOK_HOST, CRYPTOBOT_WEBHOOK_PORT) == (METRICS_HOST, METRICS_PORT):
+            webhook_server.add_route(METRICS_PATH, handle_metrics)
+        else:
+            metrics_server = LocalHTTPServer(METRICS_HOST, METRICS_PORT)
+            metrics_server.add_route(METRICS_PATH, handle_metrics)
+            await metrics_server.start()
+        loop_lag_monitor.start()
+
+# Остановка рассылки, пока бот ещё может отправлять сообщения
+async def on_stop(application):
+    await broadcast_engine.stop()
+
+# Закрытие ресурсов при остановке бота
+async def on_shutdown(application):
+    if webhook_server is not None:
+        await webhook_server.stop()
+    if metrics_server is not None:
+        await metrics_server.stop()
+    await loop_lag_monitor.stop()
+    await user_activity.flush()
+    await profiler.dump()
+    await cryptobot.close()
+    db.close()
 
 def main():
     print("=" * 50)
@@ -1992,9 +4899,20 @@ def main():
     
     # Инициализация базы данных
     init_db()
+    pricing.load()
     
     # Создание приложения
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .request(ProfilingRequest(connection_pool_size=BOT_CONNECTION_POOL_SIZE))
+        .concurrent_updates(update_processor)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Основные команды
     application.add_handler(CommandHandler("start", start))
@@ -2007,10 +4925,14 @@ def main():
     application.add_handler(CommandHandler("ban", ban_user))
     application.add_handler(CommandHandler("unban", unban_user))
     application.add_handler(CommandHandler("banned", banned_list))
+    application.add_handler(CommandHandler("orders", orders))
     application.add_handler(CommandHandler("broadcast", broadcast))
+    application.add_handler(CommandHandler("rebuild_stats", rebuild_stats))
+    application.add_handler(CommandHandler("report", report))
+    application.add_handler(CommandHandler("profile", profile))
     
     # Обработчики callback
-    application.add_handler(CallbackQueryHandler(handle_category_selection, pattern="^cat_"))
+    application.add_handler(CallbackQueryHandler(handle_category_selection, pattern="^(cat|catpage)_"))
     application.add_handler(CallbackQueryHandler(handle_back_to_categories, pattern="^back_to_categories$"))
     application.add_handler(CallbackQueryHandler(handle_product_selection, pattern="^buy_"))
     application.add_handler(CallbackQueryHandler(check_payment, pattern="^check_"))
@@ -2023,15 +4945,47 @@ def main():
     application.add_handler(CallbackQueryHandler(handle_edit, pattern="^edit_"))
     application.add_handler(CallbackQueryHandler(handle_delete, pattern="^delete_"))
     application.add_handler(CallbackQueryHandler(admin_back, pattern="^admin_back$"))
+    application.add_handler(CallbackQueryHandler(admin_page, pattern="^admin_page_(next|prev)_"))
+    application.add_handler(CallbackQueryHandler(banned_page, pattern="^banned_page_"))
+    application.add_handler(CallbackQueryHandler(orders_page, pattern="^orders_page_"))
     application.add_handler(CallbackQueryHandler(stats, pattern="^stats$"))
     application.add_handler(CallbackQueryHandler(bans_menu, pattern="^bans_menu$"))
     application.add_handler(CallbackQueryHandler(broadcast_info, pattern="^broadcast_info$"))
     application.add_handler(CallbackQueryHandler(coefficients_menu, pattern="^coefficients_menu$"))
     application.add_handler(CallbackQueryHandler(handle_coefficient_edit, pattern="^coeff_"))
     
+    # Изменения подписчиков канала сбрасывают кэш проверки подписки
+    application.add_handler(ChatMemberHandler(handle_channel_member_update, ChatMemberHandler.CHAT_MEMBER))
+    # Блокировка бота пользователем исключает его из рассылок
+    application.add_handler(ChatMemberHandler(handle_bot_member_update, ChatMemberHandler.MY_CHAT_MEMBER))
+    
     # ЕДИНЫЙ обработчик текстовых сообщений
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_messages))
     
+    # Время обработки каждого обработчика попадает в метрики
+    instrument_handlers(application)
+    
+    # Фоновые задачи
+    application.job_queue.run_repeating(
+        flush_user_activity, interval=USER_FLUSH_INTERVAL, first=USER_FLUSH_INTERVAL, name="flush_user_activity"
+    )
+    application.job_queue.run_repeating(
+        verify_ban_cache, interval=BAN_VERIFY_INTERVAL, first=BAN_VERIFY_INTERVAL, name="verify_ban_cache"
+    )
+    application.job_queue.run_repeating(
+        release_expired_reservations, interval=RESERVATION_SWEEP_INTERVAL, first=0,
+        name="release_expired_reservations"
+    )
+    application.job_queue.run_repeating(
+        roll_up_revenue, interval=ROLLUP_INTERVAL, first=0, name="roll_up_revenue"
+    )
+    application.job_queue.run_repeating(
+        dump_profiles, interval=PROFILING_DUMP_INTERVAL, first=PROFILING_DUMP_INTERVAL, name="dump_profiles"
+    )
+    application.job_queue.run_repeating(
+        poll_pending_invoices, interval=PAYMENT_POLL_INTERVAL, first=PAYMENT_POLL_INTERVAL, name="poll_pending_invoices"
+    )
+    
     logger.info("🤖 Бот запущен!")
     print("=" * 50)
     print("✅ Бот успешно запущен!")
@@ -2043,11 +4997,15 @@ def main():
     print("3. Прокси")
     print("4. Подписки")
     print("5. Физы")
-    print("⚙️ Коэффициенты:")
+    print(f"⚙️ Коэффициенты (версия {pricing.version}):")
     print(f"   • Telegram Stars: {get_coefficient('stars')}")
     print(f"   • Steam комиссия: +{round((get_coefficient('steam') - 1) * 100, 1)}%")
     print(f"   • Курс USDT: {get_coefficient('exchange_rate')}")
     print(f"💰 Комиссия CryptoBot: {CRYPTOBOT_FEE*100}%")
+    if CRYPTOBOT_WEBHOOK_ENABLED:
+        print(f"🔔 Вебхук CryptoBot: {CRYPTOBOT_WEBHOOK_HOST}:{CRYPTOBOT_WEBHOOK_PORT}{CRYPTOBOT_WEBHOOK_PATH}")
+    if METRICS_ENABLED:
+        print(f"📈 Метрики: {METRICS_HOST}:{METRICS_PORT}{METRICS_PATH}")
     print("✅ Все системы работают")
     print("=" * 50)
     
@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк путей доступа к данным на синтетической базе реалистичного объёма.
+
+    python tools/bench_db.py --db /tmp/bench.sqlite3 --output before.json
+    python tools/bench_db.py --db /tmp/bench.sqlite3 --baseline before.json --output after.json
+
+Если файла --db нет, он создаётся: по умолчанию 1 000 000 заказов, 500 000 пользователей,
+5 000 товаров и 20 000 банов (детерминированно от --seed, генерация занимает минуты,
+поэтому базу стоит переиспользовать между коммитами). Без --db база временная.
+
+Каждый путь замеряется:
+
+* cold — один вызов на свежем соединении после сброса страниц файла базы из кэша ОС
+  (posix_fadvise DONTNEED; где его нет — только пустой кэш SQLite). Для путей,
+  работающих из памяти (каталог, баны), cold — загрузка из базы;
+* warm — --repeat вызовов подряд на прогретом соединении, p50/p95/среднее.
+
+Пишущие пути (save_user, update_product_stock, резерв, пересчёт счётчиков, отмена
+просроченных) выполняются в транзакции, которая откатывается: база не меняется
+между прогонами, время fsync при commit в замер не входит.
+
+--output сохраняет результаты в JSON, --baseline сравнивает с прошлым прогоном:
+путь считается регрессией, если cold или warm p50 выросли больше чем на --threshold
+(доля, 0.2 = 20%) и больше чем на --min-delta-ms. Код возврата 1 при регрессиях.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+INSERT_CHUNK = 50_000
+PRODUCT_TYPES = ['fixed'] * 18 + ['stars', 'steam']
+ORDER_STATUSES = ['paid'] * 85 + ['expired'] * 10 + ['pending'] * 5
+FIRST_USER_ID = 100_000_000
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def insert_chunked(conn, sql, rows):
+    """Вставляет строки генератора пачками по INSERT_CHUNK, одна транзакция на пачку"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == INSERT_CHUNK:
+            conn.executemany(sql, chunk)
+            conn.commit()
+            chunk = []
+    if chunk:
+        conn.executemany(sql, chunk)
+        conn.commit()
+
+
+def generate(path, users, orders, products, banned, seed):
+    rng = random.Random(seed)
+    now = datetime.now().replace(microsecond=0)
+    main.DB_PATH = path
+    main.init_db()
+    conn = main.get_db_connection()
+
+    category_ids = [row[0] for row in conn.execute('SELECT id FROM categories ORDER BY id')]
+    first_product = conn.execute('SELECT COALESCE(MAX(id), 0) FROM products').fetchone()[0] + 1
+    catalog = []
+    for number in range(products):
+        product_type = rng.choice(PRODUCT_TYPES)
+        catalog.append((
+            first_product + number, rng.choice(category_ids), f"Товар {number}",
+            round(rng.uniform(0.5, 50), 2), f"Описание товара {number}",
+            rng.randint(0, 500) if product_type == 'fixed' else 0, product_type
+        ))
+    insert_chunked(conn, '''
+        INSERT INTO products (id, category_id, name, price, description, stock, product_type)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', catalog)
+
+    def user_rows():
+        for number in range(users):
+            joined_at = now - timedelta(seconds=rng.randint(0, 365 * 86400))
+            yield (
+                FIRST_USER_ID + number,
+                f"user{number}" if rng.random() < 0.7 else None,
+                f"Покупатель {number}",
+                joined_at,
+                joined_at + timedelta(seconds=rng.randint(0, 30 * 86400)),
+                0 if rng.random() < 0.05 else 1
+            )
+
+    insert_chunked(conn, '''
+        INSERT INTO users (user_id, username, first_name, joined_at, last_activity, is_reachable)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', user_rows())
+
+    banned_ids = rng.sample(range(users), min(banned, users))
+    insert_chunked(conn, '''
+        INSERT INTO banned_users (user_id, username, first_name, banned_by, banned_at, reason)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (
+        (FIRST_USER_ID + number, f"user{number}", f"Покупатель {number}", main.ADMIN_ID,
+         now - timedelta(seconds=rng.randint(0, 365 * 86400)), 'Бенчмарк')
+        for number in banned_ids
+    ))
+
+    def order_rows():
+        for number in range(orders):
+            # Заказы сосредоточены у небольшой части покупателей
+            user_number = int(users * rng.random() ** 3)
+            product_id, _, name, price, _, _, product_type = rng.choice(catalog)
+            custom_amount = rng.choice((50, 100, 500, 1000)) if product_type != 'fixed' else None
+            status = rng.choice(ORDER_STATUSES)
+            if status == 'pending':
+                created_at = now - timedelta(seconds=rng.randint(0, 3 * 3600))
+            else:
+                created_at = now - timedelta(seconds=rng.randint(3 * 3600, 365 * 86400))
+            paid_at = created_at + timedelta(seconds=rng.randint(10, 900)) if status == 'paid' else None
+            yield (
+                f"BENCH{number:09d}", FIRST_USER_ID + user_number, f"user{user_number}",
+                f"Покупатель {user_number}", product_id, name, custom_amount, price,
+                round(price * 1.03, 2), str(rng.randint(10_000_000, 99_999_999)), status,
+                created_at, paid_at, FIRST_USER_ID + user_number, rng.randint(1, 10_000), 1
+            )
+
+    insert_chunked(conn, '''
+        INSERT INTO orders (invoice_id, user_id, username, first_name, product_id, product_name,
+                            custom_amount, price_amount, price_with_fee, cryptobot_invoice_id, status,
+                            created_at, paid_at, chat_id, message_id, pricing_version)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', order_rows())
+
+    while main._roll_up_batch(conn, main.ROLLUP_BATCH_SIZE):
+        conn.commit()
+    main.rebuild_shop_counters(conn)
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+
+
+def dataset(conn):
+    """Размеры базы и выборки id, из которых берутся параметры запросов"""
+    def ids(sql):
+        return [row[0] for row in conn.execute(sql)]
+
+    buyers = ids('SELECT user_id FROM orders WHERE id % 97 = 0')
+    return {
+        'orders': conn.execute('SELECT MAX(id) FROM orders').fetchone()[0] or 0,
+        'users': conn.execute('SELECT MAX(id) FROM users').fetchone()[0] or 0,
+        'products': conn.execute('SELECT COUNT(*) FROM products').fetchone()[0],
+        'banned': conn.execute('SELECT COUNT(*) FROM banned_users').fetchone()[0],
+        'product_ids': ids('SELECT id FROM products WHERE is_active = 1'),
+        'fixed_ids': ids("SELECT id FROM products WHERE is_active = 1 AND product_type = 'fixed'"),
+        'category_ids': ids('SELECT DISTINCT category_id FROM products WHERE is_active = 1'),
+        'admin_cursors': conn.execute('SELECT category_id, id FROM products WHERE id % 10 = 0').fetchall(),
+        'buyers': buyers or [FIRST_USER_ID],
+        'invoices': ids('SELECT invoice_id FROM orders WHERE id % 997 = 0') or ['BENCH000000000'],
+        'user_ids': ids('SELECT user_id FROM users WHERE id % 101 = 0') or [FIRST_USER_ID],
+        'ban_ids': ids('SELECT id FROM banned_users WHERE id % 13 = 0') or [0],
+    }
+
+
+def drop_os_cache(path):
+    """Сбрасывает страницы файлов базы из кэша ОС; False, если это недоступно"""
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    for filename in (path, path + '-wal'):
+        if not os.path.exists(filename):
+            continue
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return True
+
+
+# === ЗАМЕРЯЕМЫЕ ПУТИ ===
+# Каждый путь — функция (conn, rng, data) -> вызов без аргументов; подготовка
+# параметров в замер не входит. write=True — вызов откатывается после замера
+
+def bench_catalog_reload(conn, rng, data):
+    def run():
+        categories, products = main._load_catalog_rows(conn)
+        return main.CatalogSnapshot(1, categories, products)
+    return run
+
+
+def bench_get_product_info(conn, rng, data):
+    product_id = rng.choice(data['product_ids'])
+    return lambda: main.get_product_info(product_id)
+
+
+def bench_category_page(conn, rng, data):
+    category_id = rng.choice(data['category_ids'])
+    ids = main.catalog.snapshot.category_ids.get(category_id) or [0]
+    cursor = ids[rng.randrange(len(ids))]
+    return lambda: main.catalog.snapshot.category_page(category_id, 'next', cursor)
+
+
+def bench_ban_cache_load(conn, rng, data):
+    return lambda: {row[0] for row in conn.execute('SELECT user_id FROM banned_users')}
+
+
+def bench_is_user_banned(conn, rng, data):
+    user_id = rng.choice(data['user_ids'])
+    return lambda: main.is_user_banned(user_id)
+
+
+def bench_save_user(conn, rng, data):
+    # Пачка одного сброса UserActivityBuffer: в основном знакомые пользователи и немного новых
+    seen_at = datetime.now()
+    rows = [
+        (user_id, f"user{user_id}", 'Покупатель', seen_at, seen_at)
+        for user_id in rng.sample(data['user_ids'], min(450, len(data['user_ids'])))
+    ]
+    rows += [
+        (FIRST_USER_ID + data['users'] + number, None, 'Новый', seen_at, seen_at)
+        for number in range(50)
+    ]
+    return lambda: main._upsert_users(conn, rows)
+
+
+def bench_update_product_stock(conn, rng, data):
+    product_id = rng.choice(data['fixed_ids'] or data['product_ids'])
+    return lambda: main._update_product_stock(conn, product_id, -1)
+
+
+def bench_reserve_stock(conn, rng, data):
+    product_id = rng.choice(data['fixed_ids'] or data['product_ids'])
+    now = datetime.now()
+    invoice_id = f"BENCH_RESERVE_{rng.randrange(10 ** 9)}"
+    return lambda: main._reserve_stock(conn, invoice_id, product_id, 1, now, now)
+
+
+def bench_stats(conn, rng, data):
+    return lambda: main._load_shop_stats(conn)
+
+
+def bench_rebuild_stats(conn, rng, data):
+    return lambda: main.rebuild_shop_counters(conn)
+
+
+def bench_revenue_report_30d(conn, rng, data):
+    today = datetime.now().date()
+    date_from = (today - timedelta(days=29)).isoformat()
+    return lambda: main._load_revenue_report(conn, date_from, today.isoformat())
+
+
+def bench_revenue_report_365d(conn, rng, data):
+    today = datetime.now().date()
+    date_from = (today - timedelta(days=364)).isoformat()
+    return lambda: main._load_revenue_report(conn, date_from, today.isoformat())
+
+
+def bench_admin_page(conn, rng, data):
+    cursor = rng.choice(data['admin_cursors']) if data['admin_cursors'] else None
+    return lambda: main._load_admin_products(conn, 'next', cursor, main.ADMIN_PAGE_SIZE)
+
+
+def bench_orders_by_user(conn, rng, data):
+    user_id = rng.choice(data['buyers'])
+    return lambda: main._read_rendered_rows(
+        conn, main.ORDERS_BY_USER_SQL, (user_id, sys.maxsize), main._render_order, '', main.LIST_MAX_MESSAGES
+    )
+
+
+def bench_order_by_invoice(conn, rng, data):
+    invoice_id = rng.choice(data['invoices'])
+    return lambda: main._read_rendered_rows(
+        conn, main.ORDERS_BY_INVOICE_SQL, (invoice_id,), main._render_order, '', 1
+    )
+
+
+def bench_banned_page(conn, rng, data):
+    before_id = rng.choice(data['ban_ids']) or sys.maxsize
+    return lambda: main._read_rendered_rows(
+        conn, main.BANNED_LIST_SQL, (before_id,), main._render_banned_user, '', 1
+    )
+
+
+def bench_pending_orders(conn, rng, data):
+    return lambda: main._load_pending_order_stats(conn)
+
+
+def bench_expire_overdue(conn, rng, data):
+    deadline = datetime.now() - timedelta(seconds=main.ORDER_TIMEOUT)
+    return lambda: main._expire_overdue_orders(conn, deadline)
+
+
+# (имя, фабрика вызова, пишущий)
+BENCHMARKS = [
+    ('catalog_reload', bench_catalog_reload, False),
+    ('get_product_info', bench_get_product_info, False),
+    ('category_page', bench_category_page, False),
+    ('ban_cache_load', bench_ban_cache_load, False),
+    ('is_user_banned', bench_is_user_banned, False),
+    ('save_user', bench_save_user, True),
+    ('update_product_stock', bench_update_product_stock, True),
+    ('reserve_stock', bench_reserve_stock, True),
+    ('stats', bench_stats, False),
+    ('rebuild_stats', bench_rebuild_stats, True),
+    ('revenue_report_30d', bench_revenue_report_30d, False),
+    ('revenue_report_365d', bench_revenue_report_365d, False),
+    ('admin_page', bench_admin_page, False),
+    ('orders_by_user', bench_orders_by_user, False),
+    ('order_by_invoice', bench_order_by_invoice, False),
+    ('banned_page', bench_banned_page, False),
+    ('pending_orders', bench_pending_orders, False),
+    ('expire_overdue', bench_expire_overdue, True),
+]
+
+
+def timed_call(conn, call, write):
+    started = time.perf_counter()
+    call()
+    elapsed = (time.perf_counter() - started) * 1000
+    if write:
+        conn.rollback()
+    return elapsed
+
+
+def load_memory_state(conn):
+    """Каталог и баны в памяти, как после запуска бота"""
+    categories, products = main._load_catalog_rows(conn)
+    main.catalog.snapshot = main.CatalogSnapshot(1, categories, products)
+    main.ban_cache._ids = {row[0] for row in conn.execute('SELECT user_id FROM banned_users')}
+
+
+def run_benchmarks(path, repeat, seed, only):
+    conn = main.get_db_connection()
+    data = dataset(conn)
+    load_memory_state(conn)
+    conn.close()
+
+    results = {}
+    cache_dropped = False
+    for name, factory, write in BENCHMARKS:
+        if only and name not in only:
+            continue
+        rng = random.Random(f"{seed}:{name}")
+
+        cache_dropped = drop_os_cache(path)
+        conn = main.get_db_connection()
+        try:
+            cold = timed_call(conn, factory(conn, rng, data), write)
+            # Прогрев: первые вызовы на соединении подтягивают страницы и подготовленные запросы
+            for _ in range(min(repeat, 10)):
+                timed_call(conn, factory(conn, rng, data), write)
+            warm = [timed_call(conn, factory(conn, rng, data), write) for _ in range(repeat)]
+        finally:
+            conn.rollback()
+            conn.close()
+
+        results[name] = {
+            'cold_ms': round(cold, 4),
+            'warm_p50_ms': round(percentile(warm, 50), 4),
+            'warm_p95_ms': round(percentile(warm, 95), 4),
+            'warm_mean_ms': round(sum(warm) / len(warm), 4),
+        }
+
+    meta = {
+        'created_at': datetime.now().isoformat(sep=' ', timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'orders': data['orders'],
+        'users': data['users'],
+        'products': data['products'],
+        'banned': data['banned'],
+        'repeat': repeat,
+        'os_cache_dropped': cache_dropped,
+    }
+    return {'meta': meta, 'results': results}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline, threshold, min_delta_ms):
+    """Список (путь, метрика, было, стало) для замеров, выросших больше порога"""
+    regressions = []
+    for name, result in current['results'].items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            continue
+        for key in ('cold_ms', 'warm_p50_ms'):
+            old, new = previous.get(key), result[key]
+            if old is None:
+                continue
+            if new > old * (1 + threshold) and new - old > min_delta_ms:
+                regressions.append((name, key, old, new))
+    return regressions
+
+
+def print_report(report, baseline):
+    meta = report['meta']
+    print(
+        f"Заказов {meta['orders']}, пользователей {meta['users']}, товаров {meta['products']}, "
+        f"банов {meta['banned']}; повторов {meta['repeat']}, SQLite {meta['sqlite']}"
+    )
+    if not meta['os_cache_dropped']:
+        print("⚠️ Кэш ОС не сброшен: cold — только пустой кэш SQLite")
+    print(f"{'путь':>22} {'cold мс':>10} {'p50 мс':>10} {'p95 мс':>10} {'Δ p50':>8}")
+    for name, result in report['results'].items():
+        change = ''
+        previous = (baseline or {}).get('results', {}).get(name)
+        if previous and previous.get('warm_p50_ms'):
+            change = f"{(result['warm_p50_ms'] / previous['warm_p50_ms'] - 1) * 100:+.0f}%"
+        print(
+            f"{name:>22} {result['cold_ms']:>10} {result['warm_p50_ms']:>10} "
+            f"{result['warm_p95_ms']:>10} {change:>8}"
+        )
+
+
+def run(args, path):
+    if not os.path.exists(path):
+        started = time.perf_counter()
+        print(f"🛠 Генерация базы {path}...", file=sys.stderr)
+        generate(path, args.users, args.orders, args.products, args.banned, args.seed)
+        print(f"🛠 База готова за {time.perf_counter() - started:.1f} с", file=sys.stderr)
+    else:
+        main.DB_PATH = path
+        # Схема могла отстать от текущего кода
+        main.init_db()
+    only = {name.strip() for name in args.only.split(',') if name.strip()} if args.only else None
+    return run_benchmarks(path, args.repeat, args.seed, only)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Бенчмарк запросов бота на синтетической базе')
+    parser.add_argument('--db', help='файл базы: создаётся при отсутствии и переиспользуется')
+    parser.add_argument('--orders', type=int, default=1_000_000, help='заказов в новой базе')
+    parser.add_argument('--users', type=int, default=500_000, help='пользователей в новой базе')
+    parser.add_argument('--products', type=int, default=5_000, help='товаров в новой базе')
+    parser.add_argument('--banned', type=int, default=20_000, help='забаненных в новой базе')
+    parser.add_argument('--seed', type=int, default=1, help='зерно генерации данных и параметров')
+    parser.add_argument('--repeat', type=int, default=200, help='вызовов на прогретом соединении')
+    parser.add_argument('--only', help='замерить только эти пути (через запятую)')
+    parser.add_argument('--output', help='сохранить результаты в JSON')
+    parser.add_argument('--baseline', help='JSON прошлого прогона для сравнения')
+    parser.add_argument('--threshold', type=float, default=0.2, help='допустимый рост времени, доля')
+    parser.add_argument('--min-delta-ms', type=float, default=0.05, help='рост меньше этого не считается регрессией')
+    parser.add_argument('--json', action='store_true', help='вывести результаты в JSON')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    if args.db:
+        report = run(args, os.path.abspath(args.db))
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            report = run(args, os.path.join(tmp, 'bench.sqlite3'))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report, baseline)
+
+    regressions = compare(report, baseline, args.threshold, args.min_delta_ms) if baseline else []
+    for name, key, old, new in regressions:
+        print(f"🔺 {name} {key}: {old} → {new} мс ({(new / old - 1) * 100 if old else 0:+.0f}%)", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нагрузочная проверка резервирования товара: много покупателей одновременно
+берут один и тот же товар.
+
+    python tools/bench_reservations.py --buyers 2000 --stock 100
+
+Сравнивает две схемы на временной базе:
+
+* legacy      — как было раньше: покупатель видит остаток > 0, платит,
+                и только при подтверждении оплаты остаток читается и уменьшается;
+* reservation — условный UPDATE stock = stock - 1 WHERE stock >= 1 при создании заказа.
+
+Для каждой схемы выводит число успешных покупок, «оплативших без товара»,
+итоговый остаток и задержки p50/p95/p99. Код возврата 1, если резервирование
+продало больше, чем было на складе.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def create_product(stock):
+    conn = main.get_db_connection()
+    cursor = conn.execute('''
+        INSERT INTO products (category_id, name, price, description, stock, product_type)
+        VALUES (1, 'Бенчмарк', 1.0, 'Товар для нагрузочной проверки', ?, 'fixed')
+    ''', (stock,))
+    product_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return product_id
+
+
+def _legacy_confirm(conn, product_id):
+    # Старый путь подтверждения оплаты: чтение остатка и запись из Python
+    current_stock = conn.execute('SELECT stock FROM products WHERE id = ?', (product_id,)).fetchone()[0]
+    if current_stock <= 0:
+        return False
+    conn.execute('UPDATE products SET stock = ? WHERE id = ?', (current_stock - 1, product_id))
+    return True
+
+
+async def legacy_buyer(product_id):
+    """Возвращает (купил, оплатил без товара)"""
+    row = await main.db.fetchone('SELECT stock FROM products WHERE id = ?', (product_id,))
+    if row[0] <= 0:
+        return False, False
+    # Время между выставлением счёта и оплатой
+    await asyncio.sleep(0)
+    confirmed = await main.db.write(_legacy_confirm, product_id)
+    return confirmed, not confirmed
+
+
+async def reservation_buyer(product_id, buyer):
+    invoice_id = f"BENCH_{product_id}_{buyer}"
+    reserved = await main.db.write(
+        main._reserve_stock, invoice_id, product_id, 1, datetime.now(), datetime.now()
+    )
+    return reserved, False
+
+
+async def run_scenario(name, buyer_factory, buyers, stock):
+    product_id = create_product(stock)
+    latencies = []
+
+    async def timed(buyer):
+        started = time.perf_counter()
+        result = await buyer_factory(product_id, buyer)
+        latencies.append((time.perf_counter() - started) * 1000)
+        return result
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(timed(buyer) for buyer in range(buyers)))
+    elapsed = time.perf_counter() - started
+
+    final_stock = (await main.db.fetchone('SELECT stock FROM products WHERE id = ?', (product_id,)))[0]
+    reserved = (await main.db.fetchone(
+        "SELECT COALESCE(SUM(quantity), 0) FROM stock_reservations WHERE product_id = ? AND status = 'active'",
+        (product_id,)
+    ))[0]
+    return {
+        'scenario': name,
+        'buyers': buyers,
+        'stock': stock,
+        'sold': sum(1 for sold, _ in results if sold),
+        'paid_without_stock': sum(1 for _, stranded in results if stranded),
+        'final_stock': final_stock,
+        'reserved': reserved,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(buyers / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+    }
+
+
+async def run(buyers, stock):
+    try:
+        legacy = await run_scenario('legacy', lambda product_id, buyer: legacy_buyer(product_id), buyers, stock)
+        reservation = await run_scenario('reservation', reservation_buyer, buyers, stock)
+    finally:
+        main.db.close()
+    return [legacy, reservation]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Конкурентные покупки одного товара')
+    parser.add_argument('--buyers', type=int, default=1000, help='число одновременных покупателей')
+    parser.add_argument('--stock', type=int, default=100, help='начальный остаток товара')
+    parser.add_argument('--json', action='store_true', help='вывести результаты в JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        main.DB_PATH = os.path.join(tmp, 'bench.db')
+        main.init_db()
+        main.db = main.Database(main.DB_PATH)
+        results = asyncio.run(run(args.buyers, args.stock))
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        for result in results:
+            print(
+                f"{result['scenario']:>12}: продано {result['sold']}/{result['stock']}, "
+                f"оплатили без товара {result['paid_without_stock']}, остаток {result['final_stock']}, "
+                f"в резерве {result['reserved']}, {result['throughput_per_s']} покупок/с, "
+                f"p50 {result['p50_ms']} мс, p95 {result['p95_ms']} мс, p99 {result['p99_ms']} мс"
+            )
+
+    reservation = results[1]
+    oversold = reservation['sold'] > reservation['stock'] or reservation['final_stock'] < 0
+    sys.exit(1 if oversold else 0)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Локальная заглушка CryptoBot API (createInvoice / getInvoices + вебхуки).
+
+Позволяет проверить весь путь оплаты без реальных платежей:
+
+    python tools/fake_cryptobot.py --port 9000 \
+        --webhook-url http://127.0.0.1:8080/cryptobot/webhook
+
+    CRYPTOBOT_API_URL=http://127.0.0.1:9000/api/ CRYPTOBOT_WEBHOOK_ENABLED=1 python main.py
+
+Счет "оплачивается" открытием его pay_url (http://127.0.0.1:9000/pay?invoice_id=1)
+или автоматически через --auto-pay секунд. После оплаты заглушка отправляет
+подписанный вебхук invoice_paid, как настоящий CryptoBot.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime, timezone
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class FakeCryptoBot:
+    def __init__(self, api_token, webhook_url=None, auto_pay=None, host='127.0.0.1', port=9000):
+        self.api_token = api_token
+        self.webhook_url = webhook_url
+        self.auto_pay = auto_pay
+        self.invoices = {}
+        self.next_id = 1
+        self.calls = {'createInvoice': 0, 'getInvoices': 0}
+        self.server = main.LocalHTTPServer(host, port)
+        self.server.add_route('/api/createInvoice', self.handle_create_invoice)
+        self.server.add_route('/api/getInvoices', self.handle_get_invoices)
+        self.server.add_route('/pay', self.handle_pay)
+        self._client = None
+        self._tasks = set()
+
+    @property
+    def base_url(self):
+        return f"http://{self.server.host}:{self.server.port}"
+
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=10)
+        await self.server.start()
+
+    async def stop(self):
+        await self.server.stop()
+        for task in list(self._tasks):
+            task.cancel()
+        if self._client is not None:
+            await self._client.aclose()
+
+    @staticmethod
+    def _json(payload, status=200):
+        return status, 'application/json', json.dumps(payload).encode('utf-8')
+
+    def _authorized(self, request):
+        return request.headers.get('crypto-pay-api-token') == self.api_token
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _refresh_status(self, invoice):
+        if invoice['status'] == 'active' and datetime.now(timezone.utc).timestamp() > invoice['_expires_at']:
+            invoice['status'] = 'expired'
+
+    @staticmethod
+    def _public(invoice):
+        return {key: value for key, value in invoice.items() if not key.startswith('_')}
+
+    async def handle_create_invoice(self, request):
+        if not self._authorized(request):
+            return self._json({'ok': False, 'error': {'code': 401, 'name': 'UNAUTHORIZED'}}, 401)
+        self.calls['createInvoice'] += 1
+
+        params = json.loads(request.body or b'{}')
+        invoice_id = self.next_id
+        self.next_id += 1
+        now = datetime.now(timezone.utc)
+        invoice = {
+            'invoice_id': invoice_id,
+            'hash': f"FAKE{invoice_id}",
+            'status': 'active',
+            'asset': params.get('asset', 'USDT'),
+            'amount': params.get('amount'),
+            'description': params.get('description'),
+            'pay_url': f"{self.base_url}/pay?invoice_id={invoice_id}",
+            'created_at': now.isoformat(),
+            '_expires_at': now.timestamp() + int(params.get('expires_in', 900)),
+        }
+        self.invoices[invoice_id] = invoice
+
+        if self.auto_pay is not None:
+            self._spawn(self._pay_later(invoice_id, self.auto_pay))
+
+        return self._json({'ok': True, 'result': self._public(invoice)})
+
+    async def handle_get_invoices(self, request):
+        if not self._authorized(request):
+            return self._json({'ok': False, 'error': {'code': 401, 'name': 'UNAUTHORIZED'}}, 401)
+        self.calls['getInvoices'] += 1
+
+        ids = [int(value) for value in request.query.get('invoice_ids', '').split(',') if value]
+        count = int(request.query.get('count', 100))
+        items = []
+        for invoice_id in ids[:count]:
+            invoice = self.invoices.get(invoice_id)
+            if invoice:
+                self._refresh_status(invoice)
+                items.append(self._public(invoice))
+        return self._json({'ok': True, 'result': {'items': items}})
+
+    async def handle_pay(self, request):
+        invoice_id = int(request.query.get('invoice_id', 0))
+        if not await self.pay(invoice_id):
+            return 404, 'text/plain', 'Счет не найден или не активен'.encode('utf-8')
+        return 200, 'text/plain', f"Счет {invoice_id} оплачен".encode('utf-8')
+
+    async def _pay_later(self, invoice_id, delay):
+        await asyncio.sleep(delay)
+        await self.pay(invoice_id)
+
+    async def pay(self, invoice_id):
+        """Помечает счет оплаченным и отправляет вебхук invoice_paid"""
+        invoice = self.invoices.get(invoice_id)
+        if not invoice:
+            return False
+        self._refresh_status(invoice)
+        if invoice['status'] != 'active':
+            return False
+
+        invoice['status'] = 'paid'
+        invoice['paid_at'] = datetime.now(timezone.utc).isoformat()
+
+        if self.webhook_url:
+            await self.send_webhook(invoice)
+        return True
+
+    async def send_webhook(self, invoice):
+        body = json.dumps({
+            'update_id': invoice['invoice_id'],
+            'update_type': 'invoice_paid',
+            'request_date': datetime.now(timezone.utc).isoformat(),
+            'payload': self._public(invoice),
+        }).encode('utf-8')
+        headers = {
+            'Content-Type': 'application/json',
+            'crypto-pay-api-signature': main.cryptobot_signature(self.api_token, body),
+        }
+        try:
+            response = await self._client.post(self.webhook_url, content=body, headers=headers)
+            print(f"📨 Вебхук для счета {invoice['invoice_id']}: HTTP {response.status_code}")
+        except Exception as e:
+            print(f"❌ Ошибка отправки вебхука: {e}")
+
+
+async def run(args):
+    fake = FakeCryptoBot(args.token, args.webhook_url, args.auto_pay, args.host, args.port)
+    await fake.start()
+    print(f"🧪 Заглушка CryptoBot: {fake.base_url}/api/")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await fake.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Локальная заглушка CryptoBot API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--token', default=main.CRYPTOBOT_API_TOKEN, help='токен приложения (ключ подписи вебхуков)')
+    parser.add_argument('--webhook-url', help='куда отправлять вебхуки invoice_paid')
+    parser.add_argument('--auto-pay', type=float, help='оплачивать каждый счет через N секунд')
+    try:
+        asyncio.run(run(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Локальная заглушка Telegram Bot API для запуска бота без сети.
+
+    python tools/fake_telegram.py --port 9001
+
+    TELEGRAM_API_URL=http://127.0.0.1:9001/bot python main.py
+
+Поддерживает то, чем пользуется бот: getMe, getUpdates (long polling), sendMessage,
+editMessageText, answerCallbackQuery, getChat, getChatMember и несколько служебных
+методов. Любой пользователь считается подписчиком канала (--member-status меняет это).
+
+Обновления от «пользователей» добавляются из кода (send_text / press_button, так
+работает tools/loadtest.py) или вручную через http://127.0.0.1:9001/send?user_id=1&text=/start.
+Ответы бота складываются в очередь чата, откуда их забирает next_response().
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import deque
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+# Методы, которые просто возвращают True
+TRUE_METHODS = (
+    'deleteWebhook', 'setWebhook', 'close', 'logOut', 'setMyCommands', 'deleteMessage',
+    'sendChatAction', 'setChatMenuButton'
+)
+
+
+class FakeTelegram:
+    def __init__(self, token, host='127.0.0.1', port=9001, member_status='member'):
+        self.token = token
+        self.member_status = member_status
+        self.bot_user = {
+            'id': 1, 'is_bot': True, 'first_name': 'Shop', 'username': 'fake_shop_bot',
+            'can_join_groups': False, 'can_read_all_group_messages': False, 'supports_inline_queries': False
+        }
+        self.updates = deque()
+        self.next_update_id = 1
+        self.message_ids = {}
+        self.callback_chats = {}
+        self.inboxes = {}
+        self.calls = {}
+        self.polling = asyncio.Event()
+        self._new_update = asyncio.Event()
+        self._waiting_polls = 0
+
+        self.server = main.LocalHTTPServer(host, port)
+        methods = {
+            'getMe': self.handle_get_me,
+            'getUpdates': self.handle_get_updates,
+            'sendMessage': self.handle_send_message,
+            'editMessageText': self.handle_edit_message_text,
+            'editMessageReplyMarkup': self.handle_edit_message_text,
+            'answerCallbackQuery': self.handle_answer_callback_query,
+            'getChat': self.handle_get_chat,
+            'getChatMember': self.handle_get_chat_member,
+        }
+        methods.update({method: self.handle_true for method in TRUE_METHODS})
+        for method, handler in methods.items():
+            self.server.add_route(f"/bot{token}/{method}", self._counted(method, handler))
+        self.server.add_route('/send', self.handle_send)
+
+    @property
+    def base_url(self):
+        return f"http://{self.server.host}:{self.server.port}/bot"
+
+    async def start(self):
+        await self.server.start()
+
+    async def stop(self):
+        # Отпускаем висящий long polling, иначе его задачу отменит завершение цикла
+        self._new_update.set()
+        for _ in range(100):
+            if not self._waiting_polls:
+                break
+            await asyncio.sleep(0.01)
+        await self.server.stop()
+
+    def _counted(self, method, handler):
+        async def counted(request):
+            self.calls[method] = self.calls.get(method, 0) + 1
+            return await handler(self._params(request))
+        return counted
+
+    @staticmethod
+    def _params(request):
+        # python-telegram-bot шлёт form-urlencoded, сложные значения — строками JSON
+        if request.headers.get('content-type', '').startswith('application/json'):
+            params = json.loads(request.body or b'{}')
+        else:
+            params = {key: values[0] for key, values in parse_qs(request.body.decode('utf-8')).items()}
+        params.update(request.query)
+        for key, value in params.items():
+            if isinstance(value, str):
+                try:
+                    params[key] = json.loads(value)
+                except ValueError:
+                    pass
+        return params
+
+    @staticmethod
+    def _ok(result):
+        return 200, 'application/json', json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+    # === Сторона пользователей ===
+
+    def _next_message_id(self, chat_id):
+        self.message_ids[chat_id] = self.message_ids.get(chat_id, 0) + 1
+        return self.message_ids[chat_id]
+
+    @staticmethod
+    def _user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"Покупатель {user_id}", 'username': f"user{user_id}"}
+
+    def _chat(self, chat_id):
+        return {'id': chat_id, 'type': 'private' if chat_id > 0 else 'channel'}
+
+    def _push(self, update):
+        update['update_id'] = self.next_update_id
+        self.next_update_id += 1
+        self.updates.append(update)
+        self._new_update.set()
+        return update['update_id']
+
+    def send_text(self, user_id, text):
+        """Сообщение пользователя боту (команды размечаются как bot_command)"""
+        message = {
+            'message_id': self._next_message_id(user_id),
+            'date': int(time.time()),
+            'chat': self._chat(user_id),
+            'from': self._user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return self._push({'message': message})
+
+    def press_button(self, user_id, message, callback_data):
+        """Нажатие inline-кнопки под сообщением бота"""
+        query_id = str(self.next_update_id)
+        self.callback_chats[query_id] = user_id
+        return self._push({'callback_query': {
+            'id': query_id,
+            'from': self._user(user_id),
+            'message': message,
+            'chat_instance': str(user_id),
+            'data': callback_data,
+        }})
+
+    def inbox(self, chat_id):
+        if chat_id not in self.inboxes:
+            self.inboxes[chat_id] = asyncio.Queue()
+        return self.inboxes[chat_id]
+
+    def drain(self, chat_id):
+        inbox = self.inbox(chat_id)
+        while not inbox.empty():
+            inbox.get_nowait()
+
+    async def next_response(self, chat_id, timeout):
+        """Следующее сообщение, правка или всплывающий ответ бота в чате"""
+        return await asyncio.wait_for(self.inbox(chat_id).get(), timeout)
+
+    # === Методы Bot API ===
+
+    async def handle_true(self, params):
+        return self._ok(True)
+
+    async def handle_get_me(self, params):
+        return self._ok(self.bot_user)
+
+    async def handle_get_updates(self, params):
+        self.polling.set()
+        offset = int(params.get('offset') or 0)
+        while self.updates and self.updates[0]['update_id'] < offset:
+            self.updates.popleft()
+
+        timeout = float(params.get('timeout') or 0)
+        if not self.updates and timeout:
+            self._new_update.clear()
+            self._waiting_polls += 1
+            try:
+                await asyncio.wait_for(self._new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._waiting_polls -= 1
+
+        limit = int(params.get('limit') or 100)
+        return self._ok([self.updates[index] for index in range(min(limit, len(self.updates)))])
+
+    def _bot_message(self, chat_id, text, reply_markup=None, message_id=None):
+        message = {
+            'message_id': message_id or self._next_message_id(chat_id),
+            'date': int(time.time()),
+            'chat': self._chat(chat_id),
+            'from': self.bot_user,
+            'text': str(text),
+        }
+        if reply_markup:
+            message['reply_markup'] = reply_markup
+        self.inbox(chat_id).put_nowait(message)
+        return message
+
+    async def handle_send_message(self, params):
+        chat_id = int(params['chat_id'])
+        return self._ok(self._bot_message(chat_id, params.get('text', ''), params.get('reply_markup')))
+
+    async def handle_edit_message_text(self, params):
+        chat_id = int(params['chat_id'])
+        return self._ok(self._bot_message(
+            chat_id, params.get('text', ''), params.get('reply_markup'), int(params['message_id'])
+        ))
+
+    async def handle_answer_callback_query(self, params):
+        # Пустой ответ только гасит «часики» на кнопке, ответом бота не считается
+        chat_id = self.callback_chats.pop(str(params.get('callback_query_id')), None)
+        if chat_id is not None and params.get('text'):
+            self.inbox(chat_id).put_nowait({'text': str(params['text']), 'alert': True})
+        return self._ok(True)
+
+    async def handle_get_chat(self, params):
+        return self._ok({
+            'id': -1000000000001, 'type': 'channel', 'title': 'Канал',
+            'username': str(params.get('chat_id', '@channel')).lstrip('@')
+        })
+
+    async def handle_get_chat_member(self, params):
+        return self._ok({'status': self.member_status, 'user': self._user(int(params['user_id']))})
+
+    async def handle_send(self, request):
+        user_id = int(request.query.get('user_id', 0))
+        text = request.query.get('text', '')
+        if not user_id or not text:
+            return 400, 'text/plain', 'Нужны user_id и text'.encode('utf-8')
+        update_id = self.send_text(user_id, text)
+        return 200, 'text/plain', f"Обновление {update_id} поставлено в очередь".encode('utf-8')
+
+
+async def run(args):
+    fake = FakeTelegram(args.token, args.host, args.port, args.member_status)
+    await fake.start()
+    print(f"🧪 Заглушка Telegram Bot API: {fake.base_url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await fake.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Локальная заглушка Telegram Bot API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9001)
+    parser.add_argument('--token', default=main.BOT_TOKEN, help='токен бота из адреса запросов')
+    parser.add_argument('--member-status', default='member', help='статус подписки на канал для всех пользователей')
+    try:
+        asyncio.run(run(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный прогон бота без сети: main.py запускается отдельным процессом против
+локальных заглушек Telegram (tools/fake_telegram.py) и CryptoBot (tools/fake_cryptobot.py).
+
+    python tools/loadtest.py --customers 200 --concurrency 50
+
+Виртуальные покупатели проходят сценарии:
+
+* browse — /start, /price, категория, назад к категориям;
+* fixed  — /start, /price, категория, покупка товара с остатком, проверка оплаты;
+* stars  — то же для Telegram Stars с вводом количества и подтверждением;
+* steam  — то же для пополнения Steam.
+
+Счета оплачиваются заглушкой сразу, поэтому проверка оплаты проходит успешно.
+Задержка шага — от отправки обновления до первого ответа бота в чате (сообщение,
+правка или всплывающее уведомление). Выводятся p50/p95/p99 по шагам и общая
+пропускная способность; --json печатает то же в JSON. Код возврата 1, если были ошибки.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from fake_cryptobot import FakeCryptoBot  # noqa: E402
+from fake_telegram import FakeTelegram  # noqa: E402
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+FIRST_USER_ID = 1_000_000
+SCENARIOS = ('browse', 'fixed', 'stars', 'steam')
+
+# (категория, начало текста кнопки товара, сумма для Stars/Steam)
+PURCHASES = {
+    'fixed': ('Telegram Stars/Premium', 'Telegram Premium', None),
+    'stars': ('Telegram Stars/Premium', 'Telegram Stars', '100'),
+    'steam': ('Пополнение Steam', 'Пополнение Steam', '500'),
+}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def find_button(message, text_prefix=None, data_prefix=None):
+    """callback_data первой кнопки, подходящей по началу текста или данных"""
+    keyboard = (message.get('reply_markup') or {}).get('inline_keyboard', [])
+    for row in keyboard:
+        for button in row:
+            data = button.get('callback_data')
+            if data is None:
+                continue
+            if text_prefix and not button['text'].startswith(text_prefix):
+                continue
+            if data_prefix and not data.startswith(data_prefix):
+                continue
+            return data
+    return None
+
+
+class StepFailed(Exception):
+    pass
+
+
+class LoadTest:
+    def __init__(self, telegram, timeout):
+        self.telegram = telegram
+        self.timeout = timeout
+        self.latencies = {}
+        self.errors = {}
+        self.completed = {scenario: 0 for scenario in SCENARIOS}
+
+    async def step(self, name, user_id, send):
+        self.telegram.drain(user_id)
+        started = time.perf_counter()
+        send()
+        try:
+            response = await self.telegram.next_response(user_id, self.timeout)
+        except asyncio.TimeoutError:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            raise StepFailed(f"{name}: нет ответа за {self.timeout} с")
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+        return response
+
+    def text(self, name, user_id, text):
+        return self.step(name, user_id, lambda: self.telegram.send_text(user_id, text))
+
+    async def press(self, name, user_id, message, callback_data):
+        if callback_data is None:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            raise StepFailed(f"{name}: нет нужной кнопки")
+        return await self.step(
+            name, user_id, lambda: self.telegram.press_button(user_id, message, callback_data)
+        )
+
+    async def customer(self, user_id, scenario):
+        await self.text('start', user_id, '/start')
+        categories = await self.text('price', user_id, '/price')
+
+        if scenario == 'browse':
+            products = await self.press('category', user_id, categories, find_button(categories, data_prefix='cat_'))
+            await self.press('back', user_id, products, find_button(products, data_prefix='back_to_categories'))
+        else:
+            category, product, amount = PURCHASES[scenario]
+            products = await self.press('category', user_id, categories, find_button(categories, text_prefix=category))
+            invoice = await self.press('buy', user_id, products, find_button(products, text_prefix=product))
+            if amount is not None:
+                details = await self.text('amount', user_id, amount)
+                invoice = await self.press('confirm', user_id, details, find_button(details, data_prefix='confirm_custom'))
+            paid = await self.press('check', user_id, invoice, find_button(invoice, data_prefix='check_'))
+            if paid.get('alert'):
+                self.errors['check'] = self.errors.get('check', 0) + 1
+                raise StepFailed(f"check: {paid['text']}")
+
+        self.completed[scenario] += 1
+
+    async def run(self, customers, concurrency, mix):
+        semaphore = asyncio.Semaphore(concurrency)
+        failures = []
+
+        async def limited(number):
+            async with semaphore:
+                try:
+                    await self.customer(FIRST_USER_ID + number, mix[number % len(mix)])
+                except StepFailed as e:
+                    failures.append(str(e))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(number) for number in range(customers)))
+        return time.perf_counter() - started, failures
+
+    def report(self, elapsed, customers, concurrency):
+        steps = sum(len(values) for values in self.latencies.values())
+        every = [value for values in self.latencies.values() for value in values]
+
+        def summary(values):
+            return {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 50) * 1000, 2),
+                'p95_ms': round(percentile(values, 95) * 1000, 2),
+                'p99_ms': round(percentile(values, 99) * 1000, 2),
+            }
+
+        return {
+            'customers': customers,
+            'concurrency': concurrency,
+            'elapsed_s': round(elapsed, 3),
+            'updates_per_s': round(steps / elapsed, 1) if elapsed else 0.0,
+            'completed': self.completed,
+            'errors': self.errors,
+            'overall': summary(every),
+            'steps': {name: summary(values) for name, values in self.latencies.items()},
+            'api_calls': self.telegram.calls,
+        }
+
+
+def prepare_database(data_dir, stock):
+    """База с большим остатком фиксированного товара, чтобы покупки не упирались в склад"""
+    main.DB_PATH = os.path.join(data_dir, 'accounts.sqlite3')
+    main.init_db()
+    conn = main.get_db_connection()
+    conn.execute("UPDATE products SET stock = ? WHERE product_type = 'fixed'", (stock,))
+    main.rebuild_shop_counters(conn)
+    conn.commit()
+    conn.close()
+
+
+async def start_bot(telegram, cryptobot, data_dir, extra_env):
+    env = dict(os.environ)
+    env.update({
+        'TELEGRAM_API_URL': telegram.base_url,
+        'CRYPTOBOT_API_URL': f"{cryptobot.base_url}/api/",
+        'SHOP_DATA_DIR': data_dir,
+        'PYTHONUNBUFFERED': '1',
+    })
+    env.update(extra_env)
+    log = open(os.path.join(data_dir, 'bot.log'), 'wb')
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, MAIN_PATH, env=env, stdout=log, stderr=asyncio.subprocess.STDOUT
+    )
+    return process, log
+
+
+async def stop_bot(process, log):
+    if process.returncode is None:
+        process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(process.wait(), 30)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+    log.close()
+
+
+async def run(args):
+    mix = [scenario.strip() for scenario in args.mix.split(',') if scenario.strip()]
+    unknown = set(mix) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        prepare_database(data_dir, args.stock)
+
+        telegram = FakeTelegram(main.BOT_TOKEN, port=0)
+        cryptobot = FakeCryptoBot(main.CRYPTOBOT_API_TOKEN, auto_pay=0, port=0)
+        await telegram.start()
+        await cryptobot.start()
+
+        extra_env = dict(value.split('=', 1) for value in args.env)
+        process, log = await start_bot(telegram, cryptobot, data_dir, extra_env)
+        try:
+            await asyncio.wait_for(telegram.polling.wait(), args.startup_timeout)
+        except asyncio.TimeoutError:
+            await stop_bot(process, log)
+            with open(os.path.join(data_dir, 'bot.log'), encoding='utf-8', errors='replace') as f:
+                print(f.read()[-4000:], file=sys.stderr)
+            raise SystemExit("Бот не начал опрос getUpdates")
+
+        loadtest = LoadTest(telegram, args.timeout)
+        try:
+            elapsed, failures = await loadtest.run(args.customers, args.concurrency, mix)
+        finally:
+            await stop_bot(process, log)
+            await cryptobot.stop()
+            await telegram.stop()
+
+    for failure in failures[:10]:
+        print(f"⚠️ {failure}", file=sys.stderr)
+    return loadtest.report(elapsed, args.customers, args.concurrency)
+
+
+def print_report(result):
+    overall = result['overall']
+    print(
+        f"Покупателей {result['customers']}, параллельно {result['concurrency']}: "
+        f"{result['elapsed_s']} с, {result['updates_per_s']} обновлений/с"
+    )
+    print(f"Завершено: {result['completed']}, ошибок: {result['errors'] or 0}")
+    print(f"{'шаг':>10} {'кол-во':>7} {'p50 мс':>9} {'p95 мс':>9} {'p99 мс':>9}")
+    for name, summary in [('всего', overall)] + list(result['steps'].items()):
+        print(
+            f"{name:>10} {summary['count']:>7} {summary['p50_ms']:>9} "
+            f"{summary['p95_ms']:>9} {summary['p99_ms']:>9}"
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон бота на локальных заглушках')
+    parser.add_argument('--customers', type=int, default=100, help='число виртуальных покупателей')
+    parser.add_argument('--concurrency', type=int, default=20, help='покупателей одновременно')
+    parser.add_argument('--mix', default=','.join(SCENARIOS), help='сценарии по кругу через запятую')
+    parser.add_argument('--timeout', type=float, default=15, help='ожидание ответа бота на шаг, секунды')
+    parser.add_argument('--stock', type=int, default=1_000_000, help='остаток фиксированных товаров')
+    parser.add_argument('--startup-timeout', type=float, default=60, help='ожидание запуска бота, секунды')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='дополнительные переменные окружения бота (например PROFILING_ENABLED=1)')
+    parser.add_argument('--json', action='store_true', help='вывести результаты в JSON')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+    sys.exit(1 if result['errors'] else 0)